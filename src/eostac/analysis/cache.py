@@ -0,0 +1,160 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+import rasterio
+
+from zonal import HISTOGRAM_FILENAME, SPATIAL_INDEX_FILENAME, BlockHistograms, GridSpatialIndex
+
+# root of api data, a local folder with the same layout can stand in for s3 in tests
+DATA_ROOT_ENV = "EOSTAC_DATA_ROOT"
+DEFAULT_DATA_ROOT = "s3://geosprite-api-data/api_data"
+# seconds before cached datasets and results are read again, as the pipeline may publish new data
+CACHE_TTL_ENV = "EOSTAC_CACHE_TTL"
+DEFAULT_CACHE_TTL = 3600
+# gdal options for reading cloud optimized files on s3, environment variables set before take precedence
+GDAL_OPTIONS = {
+    # do not list s3 folders when opening a file, but still probe sidecar files,
+    # as overviews of api grids are external .ovr files and approximate statistics read them
+    "GDAL_DISABLE_READDIR_ON_OPEN": "TRUE",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.vrt,.ovr,.npz",
+    # merge range requests of neighbouring blocks
+    "GDAL_HTTP_MULTIRANGE": "YES",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MAX_RETRY": "3",
+    "GDAL_HTTP_RETRY_DELAY": "1",
+    # headers and blocks read by one invocation are kept for later ones
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(256 * 1024 * 1024),
+    "GDAL_CACHEMAX": "256",
+    "CPL_VSIL_CURL_CACHE_SIZE": str(256 * 1024 * 1024),
+}
+
+
+def configure_gdal():
+    # gdal reads config options from environment variables when they are used
+    for key, value in GDAL_OPTIONS.items():
+        os.environ.setdefault(key, value)
+
+
+def get_data_root() -> str:
+    return os.environ.get(DATA_ROOT_ENV, DEFAULT_DATA_ROOT).rstrip("/")
+
+
+def get_cache_ttl() -> float:
+    return float(os.environ.get(CACHE_TTL_ENV, DEFAULT_CACHE_TTL))
+
+
+def get_api_path(product_name: str, name: str, filename: str = "api.vrt") -> str:
+    """
+    path of api file of a product year, or "presence" of a product.
+    """
+    return f"{get_data_root()}/{product_name}/{name}/{filename}"
+
+
+class LRUCache:
+    """
+    Least recently used cache which lives across warm invocations of lambda, entries expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize: int, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.entries = collections.OrderedDict()
+        # grids are opened by workers of a query concurrently
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        """
+        cached value, None when it is missing or expired.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            created, value = self.entries[key]
+            if time.time() - created > get_cache_ttl():
+                self.pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.pop(key)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.maxsize:
+                self.pop(next(iter(self.entries)))
+
+    def pop(self, key):
+        with self.lock:
+            _, value = self.entries.pop(key)
+            if self.on_evict is not None:
+                self.on_evict(value)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self.pop(key)
+
+
+# open datasets by path, so vrt and headers are parsed once per container
+DATASETS = LRUCache(16, on_evict=lambda src: src.close())
+# grids opened by queries routed by spatial index, an evicted grid may still be read by a worker,
+# so it is not closed but released, and closed when the worker drops it
+GRIDS = LRUCache(256)
+# block histograms and spatial indexes by path, a missing file is cached as None in a tuple
+INDEXES = LRUCache(64)
+# statistics by the hash of request
+RESULTS = LRUCache(256)
+
+
+def open_dataset(vrt_path: str, cache: LRUCache = DATASETS) -> rasterio.DatasetReader:
+    """
+    cached dataset of api.vrt, or of a grid with the cache of grids.
+    """
+    src = cache.get(vrt_path)
+    if src is None:
+        src = rasterio.open(vrt_path)
+        cache.put(vrt_path, src)
+    return src
+
+
+def load_index(vrt_path: str, filename: str, loader):
+    """
+    cached file next to api.vrt loaded by loader, a missing file is cached as None.
+    """
+    path = vrt_path.rsplit("/", 1)[0] + "/" + filename
+    item = INDEXES.get(path)
+    if item is None:
+        item = (loader(path),)
+        INDEXES.put(path, item)
+    return item[0]
+
+
+def load_histograms(vrt_path: str) -> BlockHistograms | None:
+    """
+    cached block histograms next to api.vrt, None when they do not exist.
+    """
+    return load_index(vrt_path, HISTOGRAM_FILENAME, BlockHistograms.load)
+
+
+def load_spatial_index(vrt_path: str) -> GridSpatialIndex | None:
+    """
+    cached spatial index of grids next to api.vrt, None when it does not exist.
+    """
+    return load_index(vrt_path, SPATIAL_INDEX_FILENAME, GridSpatialIndex.load)
+
+
+def get_request_key(geojson: dict, **params) -> str:
+    """
+    canonical hash of geometries, feature ids and parameters of a request, the same region gives the same key
+    whatever the order of keys in geojson. ids are returned with statistics of features, so they are hashed.
+    """
+    geometries = [feature["geometry"] for feature in geojson["features"]]
+    ids = [feature.get("id") for feature in geojson["features"]]
+    content = json.dumps({"geometries": geometries, "ids": ids, **params}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(content.encode()).hexdigest()
@@ -1,25 +1,179 @@
 import json
-import rasterio
 from shapely.geometry import shape
-from rasterio import mask as msk
 import time
-import numpy as np
+from presence import PRESENCE_YEARS_KEY, derive_presence
+from cache import RESULTS, configure_gdal, get_api_path, get_request_key, load_histograms, load_spatial_index, \
+    open_dataset
+from zonal import DEFAULT_HISTOGRAM_BINS, DEFAULT_MEMORY_BUDGET, approximate_zonal_classes, get_max_pixels, \
+    grid_label_zonal_classes, grid_zonal_classes, grid_zonal_values, histogram_zonal_classes, label_zonal_classes, \
+    stream_zonal_classes, stream_zonal_values
 
-def lambda_handler(event, context):
+configure_gdal()
+
+
+def get_presence_derive(tags: dict, year: str, operation: str = None):
+    """
+    derive product of year like "2000" or years like "2000-2005" from presence cube.
+
+    Args:
+        tags: metadata of presence api.vrt with the years of bits
+    """
+    years = year.split("-")
+    cube_years = tags[PRESENCE_YEARS_KEY].split(",")
+    operation = operation or ("distribution" if len(years) == 1 else "statistics")
+    bits = [cube_years.index(y) for y in years]
+    return lambda cube: derive_presence(cube, bits, operation)
+
+
+def region_statistics(event) -> dict:
+    """
+    class counts of all features merged into one region in one product year.
+    """
+    geojson: dict = event["geojson"]
+    product_name: str = event["product_name"]
+    year: str = event["year"]
+    # all classes are returned when statistic_values is missing
+    statistic_values: list[int] = event.get("statistic_values")
+    # products of several years like "2000-2005" are derived from the presence cube of product
+    presence: bool = event.get("presence", False)
+    # bytes of pixels read at once, so large basins do not exceed lambda memory
+    memory_budget: int = event.get("memory_budget", DEFAULT_MEMORY_BUDGET)
+    # sum precomputed histograms of blocks inside geometry, pixels are read only on its boundary
+    use_histogram: bool = event.get("histogram", True)
+    # approximate statistics from overviews with error bounds, by the accuracy of class shares or the pixels read
+    accuracy: float = event.get("accuracy")
+    max_pixels: int = event.get("max_pixels")
+    # areas in km² of classes instead of pixel counts, pixels are weighted by the geodesic area of their rows
+    area: bool = event.get("area", False)
+
+    shapely_geoms = [shape(feature["geometry"]) for feature in geojson["features"]]
+    vrt_path = get_api_path(product_name, "presence" if presence else year)
+    if area and (accuracy is not None or max_pixels is not None):
+        raise ValueError("Areas are only counted exactly, accuracy and max_pixels can not be used with area.")
+    if accuracy is not None or max_pixels is not None:
+        src = open_dataset(vrt_path)
+        derive = get_presence_derive(src.tags(), year, event.get("operation")) if presence else None
+        max_pixels = get_max_pixels(accuracy) if max_pixels is None else max_pixels
+        return approximate_zonal_classes(src, shapely_geoms, derive, max_pixels).get_statistics(statistic_values)
+
+    # histograms of blocks have no rows of pixels, so areas are counted from pixels
+    histograms = load_histograms(vrt_path) if use_histogram and not area else None
+    # datasets and indexes are loaded once and shared by later requests of the warm container
+    if histograms is not None and histograms.matches(open_dataset(vrt_path)):
+        src = open_dataset(vrt_path)
+        derive = get_presence_derive(src.tags(), year, event.get("operation")) if presence else None
+        counter = histogram_zonal_classes(src, shapely_geoms, histograms, derive)
+        return counter.get_statistics(statistic_values)
+
+    index = load_spatial_index(vrt_path)
+    if index is not None:
+        # only grids intersecting the region are opened, vrt is never parsed
+        derive = get_presence_derive(index.metadata, year, event.get("operation")) if presence else None
+        counter = grid_zonal_classes(index, shapely_geoms, derive, memory_budget, area)
+    else:
+        # pixels outside geometry and nodata are not counted, blocks are streamed within memory budget
+        src = open_dataset(vrt_path)
+        derive = get_presence_derive(src.tags(), year, event.get("operation")) if presence else None
+        counter = stream_zonal_classes(src, shapely_geoms, derive, memory_budget, area=area)
+    return counter.get_statistics(statistic_values)
+
+
+def value_statistics(event) -> dict:
+    """
+    mean, std, min, max, percentiles and histogram of a continuous product like water clarity
+    inside all features merged into one region, in one streaming pass.
+    """
     geojson: dict = event["geojson"]
     product_name: str = event["product_name"]
     year: str = event["year"]
-    statistic_values: list[int] = event["statistic_values"]
+    # percentiles like 50 for the median
+    percentiles: list[float] = event.get("percentiles")
+    # (min, max) of fixed bins of histogram, no histogram when it is missing
+    value_range: list[float] = event.get("value_range")
+    bins: int = event.get("bins", DEFAULT_HISTOGRAM_BINS)
+    memory_budget: int = event.get("memory_budget", DEFAULT_MEMORY_BUDGET)
 
     shapely_geoms = [shape(feature["geometry"]) for feature in geojson["features"]]
-    vrt_file = f"s3://geosprite-api-data/api_data/{product_name}/{year}/api.vrt"
+    vrt_path = get_api_path(product_name, year)
+    index = load_spatial_index(vrt_path)
+    if index is not None:
+        statistics = grid_zonal_values(index, shapely_geoms, value_range, bins, memory_budget)
+    else:
+        statistics = stream_zonal_values(open_dataset(vrt_path), shapely_geoms, value_range, bins, memory_budget)
+    return statistics.get_statistics(percentiles)
+
+
+def label_statistics(vrt_path: str, geoms: list, years: list[str], presence: bool, operation: str,
+                     memory_budget: int, area: bool = False) -> list[list]:
+    """
+    counters of every feature for each year from a product year, or for all years from the presence cube.
+    """
+    index = load_spatial_index(vrt_path)
+    tags = index.metadata if index is not None else open_dataset(vrt_path).tags()
+    derives = [get_presence_derive(tags, year, operation) for year in years] if presence else [None]
+    if index is not None:
+        return grid_label_zonal_classes(index, geoms, derives, memory_budget, area)
+    return label_zonal_classes(open_dataset(vrt_path), geoms, derives, memory_budget, area=area)
 
-    with rasterio.open(vrt_file) as src:
+
+def batch_statistics(event) -> dict:
+    """
+    class counts of every feature in every product year, each window of a dataset is read once for all features,
+    and all years of presence products are derived from one read of the presence cube.
+    """
+    geojson: dict = event["geojson"]
+    product_name: str = event["product_name"]
+    years: list[str] = event["years"]
+    statistic_values: list[int] = event.get("statistic_values")
+    presence: bool = event.get("presence", False)
+    memory_budget: int = event.get("memory_budget", DEFAULT_MEMORY_BUDGET)
+    area: bool = event.get("area", False)
+
+    shapely_geoms = [shape(feature["geometry"]) for feature in geojson["features"]]
+    if presence:
+        counters = label_statistics(get_api_path(product_name, "presence"), shapely_geoms, years, True,
+                                    event.get("operation"), memory_budget, area)
+    else:
+        counters = [label_statistics(get_api_path(product_name, year), shapely_geoms, [year], False, None,
+                                     memory_budget, area)[0] for year in years]
+
+    return {"features": [
+        {"id": feature.get("id", i),
+         "years": {year: year_counters[i].get_statistics(statistic_values)
+                   for year, year_counters in zip(years, counters)}}
+        for i, feature in enumerate(geojson["features"])]}
+
+
+def lambda_handler(event, context):
+    """
+    class counts of a region in one year, or of each feature in several years when event has "years".
+    counts of a region are approximate with error bounds when event has "accuracy" or "max_pixels",
+    and are areas in km² when event has "area".
+    statistics of values of continuous products are returned when event has "statistics" of "values".
+    """
+    params = {key: event.get(key) for key in
+              ("product_name", "year", "years", "presence", "operation", "statistic_values", "accuracy",
+               "max_pixels", "area", "statistics", "percentiles", "value_range", "bins")}
+    request_key = get_request_key(event["geojson"], **params)
+    output_dict = RESULTS.get(request_key)
+    if output_dict is None:
         start_time = time.time()
-        crop_image, _ = msk.mask(src, shapely_geoms, crop=True)
-        output_dict = {value: np.count_nonzero(crop_image == value) for value in statistic_values}
+        try:
+            if event.get("statistics") == "values":
+                output_dict = value_statistics(event)
+            elif "years" in event:
+                output_dict = batch_statistics(event)
+            else:
+                output_dict = region_statistics(event)
+        except ValueError as e:
+            # invalid parameters, like unknown years or area with accuracy
+            return {
+                'statusCode': 400,
+                'body': json.dumps({"message": str(e)})
+            }
         end_time = time.time()
         print("consumed time:", end_time - start_time)
+        RESULTS.put(request_key, output_dict)
 
     return {
         'statusCode': 200,
@@ -0,0 +1,829 @@
+import concurrent.futures
+import functools
+import io
+import json
+import math
+import numbers
+import posixpath
+from typing import Callable
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio import features, windows
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from shapely import box, prepare
+from shapely.geometry.base import BaseGeometry
+from shapely.ops import unary_union
+
+# classes of integer products are counted by bincount below this value, others by unique
+MAX_BINCOUNT_VALUE = 1 << 16
+# peak memory of pixels read at once by streaming statistics
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+# bytes of each pixel besides data, geometry mask, nodata mask and the intp copy of bincount
+PIXEL_OVERHEAD = 1 + 1 + 8
+# per block class histograms written by the pipeline next to api.vrt
+HISTOGRAM_FILENAME = "histogram.npz"
+# spatial index of grids written by the pipeline next to api.vrt
+SPATIAL_INDEX_FILENAME = "grids.npz"
+# grids read at once by a query
+MAX_GRID_WORKERS = 8
+# s3 returns access denied instead of no such key for a missing key without ListBucket permission
+S3_MISSING_CODES = ("NoSuchKey", "404", "AccessDenied", "403")
+S3_CLIENT = None
+# z score of the 95% confidence error bound of approximate statistics
+ERROR_Z = 1.96
+# approximate statistics sample at least so many pixels
+MIN_APPROXIMATE_PIXELS = 256 * 256
+# semi-major axis in meters and flattening of WGS84 ellipsoid, pixel areas of geographic products are on it
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+# relative error of percentiles of continuous products, values are sketched into logarithmic buckets
+SKETCH_ACCURACY = 0.005
+# log bucket keys are shifted by it so they are small non-negative classes of bincount
+SKETCH_KEY_OFFSET = 1 << 15
+DEFAULT_PERCENTILES = [5, 25, 50, 75, 95]
+DEFAULT_HISTOGRAM_BINS = 20
+
+
+class ClassCounter:
+    """
+    Count pixels of every class inside geometry, all classes are counted in one pass.
+    counters of parts of a region can be merged.
+    """
+
+    def __init__(self, dtype: type = np.int64):
+        """
+        Args:
+            dtype: type of counts, float for weighted counts like areas
+        """
+        # counts of small non-negative integer classes, index is the class
+        self.bins = np.zeros(0, dtype=dtype)
+        # counts of other classes, like negative or float values
+        self.others = {}
+
+    def update(self, data: np.ndarray, valid: np.ndarray = None, row_weights: np.ndarray = None):
+        """
+        Args:
+            data: pixels of a window
+            valid: True for pixels inside geometry and not nodata, None means all pixels are valid
+            row_weights: weight of a pixel in each row of data, like its area, pixels are counted when it is None
+        """
+        if row_weights is not None and valid is None:
+            valid = np.ones(data.shape, dtype=bool)
+        values = data.ravel() if valid is None else data[valid]
+        if values.size == 0:
+            return
+        # row of each pixel, weights are applied to class counts of rows
+        rows = None if row_weights is None else np.nonzero(valid)[0]
+        if np.issubdtype(values.dtype, np.integer):
+            min_value, max_value = int(values.min()), int(values.max())
+            if min_value >= 0 and max_value < MAX_BINCOUNT_VALUE:
+                if rows is None:
+                    self.add_bins(np.bincount(values.astype(np.intp, copy=False), minlength=max_value + 1))
+                    return
+                # class counts of each row by one 2-D bincount
+                bin_count = max_value + 1
+                row_bins = np.bincount(rows * bin_count + values, minlength=data.shape[0] * bin_count)
+                self.add_bins(row_weights @ row_bins.reshape(data.shape[0], bin_count))
+                return
+        if rows is not None:
+            self.add_weighted(values, row_weights[rows])
+            return
+        classes, counts = np.unique(values, return_counts=True)
+        for value, count in zip(classes.tolist(), counts.tolist()):
+            self.others[value] = self.others.get(value, 0) + count
+
+    def update_window(self, data: np.ndarray, valid: np.ndarray, src: rasterio.DatasetReader,
+                      window: windows.Window):
+        """
+        update with pixels of a window of src, counters weighting pixels by their position override it.
+        """
+        self.update(data, valid)
+
+    def add_counts(self, classes: np.ndarray, counts: np.ndarray):
+        """
+        add counts of classes, like histograms of blocks.
+        """
+        if len(classes) == 0:
+            return
+        if np.issubdtype(classes.dtype, np.integer) and classes.min() >= 0 and classes.max() < MAX_BINCOUNT_VALUE:
+            bins = np.zeros(int(classes.max()) + 1, dtype=self.bins.dtype)
+            np.add.at(bins, classes.astype(np.intp), counts)
+            self.add_bins(bins)
+            return
+        for value, count in zip(classes.tolist(), counts.tolist()):
+            self.others[value] = self.others.get(value, 0) + count
+
+    def add_weighted(self, values: np.ndarray, weights: np.ndarray):
+        """
+        add pixels of any classes with their weights.
+        """
+        if values.size == 0:
+            return
+        classes, inverse = np.unique(values, return_inverse=True)
+        self.add_counts(classes, np.bincount(inverse.ravel(), weights=weights, minlength=len(classes)))
+
+    def add_bins(self, bins: np.ndarray):
+        if len(bins) > len(self.bins):
+            self.bins = np.pad(self.bins, (0, len(bins) - len(self.bins)))
+        self.bins[:len(bins)] += bins
+
+    def merge(self, other: "ClassCounter") -> "ClassCounter":
+        self.add_bins(other.bins)
+        for value, count in other.others.items():
+            self.others[value] = self.others.get(value, 0) + count
+        return self
+
+    @property
+    def total(self) -> int | float:
+        return self.bins.sum().item() + sum(self.others.values())
+
+    def get_counts(self) -> dict:
+        """
+        counts of all classes which appear.
+        """
+        counts = {value: count for value, count in enumerate(self.bins.tolist()) if count > 0}
+        for value, count in self.others.items():
+            counts[value] = counts.get(value, 0) + count
+        return dict(sorted(counts.items()))
+
+    def get_statistics(self, statistic_values: list = None) -> dict:
+        """
+        counts of requested classes and "total" of valid pixels, all classes when statistic_values is None.
+        """
+        counts = self.get_counts()
+        if statistic_values is not None:
+            counts = {value: counts.get(value, 0) for value in statistic_values}
+        counts["total"] = self.total
+        return counts
+
+
+@functools.lru_cache(maxsize=256)
+def get_row_areas(geo_transform: tuple, height: int, geographic: bool = True, unit: float = 1.0) -> np.ndarray:
+    """
+    area in km² of a pixel in each row of a north up grid, memoized per grid.
+    pixels of geographic grids are exact quadrangles on WGS84 ellipsoid, others have the same area in every row.
+
+    Args:
+        geo_transform: gdal geo transform of grid
+        height: rows of grid
+        geographic: grid is in degrees of latitude and longitude
+        unit: meters of the linear unit of projected grid
+    """
+    _, x_res, _, y_origin, _, y_res = geo_transform
+    if not geographic:
+        areas = np.full(height, abs(x_res * y_res) * unit * unit / 1e6)
+    else:
+        # area from the equator to each row edge is proportional to q of its latitude
+        e2 = WGS84_F * (2 - WGS84_F)
+        e = math.sqrt(e2)
+        sin_lat = np.sin(np.radians(np.clip(y_origin + y_res * np.arange(height + 1), -90, 90)))
+        q = sin_lat / (1 - e2 * sin_lat ** 2) + np.log((1 + e * sin_lat) / (1 - e * sin_lat)) / (2 * e)
+        b2 = WGS84_A * WGS84_A * (1 - e2)
+        areas = np.abs(np.diff(q)) * b2 * math.radians(abs(x_res)) / 2 / 1e6
+    areas.flags.writeable = False
+    return areas
+
+
+def get_dataset_row_areas(src: rasterio.DatasetReader) -> np.ndarray:
+    """
+    area in km² of a pixel in each row of src, a grid without crs is taken as geographic.
+    """
+    geographic = src.crs is None or src.crs.is_geographic
+    unit = 1.0 if geographic else src.crs.linear_units_factor[1]
+    return get_row_areas(src.transform.to_gdal(), src.height, geographic, unit)
+
+
+class AreaCounter(ClassCounter):
+    """
+    Area in km² of every class inside geometry, pixels are weighted by the area of their rows.
+    class counts of each row are multiplied by the row areas, so it costs about the same as counting.
+    """
+
+    def __init__(self):
+        super().__init__(np.float64)
+
+    def update_window(self, data: np.ndarray, valid: np.ndarray, src: rasterio.DatasetReader,
+                      window: windows.Window):
+        row_off = int(window.row_off)
+        self.update(data, valid, get_dataset_row_areas(src)[row_off:row_off + data.shape[0]])
+
+
+class ValueStatistics:
+    """
+    Moments, range, percentiles and histogram of a continuous product inside geometry, accumulated block by block
+    in constant memory. statistics of parts of a region can be merged.
+    percentiles are from a sketch of logarithmic buckets, so their relative error is at most SKETCH_ACCURACY.
+    """
+
+    def __init__(self, value_range: tuple[float, float] = None, bins: int = DEFAULT_HISTOGRAM_BINS):
+        """
+        Args:
+            value_range: (min, max) of the fixed bins of histogram, no histogram when it is None
+            bins: bins of histogram
+        """
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared differences from the mean
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        # log bucket counts of magnitudes of positive and negative values
+        self.positive = ClassCounter()
+        self.negative = ClassCounter()
+        self.zero = 0
+        self.value_range = None if value_range is None else tuple(float(value) for value in value_range)
+        self.histogram = None if value_range is None else np.zeros(bins, dtype=np.int64)
+        # values below and above the range of histogram
+        self.outside = [0, 0]
+
+    @staticmethod
+    def get_keys(magnitudes: np.ndarray) -> np.ndarray:
+        gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+        keys = np.ceil(np.log(magnitudes) / math.log(gamma)) + SKETCH_KEY_OFFSET
+        return np.clip(keys, 0, MAX_BINCOUNT_VALUE - 1).astype(np.intp)
+
+    @staticmethod
+    def get_key_values(keys: np.ndarray) -> np.ndarray:
+        gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+        return 2 * np.power(gamma, keys - SKETCH_KEY_OFFSET) / (gamma + 1)
+
+    def update(self, data: np.ndarray, valid: np.ndarray = None):
+        """
+        Args:
+            data: pixels of a window
+            valid: True for pixels inside geometry and not nodata, None means all pixels are valid
+        """
+        values = data.ravel() if valid is None else data[valid]
+        if np.issubdtype(values.dtype, np.floating):
+            values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        values = values.astype(np.float64, copy=False)
+        mean = float(values.mean())
+        self.merge_moments(values.size, mean, float(np.square(values - mean).sum()))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        self.positive.update(self.get_keys(values[values > 0]))
+        self.negative.update(self.get_keys(-values[values < 0]))
+        self.zero += int(np.count_nonzero(values == 0))
+        if self.histogram is not None:
+            low, high = self.value_range
+            self.histogram += np.histogram(values, len(self.histogram), self.value_range)[0]
+            self.outside[0] += int(np.count_nonzero(values < low))
+            self.outside[1] += int(np.count_nonzero(values > high))
+
+    def update_window(self, data: np.ndarray, valid: np.ndarray, src: rasterio.DatasetReader,
+                      window: windows.Window):
+        self.update(data, valid)
+
+    def merge_moments(self, count: int, mean: float, m2: float):
+        """
+        merge moments of another part by the parallel algorithm of Chan et al.
+        """
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    def merge(self, other: "ValueStatistics") -> "ValueStatistics":
+        if other.count == 0:
+            return self
+        self.merge_moments(other.count, other.mean, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zero += other.zero
+        if self.histogram is not None:
+            self.histogram += other.histogram
+            self.outside = [self.outside[0] + other.outside[0], self.outside[1] + other.outside[1]]
+        return self
+
+    def get_percentiles(self, percentiles: list[float]) -> dict:
+        """
+        values at percentiles like 50 for the median, from the sketch in ascending order of values.
+        """
+        if self.count == 0:
+            return {str(percentile): None for percentile in percentiles}
+        negative_keys = np.flatnonzero(self.negative.bins)[::-1]
+        positive_keys = np.flatnonzero(self.positive.bins)
+        values = np.concatenate([-self.get_key_values(negative_keys), [0.0], self.get_key_values(positive_keys)])
+        counts = np.concatenate([self.negative.bins[negative_keys], [self.zero], self.positive.bins[positive_keys]])
+        ranks = np.cumsum(counts)
+        result = {}
+        for percentile in percentiles:
+            rank = percentile / 100 * (self.count - 1)
+            value = values[min(int(np.searchsorted(ranks, rank, side="right")), len(values) - 1)]
+            result[str(percentile)] = min(max(float(value), self.min), self.max)
+        return result
+
+    def get_statistics(self, percentiles: list[float] = None) -> dict:
+        """
+        "count" of valid pixels, "mean", "std", "min", "max", "percentiles",
+        and "histogram" with "edges" of bins, "counts" and counts "below" and "above" its range.
+        """
+        empty = self.count == 0
+        statistics = {
+            "count": self.count,
+            "mean": None if empty else self.mean,
+            "std": None if empty else math.sqrt(self.m2 / self.count),
+            "min": None if empty else self.min,
+            "max": None if empty else self.max,
+            "percentiles": self.get_percentiles(DEFAULT_PERCENTILES if percentiles is None else percentiles),
+        }
+        if self.histogram is not None:
+            edges = np.linspace(*self.value_range, len(self.histogram) + 1)
+            statistics["histogram"] = {"edges": edges.tolist(), "counts": self.histogram.tolist(),
+                                       "below": self.outside[0], "above": self.outside[1]}
+        return statistics
+
+
+def get_stream_windows(src: rasterio.DatasetReader, geometry: BaseGeometry, memory_budget: int,
+                       itemsize: int) -> list[windows.Window]:
+    """
+    windows of whole internal blocks covering geometry, each has at most memory_budget bytes of pixels.
+    windows not intersecting geometry are skipped.
+    """
+    block_height, block_width = src.block_shapes[0]
+    region = windows.from_bounds(*geometry.bounds, transform=src.transform)
+    row_start = max(math.floor(region.row_off) // block_height * block_height, 0)
+    col_start = max(math.floor(region.col_off) // block_width * block_width, 0)
+    row_stop = min(math.ceil(region.row_off + region.height), src.height)
+    col_stop = min(math.ceil(region.col_off + region.width), src.width)
+    if row_start >= row_stop or col_start >= col_stop:
+        return []
+
+    max_blocks = max(1, memory_budget // ((itemsize + PIXEL_OVERHEAD) * block_height * block_width))
+    col_blocks = min(max_blocks, math.ceil((col_stop - col_start) / block_width))
+    window_width = col_blocks * block_width
+    window_height = max(1, max_blocks // col_blocks) * block_height
+
+    stream_windows = []
+    for row_off in range(row_start, row_stop, window_height):
+        for col_off in range(col_start, col_stop, window_width):
+            window = windows.Window(col_off, row_off, min(window_width, col_stop - col_off),
+                                    min(window_height, row_stop - row_off))
+            if geometry.intersects(box(*windows.bounds(window, src.transform))):
+                stream_windows.append(window)
+    return stream_windows
+
+
+def stream_zonal_classes(src: rasterio.DatasetReader, geoms: list[BaseGeometry],
+                         derive: Callable[[np.ndarray], np.ndarray] = None,
+                         memory_budget: int = DEFAULT_MEMORY_BUDGET, band: int = 1,
+                         area: bool = False) -> ClassCounter:
+    """
+    count classes inside geometry window by window, peak memory is bounded by memory_budget
+    however large the geometry is. pixels are inside geometry by their centers like rasterio mask.
+
+    Args:
+        src: dataset in the crs of geoms
+        geoms: shapes of region
+        derive: product derived from pixels of a window, like the years of presence cube
+        memory_budget: bytes of pixels read at once
+        band: band to count
+        area: count areas in km² of classes instead of pixels
+    """
+    geometry = unary_union(geoms)
+    prepare(geometry)
+    # the row index of each pixel is also held in area mode
+    itemsize = np.dtype(src.dtypes[band - 1]).itemsize + (8 if area else 0)
+    counter = AreaCounter() if area else ClassCounter()
+    count_windows(src, geoms, geometry, get_stream_windows(src, geometry, memory_budget, itemsize), counter,
+                  derive, band)
+    return counter
+
+
+def stream_zonal_values(src: rasterio.DatasetReader, geoms: list[BaseGeometry],
+                        value_range: tuple[float, float] = None, bins: int = DEFAULT_HISTOGRAM_BINS,
+                        memory_budget: int = DEFAULT_MEMORY_BUDGET, band: int = 1) -> ValueStatistics:
+    """
+    statistics of a continuous product inside geometry in one pass window by window, like stream_zonal_classes.
+
+    Args:
+        value_range: (min, max) of histogram, no histogram when it is None
+        bins: bins of histogram
+    """
+    geometry = unary_union(geoms)
+    prepare(geometry)
+    # float64 copy and log bucket keys of values besides the pixels
+    itemsize = np.dtype(src.dtypes[band - 1]).itemsize + 8 + 8
+    statistics = ValueStatistics(value_range, bins)
+    count_windows(src, geoms, geometry, get_stream_windows(src, geometry, memory_budget, itemsize), statistics,
+                  band=band)
+    return statistics
+
+
+def count_windows(src: rasterio.DatasetReader, geoms: list[BaseGeometry], geometry: BaseGeometry,
+                  stream_windows: list[windows.Window], counter: ClassCounter | ValueStatistics,
+                  derive: Callable[[np.ndarray], np.ndarray] = None, band: int = 1):
+    """
+    count classes of pixels inside geometry in windows one by one, or accumulate statistics of their values.
+    """
+    for window in stream_windows:
+        image = src.read(band, window=window, masked=True)
+        valid = ~np.ma.getmaskarray(image)
+        # rasterizing is skipped for windows inside geometry
+        if not geometry.contains(box(*windows.bounds(window, src.transform))):
+            valid &= features.geometry_mask(geoms, out_shape=valid.shape, transform=src.window_transform(window),
+                                            invert=True)
+        data = np.ma.getdata(image)
+        counter.update_window(data if derive is None else derive(data), valid, src, window)
+
+
+def get_s3_client():
+    """
+    s3 client shared by all reads of the container, boto3 is only needed for data on s3.
+    """
+    global S3_CLIENT
+    if S3_CLIENT is None:
+        import boto3
+
+        S3_CLIENT = boto3.client("s3")
+    return S3_CLIENT
+
+
+def read_bytes(path: str) -> bytes | None:
+    """
+    content of a local or s3 file, None when it does not exist.
+    """
+    if path.startswith("s3://"):
+        from botocore.exceptions import ClientError
+
+        bucket, key = path[len("s3://"):].split("/", 1)
+        try:
+            return get_s3_client().get_object(Bucket=bucket, Key=key)["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in S3_MISSING_CODES:
+                return None
+            raise
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class BlockHistograms:
+    """
+    Class histograms of blocks in the pixel grid of api.vrt, blocks with only nodata are not stored.
+    """
+
+    def __init__(self, arrays):
+        self.row = arrays["row"].astype(np.int64)
+        self.col = arrays["col"].astype(np.int64)
+        self.classes = arrays["classes"]
+        self.counts = arrays["counts"]
+        self.block_size = int(arrays["block_size"])
+        self.shape = tuple(int(size) for size in arrays["shape"])
+        self.geo_transform = tuple(float(value) for value in arrays["geo_transform"])
+        # boxes and their tree are built once and kept with histograms in the cache of warm container
+        self.boxes = self.get_boxes()
+        self.tree = shapely.STRtree(self.boxes)
+
+    @classmethod
+    def load(cls, path: str) -> "BlockHistograms | None":
+        content = read_bytes(path)
+        if content is None:
+            return None
+        with np.load(io.BytesIO(content)) as arrays:
+            return cls(arrays)
+
+    def matches(self, src: rasterio.DatasetReader) -> bool:
+        """
+        histograms are of the pixel grid of src, they are stale when the grid changes.
+        """
+        return self.shape == (src.height, src.width) and np.allclose(self.geo_transform, src.transform.to_gdal())
+
+    def get_windows(self, indexes: np.ndarray) -> list[windows.Window]:
+        height, width = self.shape
+        col_offs, row_offs = self.col[indexes] * self.block_size, self.row[indexes] * self.block_size
+        return [windows.Window(col_off, row_off, min(self.block_size, width - col_off),
+                               min(self.block_size, height - row_off))
+                for col_off, row_off in zip(col_offs.tolist(), row_offs.tolist())]
+
+    def get_boxes(self) -> np.ndarray:
+        height, width = self.shape
+        x_origin, x_res, _, y_origin, _, y_res = self.geo_transform
+        col_offs, row_offs = self.col * self.block_size, self.row * self.block_size
+        x1 = x_origin + col_offs * x_res
+        x2 = x_origin + np.minimum(col_offs + self.block_size, width) * x_res
+        y1 = y_origin + row_offs * y_res
+        y2 = y_origin + np.minimum(row_offs + self.block_size, height) * y_res
+        return shapely.box(np.minimum(x1, x2), np.minimum(y1, y2), np.maximum(x1, x2), np.maximum(y1, y2))
+
+
+def histogram_zonal_classes(src: rasterio.DatasetReader, geoms: list[BaseGeometry], histograms: BlockHistograms,
+                            derive: Callable[[np.ndarray], np.ndarray] = None, band: int = 1) -> ClassCounter:
+    """
+    count classes inside geometry by summing histograms of blocks inside it,
+    pixels are read only for blocks crossed by the boundary of geometry.
+
+    Args:
+        src: dataset of histograms, in the crs of geoms
+        histograms: class histograms of blocks of src
+        derive: product derived from classes, like the years of presence cube
+    """
+    geometry = unary_union(geoms)
+    prepare(geometry)
+    # only blocks intersecting geometry are tested, instead of every block of the product
+    indexes = np.sort(histograms.tree.query(geometry, predicate="intersects"))
+    inside = shapely.contains(geometry, histograms.boxes[indexes])
+
+    counter = ClassCounter()
+    classes = histograms.classes if derive is None else derive(histograms.classes)
+    counter.add_counts(classes, histograms.counts[indexes[inside]].sum(axis=0, dtype=np.int64))
+    count_windows(src, geoms, geometry, histograms.get_windows(indexes[~inside]), counter, derive, band)
+    return counter
+
+
+def get_label_layers(geoms: list[BaseGeometry]) -> list[list[int]]:
+    """
+    greedily group features into layers whose features do not overlap, so each layer is one label image.
+    features only touching each other are in the same layer.
+    """
+    layers, unions = [], []
+    for i, geom in enumerate(geoms):
+        for j, union in enumerate(unions):
+            if not union.intersects(geom) or union.touches(geom):
+                layers[j].append(i)
+                unions[j] = union.union(geom)
+                break
+        else:
+            layers.append([i])
+            unions.append(geom)
+    return layers
+
+
+def count_labels(labels: np.ndarray, label_count: int, data: np.ndarray, valid: np.ndarray,
+                 counters: list[ClassCounter], pixel_areas: np.ndarray = None):
+    """
+    count classes of every label with one 2-D bincount, label 0 is outside features.
+
+    Args:
+        pixel_areas: area of each pixel for area counters, pixels are counted when it is None
+    """
+    inside = valid & (labels > 0)
+    labels, values = labels[inside], data[inside]
+    areas = None if pixel_areas is None else pixel_areas[inside]
+    if values.size == 0:
+        return
+    if np.issubdtype(values.dtype, np.integer) and values.min() >= 0 and values.max() < MAX_BINCOUNT_VALUE:
+        bin_count = int(values.max()) + 1
+        bins = np.bincount(labels.astype(np.intp) * bin_count + values, weights=areas,
+                           minlength=(label_count + 1) * bin_count)
+        for counter, label_bins in zip(counters, bins.reshape(label_count + 1, bin_count)[1:]):
+            counter.add_bins(label_bins)
+        return
+    for label, counter in enumerate(counters, 1):
+        if areas is None:
+            counter.update(values, labels == label)
+        else:
+            counter.add_weighted(values[labels == label], areas[labels == label])
+
+
+def label_zonal_classes(src: rasterio.DatasetReader, geoms: list[BaseGeometry],
+                        derives: list[Callable[[np.ndarray], np.ndarray] | None] = (None,),
+                        memory_budget: int = DEFAULT_MEMORY_BUDGET, band: int = 1,
+                        area: bool = False) -> list[list[ClassCounter]]:
+    """
+    count classes of every feature and every derived product, each window of src is read once,
+    and features are rasterized into label images of non-overlapping layers.
+
+    Args:
+        src: dataset in the crs of geoms
+        geoms: shape of each feature
+        derives: products derived from pixels, like the years of presence cube, None for pixels themselves
+        memory_budget: bytes of pixels read at once
+        area: count areas in km² of classes instead of pixels
+
+    Returns:
+        counters of each feature for each product
+    """
+    counter_type = AreaCounter if area else ClassCounter
+    counters = [[counter_type() for _ in geoms] for _ in derives]
+    if len(geoms) == 0:
+        return counters
+    geometry = unary_union(geoms)
+    prepare(geometry)
+    layers = get_label_layers(geoms)
+    # label image and the index of 2-D bincount besides the pixels, and the weight of each pixel in area mode
+    itemsize = np.dtype(src.dtypes[band - 1]).itemsize + 4 + 8 + (8 if area else 0)
+    for window in get_stream_windows(src, geometry, memory_budget, itemsize):
+        image = src.read(band, window=window, masked=True)
+        valid = ~np.ma.getmaskarray(image)
+        data = np.ma.getdata(image)
+        products = [data if derive is None else derive(data) for derive in derives]
+        transform = src.window_transform(window)
+        pixel_areas = None
+        if area:
+            row_off = int(window.row_off)
+            row_areas = get_dataset_row_areas(src)[row_off:row_off + data.shape[0]]
+            pixel_areas = np.broadcast_to(row_areas[:, np.newaxis], data.shape)
+        for layer in layers:
+            labels = features.rasterize([(geoms[i], label) for label, i in enumerate(layer, 1)], out_shape=data.shape,
+                                        transform=transform, fill=0, dtype=np.uint32)
+            for product, product_counters in zip(products, counters):
+                count_labels(labels, len(layer), product, valid, [product_counters[i] for i in layer], pixel_areas)
+    return counters
+
+
+def join_path(folder: str, path: str) -> str:
+    """
+    join a relative path to a local or s3 folder, ".." is resolved as gdal does not resolve it on s3.
+    """
+    if "://" in folder:
+        scheme, folder = folder.split("://", 1)
+        return f"{scheme}://{posixpath.normpath(posixpath.join(folder, path))}"
+    return posixpath.normpath(posixpath.join(folder, path))
+
+
+class GridSpatialIndex:
+    """
+    Bounding boxes and paths of grids of api.vrt, a query opens only the grids intersecting its region.
+    grids of api.vrt do not overlap, so counts of grids are added up.
+    """
+
+    def __init__(self, arrays, folder: str):
+        self.paths = [join_path(folder, path) for path in arrays["path"].tolist()]
+        self.bbox = arrays["bbox"]
+        self.metadata = json.loads(str(arrays["metadata"]))
+
+    @classmethod
+    def load(cls, path: str) -> "GridSpatialIndex | None":
+        content = read_bytes(path)
+        if content is None:
+            return None
+        with np.load(io.BytesIO(content)) as arrays:
+            return cls(arrays, path.rsplit("/", 1)[0])
+
+    def query(self, geometry: BaseGeometry) -> list[str]:
+        """
+        paths of grids intersecting geometry.
+        """
+        min_x, min_y, max_x, max_y = geometry.bounds
+        candidates = np.flatnonzero((self.bbox[:, 0] < max_x) & (self.bbox[:, 2] > min_x) &
+                                    (self.bbox[:, 1] < max_y) & (self.bbox[:, 3] > min_y))
+        boxes = shapely.box(*self.bbox[candidates].T)
+        return [self.paths[i] for i in candidates[shapely.intersects(geometry, boxes)]]
+
+
+def map_grids(func: Callable[[rasterio.DatasetReader], object], paths: list[str],
+              max_workers: int = MAX_GRID_WORKERS) -> list:
+    """
+    apply func to every grid in a thread pool, gdal releases gil when reading.
+    grids are kept open in the cache of the warm container, so they are not closed here.
+    """
+    # cache imports this module for loaders of indexes
+    from cache import GRIDS, open_dataset
+
+    def run(path: str):
+        return func(open_dataset(path, GRIDS))
+
+    if len(paths) <= 1:
+        return [run(path) for path in paths]
+    with concurrent.futures.ThreadPoolExecutor(min(max_workers, len(paths))) as executor:
+        return list(executor.map(run, paths))
+
+
+def grid_zonal_classes(index: GridSpatialIndex, geoms: list[BaseGeometry],
+                       derive: Callable[[np.ndarray], np.ndarray] = None,
+                       memory_budget: int = DEFAULT_MEMORY_BUDGET, area: bool = False) -> ClassCounter:
+    """
+    count classes inside geometry from the grids intersecting it concurrently, memory budget is shared by workers.
+    """
+    geometry = unary_union(geoms)
+    paths = index.query(geometry)
+    budget = memory_budget // max(1, min(MAX_GRID_WORKERS, len(paths)))
+    counter = AreaCounter() if area else ClassCounter()
+    for grid_counter in map_grids(lambda src: stream_zonal_classes(src, geoms, derive, budget, area=area), paths):
+        counter.merge(grid_counter)
+    return counter
+
+
+def grid_zonal_values(index: GridSpatialIndex, geoms: list[BaseGeometry], value_range: tuple[float, float] = None,
+                      bins: int = DEFAULT_HISTOGRAM_BINS,
+                      memory_budget: int = DEFAULT_MEMORY_BUDGET) -> ValueStatistics:
+    """
+    statistics of a continuous product inside geometry from the grids intersecting it concurrently.
+    """
+    paths = index.query(unary_union(geoms))
+    budget = memory_budget // max(1, min(MAX_GRID_WORKERS, len(paths)))
+    statistics = ValueStatistics(value_range, bins)
+    for grid_statistics in map_grids(lambda src: stream_zonal_values(src, geoms, value_range, bins, budget), paths):
+        statistics.merge(grid_statistics)
+    return statistics
+
+
+def grid_label_zonal_classes(index: GridSpatialIndex, geoms: list[BaseGeometry],
+                             derives: list[Callable[[np.ndarray], np.ndarray] | None] = (None,),
+                             memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                             area: bool = False) -> list[list[ClassCounter]]:
+    """
+    label_zonal_classes over the grids intersecting any feature concurrently.
+    """
+    counter_type = AreaCounter if area else ClassCounter
+    counters = [[counter_type() for _ in geoms] for _ in derives]
+    if len(geoms) == 0:
+        return counters
+    paths = index.query(unary_union(geoms))
+    budget = memory_budget // max(1, min(MAX_GRID_WORKERS, len(paths)))
+    for grid_counters in map_grids(lambda src: label_zonal_classes(src, geoms, derives, budget, area=area), paths):
+        for product_counters, grid_product_counters in zip(counters, grid_counters):
+            for counter, grid_counter in zip(product_counters, grid_product_counters):
+                counter.merge(grid_counter)
+    return counters
+
+
+def get_max_pixels(accuracy: float) -> int:
+    """
+    pixels to sample so the error of the share of any class is within accuracy, like 0.01 for 1%.
+    """
+    if isinstance(accuracy, bool) or not isinstance(accuracy, numbers.Real) or not 0 < accuracy < 1:
+        raise ValueError(f"accuracy should be a number between 0 and 1, but got {accuracy!r}.")
+    return max(MIN_APPROXIMATE_PIXELS, math.ceil((ERROR_Z / (2 * accuracy)) ** 2))
+
+
+class ApproximateClasses:
+    """
+    Class counts sampled from a coarse resolution and scaled to full resolution, with estimated error bounds.
+    """
+
+    def __init__(self, counter: ClassCounter, scale: float, factor: int, boundary_pixels: float):
+        """
+        Args:
+            counter: counts of coarse pixels
+            scale: full resolution pixels of a coarse pixel
+            factor: decimation factor of coarse resolution
+            boundary_pixels: full resolution pixels which may be inside or outside geometry at coarse resolution
+        """
+        self.counter = counter
+        self.scale = scale
+        self.factor = factor
+        self.boundary_pixels = boundary_pixels
+
+    def get_statistics(self, statistic_values: list = None) -> dict:
+        """
+        scaled counts like ClassCounter, "error" of each count and "overview_factor" which is read.
+        a count error is the sampling error of 95% confidence plus its share of boundary error.
+        """
+        counts = self.counter.get_statistics(statistic_values)
+        sampled = counts.pop("total")
+        statistics, errors = {}, {}
+        for value, count in counts.items():
+            share = count / sampled if sampled > 0 else 0
+            # an absent class may still be missed by sampling, so its error is at least of one coarse pixel
+            sampling_error = ERROR_Z * self.scale * math.sqrt(max(count, 1) * (1 - share))
+            statistics[value] = round(count * self.scale)
+            errors[value] = round(sampling_error + self.boundary_pixels * share)
+        statistics["total"] = round(sampled * self.scale)
+        errors["total"] = round(self.boundary_pixels)
+        statistics["error"] = errors
+        statistics["overview_factor"] = self.factor
+        return statistics
+
+
+def approximate_zonal_classes(src: rasterio.DatasetReader, geoms: list[BaseGeometry],
+                              derive: Callable[[np.ndarray], np.ndarray] = None,
+                              max_pixels: int = MIN_APPROXIMATE_PIXELS, band: int = 1) -> ApproximateClasses:
+    """
+    count classes inside geometry at a coarse resolution of about max_pixels pixels,
+    gdal reads the overview closest to it, so few pixels are read however large the geometry is.
+
+    Args:
+        src: dataset in the crs of geoms, its grids should have overviews
+        max_pixels: pixels of the region bounding box at coarse resolution
+    """
+    if isinstance(max_pixels, bool) or not isinstance(max_pixels, numbers.Integral) or max_pixels < 1:
+        raise ValueError(f"max_pixels should be a positive integer, but got {max_pixels!r}.")
+    geometry = unary_union(geoms)
+    region = windows.from_bounds(*geometry.bounds, transform=src.transform).round_offsets().round_lengths()
+    full = windows.Window(0, 0, src.width, src.height)
+    # geometry outside src has no pixels
+    if not windows.intersect(region, full):
+        return ApproximateClasses(ClassCounter(), 1, 1, 0)
+    region = region.intersection(full)
+    factor = 1
+    while region.width * region.height / (factor * factor) > max_pixels:
+        factor *= 2
+    out_shape = (max(1, math.ceil(region.height / factor)), max(1, math.ceil(region.width / factor)))
+
+    image = src.read(band, window=region, out_shape=out_shape, masked=True, resampling=Resampling.nearest)
+    x_scale, y_scale = region.width / out_shape[1], region.height / out_shape[0]
+    transform = src.window_transform(region) * Affine.scale(x_scale, y_scale)
+    valid = ~np.ma.getmaskarray(image) & features.geometry_mask(geoms, out_shape=out_shape, transform=transform,
+                                                                invert=True)
+    data = np.ma.getdata(image)
+    counter = ClassCounter()
+    counter.update(data if derive is None else derive(data), valid)
+
+    scale = x_scale * y_scale
+    # coarse pixels along the boundary are half inside geometry on average
+    coarse_size = math.sqrt(abs(transform.a * transform.e))
+    boundary_pixels = 0.5 * scale * geometry.boundary.length / coarse_size if factor > 1 else 0
+    return ApproximateClasses(counter, scale, factor, boundary_pixels)
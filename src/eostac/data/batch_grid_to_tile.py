@@ -1,10 +1,10 @@
-from eostac.data.module import grid_to_tile
+from eostac.data.module import TaskGraph, add_grid_to_tile, find_grid_nodes
 import argparse
 import os
 
 
 def cleanup(path: str):
-    os.system(rf"find {path} -type f -name 'temp.tif' -delete")
+    os.system(rf"find {path} -type f -name '*.temp.tif' -delete")
     os.system(rf"find {path} -type f -name '*.vrt' -delete")
     os.system(rf"find {path} -type f -name '*.png.aux.xml' -delete")
 
@@ -16,12 +16,18 @@ def parse_args():
     parser.add_argument('-o2', "--thumbnail_folder", help='destination Folder', type=str, required=True)
     parser.add_argument('-o3', '--tile_folder', help='destination Folder', type=str, required=True)
     parser.add_argument('-z', '--zoom', help='zoom levels', type=str, default="0-2")
+    parser.add_argument('-e', '--executor', help='serial, thread or process', type=str, default="serial")
+    parser.add_argument('-w', '--max_workers', help='worker count, default is cpu count', type=int, default=None)
+    parser.add_argument('--cog', help='write output as cloud optimized geotiff', action="store_true")
+    parser.add_argument('-t', '--tile_format', help='folder, mbtiles or pmtiles', type=str, default="folder")
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
 
+    # all products and years share one graph, so stages of different years overlap
+    graph = TaskGraph(executor=args.executor, max_workers=args.max_workers)
     for production_name in os.listdir(args.grid_folder):
         production_path = os.path.join(args.grid_folder, production_name)
         color_file_path = os.path.join(production_path, "colorramp.txt")
@@ -34,11 +40,12 @@ def main():
             thumbnail_folder = os.path.join(args.thumbnail_folder, production_name, year)
             tile_folder = os.path.join(args.tile_folder, production_name, year)
 
-            print(f"{production_name} {year} data start:")
-            grid_to_tile(grid_folder=grid_folder, color_folder=color_folder, color_file_path=color_file_path,
-                         thumbnail_folder=thumbnail_folder, tile_folder=tile_folder, zoom=args.zoom)
-
-            print(f"{production_name} {year} data end:")
+            print(f"{production_name} {year} data added.")
+            add_grid_to_tile(graph, grid_nodes=find_grid_nodes(grid_folder), color_folder=color_folder,
+                             color_file_path=color_file_path, thumbnail_folder=thumbnail_folder,
+                             tile_folder=tile_folder, zoom=args.zoom,
+                             driver_name="COG" if args.cog else "GTiff", tile_format=args.tile_format)
+    graph.run()
 
     cleanup(args.grid_folder)
     cleanup(args.color_folder)
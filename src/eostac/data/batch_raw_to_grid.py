@@ -1,4 +1,4 @@
-from eostac.data.module.xyz import raw_to_grid
+from eostac.data.module import TaskGraph, add_raw_to_grid
 import argparse
 import os
 
@@ -11,12 +11,17 @@ def parse_args():
     parser.add_argument('-g', "--grid_shp_path", help="wgs84 grids", type=str, required=True)
     parser.add_argument('-f', "--name_format", help="grid name format with four place holder", type=str,
                         required=True, default="aircas_{}_yearly_{}_{}_{}")
+    parser.add_argument('-e', '--executor', help='serial, thread or process', type=str, default="serial")
+    parser.add_argument('-w', '--max_workers', help='worker count, default is cpu count', type=int, default=None)
+    parser.add_argument('--cog', help='write output as cloud optimized geotiff', action="store_true")
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
 
+    # all products and years share one graph, so stages of different years overlap
+    graph = TaskGraph(executor=args.executor, max_workers=args.max_workers)
     for production_name in os.listdir(args.raw_folder):
         production_path = os.path.join(args.raw_folder, production_name)
         for year in os.listdir(production_path):
@@ -26,11 +31,11 @@ def main():
             wgs84_folder = os.path.join(args.wgs84_folder, production_name, year)
             grid_folder = os.path.join(args.grid_folder, production_name, year)
             name_format = args.name_format.format(production_name, "{}", "{}", year)
-            print(f"{production_name} {year} data start:")
-            raw_to_grid(raw_folder=raw_folder, wgs84_folder=wgs84_folder, grid_folder=grid_folder,
-                        grid_shp_path=args.grid_shp_path, name_format=name_format)
-
-            print(f"{production_name} {year} data end:")
+            print(f"{production_name} {year} data added.")
+            add_raw_to_grid(graph, raw_folder=raw_folder, wgs84_folder=wgs84_folder, grid_folder=grid_folder,
+                            grid_shp_path=args.grid_shp_path, name_format=name_format,
+                            driver_name="COG" if args.cog else "GTiff")
+    graph.run()
 
 
 if __name__ == "__main__":
@@ -1,2 +1,12 @@
+from .calc_engine import *
+from .executor import *
+from .grid_index import *
+from .histogram import *
+from .manifest import *
 from .task import *
+from .pipeline import *
+from .presence import *
+from .publish import *
+from .spatial_index import *
+from .tile_store import *
 from .xyz import *
@@ -0,0 +1,216 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import dataclasses
+import functools
+import math
+import string
+import types
+
+import numpy as np
+from osgeo import gdal
+
+# names of inputs in expression, the same with gdal_calc
+INPUT_NAMES = string.ascii_uppercase
+# numpy functions can be used in expression like gdal_calc
+CALC_NAMESPACE = {name: getattr(np, name) for name in dir(np) if not name.startswith("_")}
+CALC_NAMESPACE.update({"np": np, "numpy": np})
+# tolerance of pixel alignment between inputs, in pixels
+ALIGN_TOLERANCE = 1e-6
+# numpy types of gdal data types
+GDAL_TYPES = {"Byte": np.uint8, "Int8": np.int8, "UInt16": np.uint16, "Int16": np.int16, "UInt32": np.uint32,
+              "Int32": np.int32, "UInt64": np.uint64, "Int64": np.int64, "Float32": np.float32,
+              "Float64": np.float64}
+
+
+@dataclasses.dataclass
+class CalcOutput:
+    calc: str
+    dest_folder: str
+    output_type: str = "Byte"
+    # index of src bound to A, B, C ..., None means all src in order
+    inputs: tuple[int, ...] = None
+
+    def get_inputs(self, src_count: int) -> tuple[int, ...]:
+        return tuple(range(src_count)) if self.inputs is None else tuple(self.inputs)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_calc(calc: str) -> types.CodeType:
+    """
+    expression is compiled once in each process, code objects can not be pickled to workers.
+    """
+    return compile(calc, f"<calc {calc}>", "eval")
+
+
+def get_block_windows(x_size: int, y_size: int, block_x_size: int, block_y_size: int = None):
+    block_y_size = block_x_size if block_y_size is None else block_y_size
+    for y_off in range(0, y_size, block_y_size):
+        for x_off in range(0, x_size, block_x_size):
+            yield x_off, y_off, min(block_x_size, x_size - x_off), min(block_y_size, y_size - y_off)
+
+
+def get_window_size(band: gdal.Band, block_size: int) -> tuple[int, int]:
+    """
+    a window of whole natural blocks with about block_size x block_size pixels, so no block is read twice.
+    """
+    natural_x_size, natural_y_size = band.GetBlockSize()
+    x_size = natural_x_size * max(1, block_size // natural_x_size)
+    y_size = natural_y_size * max(1, block_size * block_size // (x_size * natural_y_size))
+    return x_size, y_size
+
+
+class CalcInput:
+    """
+    An input of calc, it reads windows in the pixel grid of outputs into reused buffers.
+    the input should have the same resolution with outputs and be aligned with them, but its extent may differ.
+    """
+
+    def __init__(self, path: str, geo_transform: tuple, x_size: int, y_size: int, hide_nodata: bool):
+        self.path = path
+        self.ds = gdal.Open(path)
+        if self.ds is None:
+            raise ValueError(f"Can not open {path}.")
+        self.band = self.ds.GetRasterBand(1)
+        self.nodata = None if hide_nodata else self.band.GetNoDataValue()
+        # pixels out of input are filled with its nodata, and they are always masked
+        fill_nodata = self.band.GetNoDataValue()
+        self.fill_value = 0 if fill_nodata is None or math.isnan(fill_nodata) else fill_nodata
+
+        src_geo_transform = self.ds.GetGeoTransform()
+        if not np.allclose(src_geo_transform[1:3] + src_geo_transform[4:6], geo_transform[1:3] + geo_transform[4:6]):
+            raise ValueError(f"{path} should have the same resolution with the first input.")
+        x_off = (src_geo_transform[0] - geo_transform[0]) / geo_transform[1]
+        y_off = (src_geo_transform[3] - geo_transform[3]) / geo_transform[5]
+        if abs(x_off - round(x_off)) > ALIGN_TOLERANCE or abs(y_off - round(y_off)) > ALIGN_TOLERANCE:
+            raise ValueError(f"{path} should be aligned with the pixels of the first input.")
+        # position of input in the pixel grid of outputs
+        self.x_off, self.y_off = round(x_off), round(y_off)
+        self.same_grid = (self.x_off, self.y_off, self.ds.RasterXSize, self.ds.RasterYSize) == (0, 0, x_size, y_size)
+        self.buffers = {}
+        self.mask_buffers = {}
+
+    def get_buffer(self, buffers: dict, shape: tuple[int, int], dtype) -> np.ndarray:
+        # only edge windows have other shapes, so there are at most four buffers
+        if shape not in buffers:
+            buffers[shape] = np.empty(shape, dtype=dtype)
+        return buffers[shape]
+
+    def read(self, x_off: int, y_off: int, x_count: int, y_count: int) -> tuple[np.ndarray, np.ndarray | None]:
+        """
+        read a window of output grid, returns data and nodata mask, None mask means no pixel is masked.
+        """
+        if self.same_grid:
+            if (y_count, x_count) in self.buffers:
+                data = self.band.ReadAsArray(x_off, y_off, x_count, y_count, buf_obj=self.buffers[(y_count, x_count)])
+            else:
+                data = self.buffers[(y_count, x_count)] = self.band.ReadAsArray(x_off, y_off, x_count, y_count)
+            outside = None
+        else:
+            data, outside = self.read_partial(x_off, y_off, x_count, y_count)
+
+        mask = outside
+        if self.nodata is not None:
+            nodata_mask = self.get_buffer(self.mask_buffers, data.shape, bool)
+            if math.isnan(self.nodata):
+                np.isnan(data, out=nodata_mask)
+            else:
+                np.equal(data, self.nodata, out=nodata_mask)
+            mask = nodata_mask if mask is None else np.logical_or(mask, nodata_mask, out=nodata_mask)
+        return data, mask
+
+    def read_partial(self, x_off: int, y_off: int, x_count: int, y_count: int) -> tuple[np.ndarray, np.ndarray]:
+        src_x_min = max(x_off - self.x_off, 0)
+        src_y_min = max(y_off - self.y_off, 0)
+        src_x_max = min(x_off + x_count - self.x_off, self.ds.RasterXSize)
+        src_y_max = min(y_off + y_count - self.y_off, self.ds.RasterYSize)
+        dtype = gdal.GetDataTypeName(self.band.DataType)
+        data = self.get_buffer(self.buffers, (y_count, x_count), np.dtype(GDAL_TYPES.get(dtype, np.float64)))
+        data.fill(self.fill_value)
+        outside = np.ones((y_count, x_count), dtype=bool)
+        if src_x_min < src_x_max and src_y_min < src_y_max:
+            row = src_y_min + self.y_off - y_off
+            col = src_x_min + self.x_off - x_off
+            rows, cols = src_y_max - src_y_min, src_x_max - src_x_min
+            data[row:row + rows, col:col + cols] = self.band.ReadAsArray(src_x_min, src_y_min, cols, rows)
+            outside[row:row + rows, col:col + cols] = False
+        return data, outside
+
+
+def apply_nodata(result: np.ndarray, mask: np.ndarray, nodata: float, inputs: list[np.ndarray]) -> np.ndarray:
+    """
+    set nodata where mask is True, in place when result is a new array which can hold nodata.
+    """
+    if not mask.any():
+        return result
+    in_place = (result.flags.writeable and np.can_cast(np.min_scalar_type(nodata), result.dtype)
+                and not any(np.may_share_memory(result, data) for data in inputs))
+    if in_place:
+        np.copyto(result, nodata, where=mask)
+        return result
+    return np.where(mask, nodata, result)
+
+
+def run_calc(src_paths: list[str], outputs: list[CalcOutput], dest_paths: list[str], driver_name: str = "GTiff",
+             create_options: list[str] = (), hide_nodata: bool = True, nodata: float = 0,
+             block_size: int = 512) -> bool:
+    """
+    evaluate several expressions window by window, each src used by any output is read once per window.
+    outputs have the grid of the first used src, other src should have the same resolution and be aligned with it,
+    windows are shared by all src when their grids are the same.
+
+    Args:
+        src_paths: input files, None for missing inputs which no output uses
+        outputs: expressions and the src they use
+        dest_paths: output file of each expression
+        hide_nodata: ignore nodata of inputs, otherwise pixels with nodata in any input of an output are nodata
+        nodata: nodata of outputs, None means outputs have no nodata
+    """
+    used = sorted({i for output in outputs for i in output.get_inputs(len(src_paths))})
+    first_ds = gdal.Open(src_paths[used[0]])
+    if first_ds is None:
+        return False
+    geo_transform = first_ds.GetGeoTransform()
+    x_size, y_size = first_ds.RasterXSize, first_ds.RasterYSize
+    calc_inputs = {i: CalcInput(src_paths[i], geo_transform, x_size, y_size, hide_nodata) for i in used}
+
+    driver = gdal.GetDriverByName(driver_name)
+    codes = [compile_calc(output.calc) for output in outputs]
+    dest_bands = []
+    for output, dest_path in zip(outputs, dest_paths):
+        dest_ds = driver.Create(dest_path, x_size, y_size, 1, gdal.GetDataTypeByName(output.output_type),
+                                options=list(create_options))
+        if dest_ds is None:
+            return False
+        dest_ds.SetGeoTransform(geo_transform)
+        dest_ds.SetProjection(first_ds.GetProjection())
+        if nodata is not None:
+            dest_ds.GetRasterBand(1).SetNoDataValue(nodata)
+        dest_bands.append((dest_ds, dest_ds.GetRasterBand(1)))
+
+    window_x_size, window_y_size = get_window_size(calc_inputs[used[0]].band, block_size)
+    for x_off, y_off, x_count, y_count in get_block_windows(x_size, y_size, window_x_size, window_y_size):
+        blocks = {i: calc_input.read(x_off, y_off, x_count, y_count) for i, calc_input in calc_inputs.items()}
+        # outputs of the same inputs share one mask
+        output_masks = {}
+
+        for output, code, (_, dest_band) in zip(outputs, codes, dest_bands):
+            inputs = output.get_inputs(len(src_paths))
+            arrays = [blocks[i][0] for i in inputs]
+            result = eval(code, CALC_NAMESPACE, dict(zip(INPUT_NAMES, arrays)))
+            if np.ndim(result) == 0:
+                result = np.full((y_count, x_count), result)
+
+            if nodata is not None:
+                if inputs not in output_masks:
+                    masks = [blocks[i][1] for i in inputs if blocks[i][1] is not None]
+                    output_masks[inputs] = np.logical_or.reduce(masks) if len(masks) > 0 else None
+                if output_masks[inputs] is not None:
+                    result = apply_nodata(result, output_masks[inputs], nodata, arrays)
+            dest_band.WriteArray(result, x_off, y_off)
+
+    for dest_ds, _ in dest_bands:
+        dest_ds.FlushCache()
+    return True
@@ -0,0 +1,45 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import concurrent.futures
+import os
+
+EXECUTOR_NAMES = ("serial", "thread", "process")
+
+
+class SerialExecutor(concurrent.futures.Executor):
+    """
+    run every submitted function immediately in the calling thread.
+    it has the same interface as the pool executors, so callers do not need a special case.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def get_max_workers(max_workers: int = None) -> int:
+    if max_workers is None or max_workers <= 0:
+        return os.cpu_count() or 1
+    return max_workers
+
+
+def get_executor(executor_name: str = "serial", max_workers: int = None) -> concurrent.futures.Executor:
+    """
+    Args:
+        executor_name: one of "serial", "thread" and "process"
+        max_workers: worker count of pool executors, None or non-positive means cpu count
+    """
+    if executor_name == "serial":
+        return SerialExecutor()
+    if executor_name == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=get_max_workers(max_workers))
+    if executor_name == "process":
+        return concurrent.futures.ProcessPoolExecutor(max_workers=get_max_workers(max_workers))
+    raise ValueError(f"executor name should be one of {EXECUTOR_NAMES}, but got {executor_name}.")
@@ -0,0 +1,105 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# at most so many mismatched grids are listed in log
+MAX_REPORTED_MISMATCHES = 20
+
+
+def get_grid_prefix(path: str) -> str:
+    """
+    grids of different folders are matched by the name prefix before the last "_".
+    """
+    return os.path.basename(path).rsplit("_", 1)[0]
+
+
+def scan_grids(folder: str, suffix: str = "tif") -> dict[str, str]:
+    """
+    prefix to path of grids in folder with one directory listing, hidden files are ignored like glob.
+    """
+    files = {}
+    if not os.path.isdir(folder):
+        logger.warning(f"Src folder {folder} does not exist.")
+        return files
+    with os.scandir(folder) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.name.startswith(".") or not entry.name.endswith(f".{suffix}") or not entry.is_file():
+                continue
+            prefix = get_grid_prefix(entry.name)
+            if prefix in files:
+                logger.warning(f"Grid {prefix} has several files in {folder}, {entry.path} is used.")
+            files[prefix] = entry.path
+    return files
+
+
+class GridIndex:
+    """
+    Index of grids in several folders, each folder is scanned once however many grids and stages use it.
+    """
+
+    def __init__(self, folders: list[str], suffix: str = "tif", files: list[dict[str, str]] = None):
+        """
+        Args:
+            folders: src folders, like the folder of each year
+            suffix: suffix of grid files
+            files: prefix to path of each folder, the folders are scanned when it is None
+        """
+        self.folders = list(folders)
+        self.suffix = suffix
+        self.files = [scan_grids(folder, suffix) for folder in self.folders] if files is None else files
+
+    def select(self, folders: list[str]) -> "GridIndex":
+        """
+        index of some folders without scanning them again, folders not in index are scanned.
+        """
+        positions = {os.path.normpath(folder): i for i, folder in enumerate(self.folders)}
+        files = []
+        for folder in folders:
+            i = positions.get(os.path.normpath(folder))
+            files.append(scan_grids(folder, self.suffix) if i is None else self.files[i])
+        return GridIndex(folders, self.suffix, files)
+
+    @property
+    def prefixes(self) -> list[str]:
+        return sorted(set().union(*self.files))
+
+    def get_paths(self, prefix: str) -> list[str | None]:
+        """
+        grid of prefix in each folder, None when it is missing in the folder.
+        """
+        return [files.get(prefix) for files in self.files]
+
+    def get_folder_paths(self, folder: str) -> list[str]:
+        return [path for _, path in sorted(self.select([folder]).files[0].items())]
+
+    def get_mismatches(self) -> dict[str, list[str]]:
+        """
+        grids missing in some folders, prefix to the folders missing it.
+        """
+        mismatches = {}
+        for prefix in self.prefixes:
+            missing = [folder for folder, files in zip(self.folders, self.files) if prefix not in files]
+            if len(missing) > 0:
+                mismatches[prefix] = missing
+        return mismatches
+
+    def report_mismatches(self, name: str = "") -> dict[str, list[str]]:
+        """
+        log grids missing in some folders before any work starts.
+        """
+        mismatches = self.get_mismatches()
+        if len(mismatches) == 0:
+            return mismatches
+        of_name = f" of {name}" if name else ""
+        logger.warning(f"{len(mismatches)} of {len(self.prefixes)} grids{of_name} are missing in some src folders.")
+        for prefix, missing in list(mismatches.items())[:MAX_REPORTED_MISMATCHES]:
+            logger.warning(f"Grid {prefix} is missing in {missing}.")
+        if len(mismatches) > MAX_REPORTED_MISMATCHES:
+            logger.warning(f"And {len(mismatches) - MAX_REPORTED_MISMATCHES} more mismatched grids.")
+        return mismatches
@@ -0,0 +1,71 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal
+
+from .calc_engine import get_block_windows
+
+logger = logging.getLogger(__name__)
+
+# histograms are stored next to api.vrt
+HISTOGRAM_FILENAME = "histogram.npz"
+HISTOGRAM_BLOCK_SIZE = 256
+# blocks along each side of a window read at once, windows are block aligned in both dimensions,
+# so memory does not grow with the width of vrt
+HISTOGRAM_WINDOW_BLOCKS = 4
+
+
+def get_histogram_path(vrt_path: str) -> str:
+    return os.path.join(os.path.dirname(vrt_path), HISTOGRAM_FILENAME)
+
+
+def build_histogram(vrt_path: str, dest_path: str = None, block_size: int = HISTOGRAM_BLOCK_SIZE) -> str:
+    """
+    class histogram of every block of vrt, blocks with only nodata are not stored.
+    histograms are stored as columns in a npz file, "row" and "col" of blocks, "classes" which appear,
+    and "counts" of each class in each block, region statistics sum the blocks inside region.
+
+    Args:
+        vrt_path: api.vrt of a product year
+        dest_path: histogram file, next to vrt by default
+        block_size: pixels of block side in the grid of vrt
+    """
+    dest_path = get_histogram_path(vrt_path) if dest_path is None else dest_path
+    ds = gdal.Open(vrt_path)
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+
+    rows, cols, block_histograms = [], [], []
+    window_size = block_size * HISTOGRAM_WINDOW_BLOCKS
+    for window_x, window_y, window_width, window_height in get_block_windows(ds.RasterXSize, ds.RasterYSize,
+                                                                             window_size):
+        window = band.ReadAsArray(window_x, window_y, window_width, window_height)
+        for x_off, y_off, x_count, y_count in get_block_windows(window_width, window_height, block_size):
+            data = window[y_off:y_off + y_count, x_off:x_off + x_count]
+            if nodata is not None:
+                data = data[~np.isnan(data)] if np.isnan(nodata) else data[data != nodata]
+            if data.size == 0:
+                continue
+            rows.append((window_y + y_off) // block_size)
+            cols.append((window_x + x_off) // block_size)
+            block_histograms.append(np.unique(data, return_counts=True))
+
+    classes = np.unique(np.concatenate([values for values, _ in block_histograms])) \
+        if len(block_histograms) > 0 else np.zeros(0, dtype=np.int64)
+    counts = np.zeros((len(block_histograms), len(classes)), dtype=np.uint32)
+    for i, (values, value_counts) in enumerate(block_histograms):
+        counts[i, np.searchsorted(classes, values)] = value_counts
+
+    with open(dest_path, "wb") as f:
+        np.savez_compressed(f, row=np.array(rows, dtype=np.uint32), col=np.array(cols, dtype=np.uint32),
+                            classes=classes, counts=counts, block_size=np.array(block_size),
+                            shape=np.array([ds.RasterYSize, ds.RasterXSize]),
+                            geo_transform=np.array(ds.GetGeoTransform()))
+    logger.info(f"Histogram of {len(rows)} blocks and {len(classes)} classes is written to {dest_path}.")
+    return dest_path
@@ -0,0 +1,174 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+
+MANIFEST_FILENAME = ".manifest.json"
+# manifests of stages sharing a folder are merged on saving, threads save one at a time
+MANIFEST_LOCK = threading.Lock()
+
+
+def get_params_digest(params) -> str:
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_file_hash(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def expand_vrt_sources(paths: list[str]) -> list[str]:
+    """
+    replace vrt files with the files they reference, so a temporary vrt with random name is fingerprinted by its sources.
+    the vrt is parsed as xml and never opened by gdal. paths are normalized, so a file is the same in and out of vrt.
+    """
+    expanded = []
+    for path in paths:
+        if not path.lower().endswith(".vrt") or not os.path.isfile(path):
+            expanded.append(os.path.normpath(path))
+            continue
+        vrt_folder = os.path.dirname(path)
+        sources = []
+        for element in ET.parse(path).getroot().iter("SourceFilename"):
+            source = element.text
+            if element.get("relativeToVRT") == "1":
+                source = os.path.join(vrt_folder, source)
+            sources.append(os.path.normpath(source))
+        expanded.extend(expand_vrt_sources(list(dict.fromkeys(sources))))
+    return expanded
+
+
+class Manifest:
+    """
+    Records of finished tasks in one destination folder.
+    each record keeps the fingerprints of inputs, the digest of stage parameters and the fingerprints of outputs,
+    a task is up-to-date only when all of them are unchanged.
+    a crashed task has no record, so its truncated outputs are rebuilt.
+    """
+
+    def __init__(self, folder: str, hash_inputs: bool = False):
+        """
+        Args:
+            folder: destination folder of stage
+            hash_inputs: also compare sha256 of inputs, so touched but unchanged inputs are not rebuilt
+        """
+        self.path = os.path.join(folder, MANIFEST_FILENAME)
+        self.hash_inputs = hash_inputs
+        self.records = self.load()
+
+    def load(self) -> dict:
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def get_key(dest_in_task: list[str]) -> str:
+        return "|".join(os.path.basename(os.path.normpath(path)) for path in dest_in_task)
+
+    def has_record(self, dest_in_task: list[str]) -> bool:
+        return self.get_key(dest_in_task) in self.records
+
+    def get_record(self, dest_in_task: list[str]) -> dict | None:
+        return self.records.get(self.get_key(dest_in_task))
+
+    def get_input_fingerprint(self, path: str) -> dict:
+        stat = os.stat(path)
+        fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        if self.hash_inputs:
+            fingerprint["sha256"] = get_file_hash(path)
+        return fingerprint
+
+    @staticmethod
+    def get_output_fingerprint(path: str) -> dict:
+        # tiles folder changes all the time, only its existence is recorded
+        if os.path.isdir(path):
+            return {"folder": True}
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def is_input_changed(self, path: str, fingerprint: dict) -> bool:
+        if not os.path.isfile(path):
+            return True
+        stat = os.stat(path)
+        if stat.st_size != fingerprint["size"]:
+            return True
+        if stat.st_mtime_ns == fingerprint["mtime"]:
+            return False
+        return not (self.hash_inputs and fingerprint.get("sha256") == get_file_hash(path))
+
+    def is_up_to_date(self, src_in_task: list[str], dest_in_task: list[str], params) -> bool:
+        record = self.records.get(self.get_key(dest_in_task))
+        if record is None or record["params"] != get_params_digest(params):
+            return False
+
+        inputs = expand_vrt_sources(src_in_task)
+        if sorted(inputs) != sorted(record["inputs"]):
+            return False
+        for path in inputs:
+            if self.is_input_changed(path, record["inputs"][path]):
+                return False
+
+        for path in dest_in_task:
+            if not os.path.exists(path) or self.get_output_fingerprint(path) != record["outputs"].get(path):
+                return False
+        return True
+
+    def get_changed_inputs(self, src_in_task: list[str], dest_in_task: list[str], params) -> list[str] | None:
+        """
+        inputs added, changed or removed since the task was recorded.
+        None means the task should be built entirely, because it has no record or its parameters changed.
+        """
+        record = self.get_record(dest_in_task)
+        if record is None or record["params"] != get_params_digest(params):
+            return None
+
+        inputs = expand_vrt_sources(src_in_task)
+        changed = [path for path in inputs
+                   if path not in record["inputs"] or self.is_input_changed(path, record["inputs"][path])]
+        input_set = set(inputs)
+        changed.extend(path for path in record["inputs"] if path not in input_set)
+        return changed
+
+    def record(self, src_in_task: list[str], dest_in_task: list[str], params, **extra):
+        """
+        record a finished task and save it at once.
+
+        Args:
+            extra: other json values saved in the record, like the footprints of inputs
+        """
+        inputs = expand_vrt_sources(src_in_task)
+        record = {
+            "inputs": {path: self.get_input_fingerprint(path) for path in inputs if os.path.isfile(path)},
+            "params": get_params_digest(params),
+            "outputs": {path: self.get_output_fingerprint(path) for path in dest_in_task if os.path.exists(path)},
+            **extra,
+        }
+        key = self.get_key(dest_in_task)
+        self.records[key] = record
+        self.save(key)
+
+    def save(self, key: str):
+        # several stages may share one folder, so merge with the saved file instead of overwriting it
+        with MANIFEST_LOCK:
+            records = self.load()
+            records[key] = self.records[key]
+            # the temp file is unique for every save, not only for every process
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path), prefix=f"{MANIFEST_FILENAME}.",
+                                             suffix=".tmp", delete=False) as f:
+                json.dump(records, f)
+            os.replace(f.name, self.path)
@@ -0,0 +1,164 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import concurrent.futures
+import dataclasses
+import logging
+import functools
+import os
+from typing import Callable
+
+from osgeo import gdal
+
+from .executor import get_executor
+from .task import RasterImageProcess, time_it
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Node:
+    name: str
+    func: Callable[..., bool]
+    args: tuple
+    deps: list[str]
+    # called before submitting, the node is done without running when it returns True
+    skip: Callable[[], bool] = None
+    # called after the node succeeds
+    on_success: Callable[[], None] = None
+
+
+class TaskGraph:
+    """
+    Schedule functions by their dependencies.
+    a node is submitted to executor as soon as all of its dependencies succeed,
+    so different stages of different grids run at the same time.
+    when a node fails, all nodes depend on it are skipped.
+    """
+
+    def __init__(self, executor: str = "serial", max_workers: int = None):
+        self.executor = executor
+        self.max_workers = max_workers
+        self.nodes: dict[str, Node] = {}
+
+    def add(self, name: str, func: Callable[..., bool], *args, deps: list[str] = (),
+            skip: Callable[[], bool] = None, on_success: Callable[[], None] = None) -> str:
+        """
+        Args:
+            name: unique node name
+            func: picklable function returns bool, it runs in the worker of executor
+            args: arguments of func
+            deps: names of nodes added before, None in it is ignored
+            skip: called in the scheduling process when the node is ready
+            on_success: called in the scheduling process when the node succeeds
+        """
+        if name in self.nodes:
+            raise ValueError(f"Node {name} already exists.")
+        deps = list(dict.fromkeys(dep for dep in deps if dep is not None))
+        for dep in deps:
+            if dep not in self.nodes:
+                raise ValueError(f"Dependency {dep} of node {name} should be added before it.")
+        self.nodes[name] = Node(name, func, args, deps, skip, on_success)
+        return name
+
+    @time_it
+    def run(self) -> bool:
+        all_success = True
+        waiting = {name: len(node.deps) for name, node in self.nodes.items()}
+        children = {name: [] for name in self.nodes}
+        for name, node in self.nodes.items():
+            for dep in node.deps:
+                children[dep].append(name)
+
+        with get_executor(self.executor, self.max_workers) as executor:
+            running = {}
+
+            # waiting only keeps nodes not submitted yet
+            def submit_ready(names):
+                for ready_name in names:
+                    if waiting.get(ready_name) != 0:
+                        continue
+                    waiting.pop(ready_name)
+                    ready_node = self.nodes[ready_name]
+                    if ready_node.skip is not None and ready_node.skip():
+                        finish(ready_name)
+                        continue
+                    running[executor.submit(ready_node.func, *ready_node.args)] = ready_name
+
+            def finish(finished_name):
+                for child in children[finished_name]:
+                    if child in waiting:
+                        waiting[child] -= 1
+                submit_ready(children[finished_name])
+
+            def skip_descendants(failed_name):
+                stack = list(children[failed_name])
+                while stack:
+                    skipped = stack.pop()
+                    if waiting.pop(skipped, None) is None:
+                        continue
+                    logger.info(f"Skip node {skipped} because node {failed_name} failed.")
+                    stack.extend(children[skipped])
+
+            submit_ready(list(waiting))
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        success = future.result() is not False
+                    except Exception:
+                        logger.exception(f"Node {name} raised an exception.")
+                        success = False
+
+                    if not success:
+                        all_success = False
+                        logger.info(f"Node {name} failed.")
+                        skip_descendants(name)
+                        continue
+
+                    if self.nodes[name].on_success is not None:
+                        self.nodes[name].on_success()
+                    finish(name)
+
+        return all_success
+
+
+def run_stage_task_on_vrt(stage: RasterImageProcess, src_paths: list[str], vrt_path: str,
+                          dest_in_task: list[str], task_args: dict) -> bool:
+    """
+    build a vrt of src paths which are produced by upstream nodes, and use it as the source of task.
+    """
+    src_paths = [path for path in src_paths if os.path.isfile(path)]
+    if len(src_paths) == 0:
+        return False
+    gdal.BuildVRT(vrt_path, src_paths)
+    try:
+        return stage.run_task([vrt_path], dest_in_task, task_args)
+    finally:
+        if os.path.isfile(vrt_path):
+            os.remove(vrt_path)
+
+
+def add_stage_task(graph: TaskGraph, stage: RasterImageProcess, src_in_task: list[str], dest_in_task: list[str],
+                   task_args: dict, deps: list[str] = (), vrt_path: str = None) -> str:
+    """
+    add one task of stage into graph, the destination paths are the node name.
+    up-to-date tasks are skipped and finished tasks are recorded like RasterImageProcess.__call__ does.
+
+    Args:
+        vrt_path: if it is not None, src files are put into this vrt before the task runs
+    """
+    name = f"{stage.__class__.__name__}:{'|'.join(dest_in_task)}"
+
+    def skip():
+        return len(stage.get_pending_dest_paths(src_in_task, dest_in_task, task_args)) == 0
+
+    on_success = functools.partial(stage.record_task, src_in_task, dest_in_task, task_args)
+    if vrt_path is None:
+        return graph.add(name, stage.run_task, src_in_task, dest_in_task, task_args,
+                         deps=deps, skip=skip, on_success=on_success)
+    return graph.add(name, run_stage_task_on_vrt, stage, src_in_task, vrt_path, dest_in_task, task_args,
+                     deps=deps, skip=skip, on_success=on_success)
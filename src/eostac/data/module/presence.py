@@ -0,0 +1,74 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import dataclasses
+
+import numpy as np
+
+# metadata of presence cube, years of bits from bit 0, and years whose grids are merged into the cube
+PRESENCE_YEARS_KEY = "PRESENCE_YEARS"
+PRESENCE_MERGED_KEY = "PRESENCE_MERGED_YEARS"
+PRESENCE_OPERATIONS = ("distribution", "change", "statistics")
+# count of set bits of every byte
+POPCOUNT_LUT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+PRESENCE_TYPES = {"Byte": np.uint8, "UInt16": np.uint16, "UInt32": np.uint32}
+
+
+def get_presence_type(year_count: int) -> str:
+    """
+    the smallest gdal data type with a bit for every year, the highest bit is left for nodata.
+    """
+    for type_name, dtype in PRESENCE_TYPES.items():
+        if year_count < np.iinfo(dtype).bits:
+            return type_name
+    raise ValueError(f"A presence cube holds at most 31 years, but got {year_count}.")
+
+
+def get_presence_nodata(type_name: str) -> int:
+    """
+    nodata of presence cube where every merged year is nodata, all bits are set, so it is never a presence.
+    """
+    return int(np.iinfo(PRESENCE_TYPES[type_name]).max)
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    values = np.ascontiguousarray(values)
+    counts = POPCOUNT_LUT[values.view(np.uint8)].reshape(*values.shape, values.itemsize)
+    return counts.sum(axis=-1, dtype=np.uint8)
+
+
+def derive_presence(cube: np.ndarray, bits: list[int], operation: str) -> np.ndarray:
+    """
+    derive a water distribution product from presence cube with bit operations.
+
+    Args:
+        cube: presence cube, bit i is the water presence of year i
+        bits: bits of selected years in order
+        operation: "distribution" of one year, "change" of two years like A+2*B,
+            or "statistics" of several years like A+B+C
+    """
+    if operation == "distribution":
+        return ((cube >> bits[0]) & 1).astype(np.uint8)
+    if operation == "change":
+        return (((cube >> bits[0]) & 1) + 2 * ((cube >> bits[1]) & 1)).astype(np.uint8)
+    if operation == "statistics":
+        mask = sum(1 << bit for bit in bits)
+        return popcount(cube & np.array(mask, dtype=cube.dtype))
+    raise ValueError(f"operation should be one of {PRESENCE_OPERATIONS}, but got {operation}.")
+
+
+@dataclasses.dataclass
+class PresenceProduct:
+    """
+    a water distribution product of selected years, it is derived from presence cube on demand.
+    """
+    operation: str
+    years: tuple[str, ...]
+
+    def derive(self, cube: np.ndarray, cube_years: list[str]) -> np.ndarray:
+        missing = [year for year in self.years if year not in cube_years]
+        if len(missing) > 0:
+            raise ValueError(f"Years {missing} are not in presence cube of {cube_years}.")
+        return derive_presence(cube, [cube_years.index(year) for year in self.years], self.operation)
@@ -0,0 +1,143 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import logging
+import os
+import shutil
+import xml.etree.ElementTree as ElementTree
+
+from osgeo import gdal
+
+from .manifest import expand_vrt_sources
+from .utils import ensure_overviews
+
+try:
+    import fcntl
+except ImportError:
+    # reflink is only supported on linux
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# ioctl of linux to share the extents of a file, supported by btrfs, xfs and some others
+FICLONE = 0x40049409
+# link tries hardlink, reflink and copy in order, vrt publishes no file but a vrt of the original grids
+PUBLISH_MODES = ("link", "vrt", "copy")
+# overviews of api grids, approximate statistics of large regions are read from them
+API_OVERVIEW_LEVELS = [2, 4, 8, 16, 32, 64]
+
+
+def reflink(src_path: str, dest_path: str):
+    """
+    copy on write clone of src, raise OSError when the filesystem does not support it.
+    """
+    if fcntl is None:
+        raise OSError("Reflink is not supported on this platform.")
+    with open(src_path, "rb") as src_file, open(dest_path, "wb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dest_file.close()
+            os.remove(dest_path)
+            raise
+
+
+def publish_file(src_path: str, dest_path: str, mode: str = "link") -> str:
+    """
+    publish src to dest without copying data when possible, returns the way it is published.
+
+    Args:
+        mode: "link" tries hardlink, reflink and copy in order, "copy" always copies
+    """
+    if os.path.lexists(dest_path):
+        if mode == "link" and os.path.exists(dest_path) and os.path.samefile(src_path, dest_path):
+            return "hardlink"
+        # never write through an old link
+        os.remove(dest_path)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+
+    if mode == "link":
+        try:
+            os.link(src_path, dest_path)
+            return "hardlink"
+        except OSError:
+            pass
+        try:
+            reflink(src_path, dest_path)
+            return "reflink"
+        except OSError:
+            pass
+    shutil.copyfile(src_path, dest_path)
+    return "copy"
+
+
+def publish_files(src_paths: list[str], dest_folder: str, mode: str = "link") -> list[str]:
+    """
+    publish files into dest folder with the same names, vrt mode links files as there is no vrt.
+    """
+    if mode not in PUBLISH_MODES:
+        raise ValueError(f"Publish mode should be one of {PUBLISH_MODES}, but got {mode}.")
+    dest_paths = []
+    counts = {}
+    for src_path in src_paths:
+        dest_path = os.path.join(dest_folder, os.path.basename(src_path))
+        way = publish_file(src_path, dest_path, "copy" if mode == "copy" else "link")
+        counts[way] = counts.get(way, 0) + 1
+        dest_paths.append(dest_path)
+    if counts.get("copy", 0) > 0 and mode != "copy":
+        logger.warning(f"{counts['copy']} files are copied into {dest_folder}, as they can not be linked.")
+    return dest_paths
+
+
+def make_vrt_relative(vrt_path: str):
+    """
+    rewrite sources of vrt relative to it, so the vrt and its grids can be moved or uploaded together.
+    """
+    vrt_folder = os.path.dirname(os.path.abspath(vrt_path))
+    tree = ElementTree.parse(vrt_path)
+    for element in tree.iter("SourceFilename"):
+        path = element.text
+        if path.startswith("/vsi"):
+            continue
+        if element.get("relativeToVRT") == "1":
+            path = os.path.join(vrt_folder, path)
+        element.text = os.path.relpath(os.path.abspath(path), vrt_folder)
+        element.set("relativeToVRT", "1")
+    tree.write(vrt_path)
+
+
+def publish_vrt(src_paths: list[str], vrt_path: str, mode: str = "link", metadata: dict = None,
+                overview_levels: list[int] = None) -> str:
+    """
+    publish grids with a vrt over them, it is a metadata operation except the copy mode.
+
+    Args:
+        src_paths: grids to publish
+        vrt_path: the vrt, grids are published into its folder except the vrt mode
+        mode: "link" publishes grids by hardlink or reflink, "vrt" only writes a vrt pointing at the original grids,
+            "copy" copies grids
+        metadata: metadata items of vrt
+        overview_levels: build overviews of published grids without any, they are external .ovr files
+            next to the published grids, so the original grids are not changed except in vrt mode
+    """
+    if mode != "vrt":
+        src_paths = publish_files(src_paths, os.path.dirname(vrt_path), mode)
+    os.makedirs(os.path.dirname(vrt_path), exist_ok=True)
+    vrt_ds = gdal.BuildVRT(vrt_path, src_paths)
+    for key, value in (metadata or {}).items():
+        vrt_ds.SetMetadataItem(key, value)
+    del vrt_ds
+    make_vrt_relative(vrt_path)
+    if overview_levels is not None:
+        build_vrt_overviews(vrt_path, overview_levels)
+    return vrt_path
+
+
+def build_vrt_overviews(vrt_path: str, overview_levels: list[int] = API_OVERVIEW_LEVELS):
+    """
+    build overviews of grids of vrt without any, so reading vrt at a coarse resolution reads few pixels.
+    """
+    built = [ensure_overviews(path, overview_levels) for path in expand_vrt_sources([vrt_path])]
+    logger.info(f"Overviews of {sum(built)} grids of {vrt_path} are built.")
@@ -0,0 +1,67 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import json
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal
+
+from .manifest import expand_vrt_sources
+
+logger = logging.getLogger(__name__)
+
+# spatial index of grids is stored next to api.vrt
+SPATIAL_INDEX_FILENAME = "grids.npz"
+
+
+def get_spatial_index_path(vrt_path: str) -> str:
+    return os.path.join(os.path.dirname(vrt_path), SPATIAL_INDEX_FILENAME)
+
+
+def build_spatial_index(vrt_path: str, dest_path: str = None) -> str:
+    """
+    index of the grids of vrt, so a query opens only the grids intersecting its region without parsing the vrt.
+    columns are "path" relative to the index, "bbox" as (min_x, min_y, max_x, max_y) in the crs of vrt,
+    "geo_transform", "shape" as (height, width), "block_shape" as (height, width) and "nodata" (nan for none) of
+    each grid, and "metadata" of vrt as json.
+
+    Args:
+        vrt_path: api.vrt of a product year
+        dest_path: index file, next to vrt by default
+    """
+    dest_path = get_spatial_index_path(vrt_path) if dest_path is None else dest_path
+    index_folder = os.path.dirname(os.path.abspath(dest_path))
+    paths, bboxes, geo_transforms, shapes, block_shapes, nodatas = [], [], [], [], [], []
+    for path in expand_vrt_sources([vrt_path]):
+        ds = gdal.Open(path)
+        if ds is None:
+            logger.warning(f"Grid {path} of {vrt_path} can not be opened, it is not indexed.")
+            continue
+        band = ds.GetRasterBand(1)
+        geo_transform = ds.GetGeoTransform()
+        x1, y1 = geo_transform[0], geo_transform[3]
+        x2 = x1 + geo_transform[1] * ds.RasterXSize
+        y2 = y1 + geo_transform[5] * ds.RasterYSize
+        nodata = band.GetNoDataValue()
+
+        paths.append(os.path.relpath(os.path.abspath(path), index_folder))
+        bboxes.append((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+        geo_transforms.append(geo_transform)
+        shapes.append((ds.RasterYSize, ds.RasterXSize))
+        block_shapes.append(tuple(reversed(band.GetBlockSize())))
+        nodatas.append(np.nan if nodata is None else nodata)
+
+    vrt_ds = gdal.Open(vrt_path)
+    metadata = vrt_ds.GetMetadata() if vrt_ds is not None else {}
+    with open(dest_path, "wb") as f:
+        np.savez_compressed(f, path=np.array(paths, dtype=str), bbox=np.array(bboxes, dtype=np.float64).reshape(-1, 4),
+                            geo_transform=np.array(geo_transforms, dtype=np.float64).reshape(-1, 6),
+                            shape=np.array(shapes, dtype=np.int64).reshape(-1, 2),
+                            block_shape=np.array(block_shapes, dtype=np.int64).reshape(-1, 2),
+                            nodata=np.array(nodatas, dtype=np.float64), metadata=np.array(json.dumps(metadata)))
+    logger.info(f"Spatial index of {len(paths)} grids is written to {dest_path}.")
+    return dest_path
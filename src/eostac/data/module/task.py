@@ -3,6 +3,7 @@
 # Author: Jia Song
 #
 
+import concurrent.futures
 import dataclasses
 import glob
 import logging
@@ -11,27 +12,59 @@ import shutil
 import time
 import uuid
 
+import numpy as np
 from osgeo import gdal, ogr
-from osgeo_utils import gdal2tiles, gdal_calc
 
-from .utils import get_suffix_by_driver
+from .calc_engine import CalcOutput, get_block_windows, run_calc
+from .executor import get_executor
+from .grid_index import GridIndex
+from .manifest import Manifest, expand_vrt_sources
+from .presence import PRESENCE_MERGED_KEY, PRESENCE_TYPES, PRESENCE_YEARS_KEY, PresenceProduct, \
+    get_presence_nodata, get_presence_type
+from .tile_store import get_tile_store_path
+from .tiles import WEB_VIEWERS, parse_zoom, render_xyz_tiles
+from .utils import ensure_overviews, get_bounds, get_color_lut, get_suffix_by_driver
 
 logger = logging.getLogger(__name__)
 
 SHP_DRIVER = ogr.GetDriverByName("ESRI Shapefile")
-TIF_CREATE_OPTIONS = ["COMPRESS=DEFLATE", "INTERLEAVE=BAND", "BLOCKXSIZE=512", "BLOCKYSIZE=512"]
+BLOCK_SIZE = 512
+TIF_CREATE_OPTIONS = ["COMPRESS=DEFLATE", "INTERLEAVE=BAND", f"BLOCKXSIZE={BLOCK_SIZE}", f"BLOCKYSIZE={BLOCK_SIZE}"]
+# cloud optimized geotiff has internal overviews and puts all ifd at the beginning of file
+COG_CREATE_OPTIONS = ["COMPRESS=DEFLATE", f"BLOCKSIZE={BLOCK_SIZE}", "OVERVIEWS=AUTO", "BIGTIFF=IF_SAFER"]
+COG_PREDICTORS = {1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}
 
 
 def time_it(func):
     def wrapper(*args, **kwargs):
         start = time.time()
-        func(*args, **kwargs)
+        result = func(*args, **kwargs)
         end = time.time()
-        print(f'{func.__class__}:{end - start} seconds')
+        print(f'{func.__qualname__}:{end - start} seconds')
+        return result
 
     return wrapper
 
 
+def get_create_options(driver_name: str, predictor: int = None, compress_level: int = None,
+                       overview_resampling: str = "NEAREST") -> list[str]:
+    if driver_name == "GTiff":
+        create_options = list(TIF_CREATE_OPTIONS)
+        if predictor is not None:
+            create_options.append(f"PREDICTOR={predictor}")
+        if compress_level is not None:
+            create_options.append(f"ZLEVEL={compress_level}")
+        return create_options
+    if driver_name == "COG":
+        create_options = COG_CREATE_OPTIONS + [f"OVERVIEW_RESAMPLING={overview_resampling}"]
+        if predictor is not None:
+            create_options.append(f"PREDICTOR={COG_PREDICTORS[predictor]}")
+        if compress_level is not None:
+            create_options.append(f"LEVEL={compress_level}")
+        return create_options
+    return []
+
+
 @dataclasses.dataclass
 class RasterImageProcessOptions:
     src_path: list[str]
@@ -41,6 +74,18 @@ class RasterImageProcessOptions:
     driver_name: str = "GTiff"
     overwrite: bool = False
     rollback: bool = True
+    # "serial", "thread" or "process"
+    executor: str = "serial"
+    # None means cpu count
+    max_workers: int = None
+    # tiff predictor, 1 is none, 2 is horizontal differencing, 3 is floating point
+    predictor: int = None
+    # deflate level from 1 to 9
+    compress_level: int = None
+    overview_resampling: str = "NEAREST"
+    # skip up-to-date tasks by the manifest in destination folder, otherwise skip non-empty destination files
+    manifest: bool = True
+    hash_inputs: bool = False
 
 
 class RasterImageProcess:
@@ -58,12 +103,18 @@ class RasterImageProcess:
         self.dest_folder = options.dest_folder
 
         self.input_suffix = options.input_suffix
+        self.driver_name = options.driver_name
         self.output_suffix = get_suffix_by_driver(options.driver_name)
+        self.create_options = get_create_options(options.driver_name, options.predictor, options.compress_level,
+                                                 options.overview_resampling)
         self.recursive = options.recursive
 
         self.overwrite = options.overwrite
         self.rollback = options.rollback
 
+        self.executor = options.executor
+        self.max_workers = options.max_workers
+
         # put every file into a flatten task
         self.all_src = []
         self.all_dest = []
@@ -72,6 +123,8 @@ class RasterImageProcess:
         if not os.path.isdir(options.dest_folder):
             os.makedirs(options.dest_folder, exist_ok=True)
 
+        self.manifest = Manifest(options.dest_folder, options.hash_inputs) if options.manifest else None
+
         # wait for split src and dest into several task
         self.tasks = []
 
@@ -85,12 +138,18 @@ class RasterImageProcess:
         for path in self.all_src:
             # both src and dest maybe a list, so we use list
             src_in_task = [path]
-            dest_file_name = os.path.splitext(os.path.basename(path))[0] + f".{self.output_suffix}"
-            dest_in_task: list[str] = [os.path.join(self.dest_folder, dest_file_name)]
+            dest_in_task = self.get_dest_paths(path)
             self.tasks.append([src_in_task, dest_in_task, {}])
 
         self.flatten_dest_paths()
 
+    def get_dest_paths(self, src_path: str) -> list[str]:
+        """
+        the destination of a src file in default task, the src file may not exist yet.
+        """
+        dest_file_name = os.path.splitext(os.path.basename(src_path))[0] + f".{self.output_suffix}"
+        return [os.path.join(self.dest_folder, dest_file_name)]
+
     def execute(self, src_in_task: list[str], dest_in_task: list[str], **kwargs) -> bool:
         raise NotImplementedError
 
@@ -136,35 +195,115 @@ class RasterImageProcess:
             if os.path.isfile(path):
                 os.remove(path)
 
+    def run_task(self, src_in_task: list[str], dest_in_task: list[str], task_args: dict) -> bool:
+        """
+        execute one task, log and rollback it when failed.
+        it runs in the worker of executor, so it only returns a bool.
+        """
+        try:
+            result = self.execute(src_in_task, dest_in_task, **task_args)
+            # gdal returns None when failed, and the returned dataset is flushed when released
+            success = result is not None and result is not False
+            del result
+        except Exception:
+            logger.exception(f"Execute module '{self.__class__.__name__}' raised an exception.")
+            success = False
+
+        if not success:
+            logger.info(
+                f"Execute module '{self.__class__.__name__}' failed: "
+                f"source pathname: {src_in_task}, destination pathname: {dest_in_task}")
+
+            if self.rollback:
+                self.remove_existing_file(dest_in_task)
+                logger.info(f"Execute failed and rollback is performed. Remove file {dest_in_task}.")
+        return success
+
+    def get_params(self) -> dict:
+        """
+        parameters which affect the outputs of every task, a task is rebuilt when they change.
+        """
+        return {"module": self.__class__.__name__, "driver": self.driver_name,
+                "create_options": self.create_options, "options": getattr(self, "options", None)}
+
+    def get_task_params(self, task_args: dict) -> dict:
+        return {"module": self.get_params(), "task": task_args}
+
+    def get_pending_dest_paths(self, src_in_task: list[str], dest_in_task: list[str], task_args: dict) -> list[str]:
+        """
+        destination paths need to be built, empty list means the task is skipped.
+        """
+        if self.overwrite:
+            return dest_in_task
+        if self.manifest is None:
+            return self.remove_existing_path(dest_in_task)
+        if self.manifest.is_up_to_date(src_in_task, dest_in_task, self.get_task_params(task_args)):
+            logger.info(f"Destination is up-to-date : {dest_in_task}")
+            return []
+        return dest_in_task
+
+    def record_task(self, src_in_task: list[str], dest_in_task: list[str], task_args: dict):
+        if self.manifest is not None:
+            self.manifest.record(src_in_task, dest_in_task, self.get_task_params(task_args))
+
     @time_it
     def __call__(self, **kwargs):
         all_success = True
 
-        for src_in_task, dest_in_task, task_args in self.tasks:
-            if not self.overwrite:
-                dest_in_task = self.remove_existing_path(dest_in_task)
-                if len(dest_in_task) == 0:
+        with get_executor(self.executor, self.max_workers) as executor:
+            futures = {}
+            for src_in_task, dest_in_task, task_args in self.tasks:
+                pending_dest_in_task = self.get_pending_dest_paths(src_in_task, dest_in_task, task_args)
+                if len(pending_dest_in_task) == 0:
                     continue
 
-            success = self.execute(src_in_task, dest_in_task, **task_args)
+                future = executor.submit(self.run_task, src_in_task, pending_dest_in_task, task_args)
+                futures[future] = (src_in_task, dest_in_task, task_args)
 
-            if success is False:
-                all_success = False
-
-                logger.info(
-                    f"Execute module '{self.__class__.__name__}' failed: "
-                    f"source pathname: {src_in_task}, destination pathname: {dest_in_task}")
+            for future in concurrent.futures.as_completed(futures):
+                if future.result() is False:
+                    all_success = False
+                else:
+                    self.record_task(*futures[future])
 
-                if self.rollback:
-                    self.remove_existing_file(dest_in_task)
-                    logger.info(f"Execute failed and rollback is performed. Remove file {dest_in_task}.")
         return all_success
 
-    def build_vrt(self, filename: str = None) -> str:
+    def get_writable_path(self, dest_path: str) -> str:
+        """
+        the path to create output with gdal Create, cog driver only supports CreateCopy, so it uses a temp geotiff.
+        """
+        if self.driver_name == "COG":
+            return os.path.splitext(dest_path)[0] + ".temp.tif"
+        return dest_path
+
+    def copy_to_dest_path(self, writable_path: str, dest_path: str) -> bool:
+        """
+        copy the temp geotiff to destination with cog driver, it builds overviews and ifd-first layout.
+        """
+        if writable_path == dest_path:
+            return True
+        try:
+            result = gdal.Translate(dest_path, writable_path, format=self.driver_name,
+                                    creationOptions=self.create_options)
+            return result is not None
+        finally:
+            os.remove(writable_path)
+
+    def build_vrt(self, filename: str = None, dest_folder: str = None) -> str:
+        """
+        Args:
+            dest_folder: only the destination files in this folder are put into the vrt in it,
+                None means all destination files and the vrt is in dest folder of stage
+        """
         if filename is None:
             filename = f"{str(uuid.uuid4())}.vrt"
-        vrt_file = os.path.join(self.dest_folder, filename)
-        gdal.BuildVRT(vrt_file, self.all_dest)
+        if dest_folder is None:
+            dest_folder, dest_paths = self.dest_folder, self.all_dest
+        else:
+            dest_paths = [path for path in self.all_dest
+                          if os.path.normpath(os.path.dirname(path)) == os.path.normpath(dest_folder)]
+        vrt_file = os.path.join(dest_folder, filename)
+        gdal.BuildVRT(vrt_file, dest_paths)
         return vrt_file
 
 
@@ -199,7 +338,7 @@ class WGS84Grid(RasterImageProcess):
         super().__init__(options)
         self.name_format = name_format
         self.split_task(grid_shp_path)
-        self.options = {"format": options.driver_name, "creationOptions": TIF_CREATE_OPTIONS,
+        self.options = {"format": options.driver_name, "creationOptions": self.create_options,
                         "stats": True}
 
     def dest_filename(self, lng_centre: float, lat_centre: float):
@@ -232,28 +371,40 @@ class WGS84Grid(RasterImageProcess):
 
 
 class ColorRamp(RasterImageProcess):
+    """
+    render grids with color ramp in one pass.
+    each block is scaled to byte and looked up in a 256 entries rgba table, then written to destination directly.
+    """
+
     def __init__(self,
                  options: RasterImageProcessOptions,
                  color_file_path: str,
+                 paletted: bool = False,
+                 presence: PresenceProduct = None,
                  ):
+        """
+        Args:
+            paletted: write single band byte raster with color table instead of rgba raster
+            presence: src grids are presence cubes, and this product is derived from them before rendering
+        """
         super().__init__(options)
         self.split_task()
+        self.paletted = paletted
+        self.presence = presence
         self.scale_params = [self.get_scale_params(color_file_path)]
-        self.color_table = self.get_color_ramp(color_file_path)
-        # 1. convert to byte type
-        self.options1 = {"creationOptions": TIF_CREATE_OPTIONS, "outputType": gdal.gdalconst.GDT_Byte,
-                         "scaleParams": self.scale_params}
-        # 2. add rgba
-        self.options2 = {"creationOptions": TIF_CREATE_OPTIONS, "rgbExpand": "rgba"}
+        start_scale, end_scale = self.scale_params[0]
+        # the same linear scale with gdal_translate -scale start end 0 255
+        self.scale_ratio = 255 / (end_scale - start_scale)
+        self.scale_offset = -start_scale * self.scale_ratio
+        # shape is (4, 256), so a lookup gives band sequential rgba blocks
+        self.color_lut = get_color_lut(self.get_color_ramp(color_file_path))
 
     @staticmethod
     def get_scale_params(color_file_path: str):
         start_scale = None
         end_scale = None
-        print(color_file_path)
         with open(color_file_path) as f:
             for line in f:
-                print(line)
                 line = line.strip()
                 if not line[0].isdigit():
                     continue
@@ -290,106 +441,445 @@ class ColorRamp(RasterImageProcess):
         rgba = tuple(map(int, strs[1:5]))
         return value, rgba
 
+    def get_params(self) -> dict:
+        params = super().get_params()
+        params.update({"scale_params": self.scale_params, "color_lut": self.color_lut.tolist(),
+                       "paletted": self.paletted,
+                       "presence": None if self.presence is None else dataclasses.asdict(self.presence)})
+        return params
+
+    def get_color_table(self) -> gdal.ColorTable:
+        color_table = gdal.ColorTable()
+        for i in range(256):
+            color_table.SetColorEntry(i, tuple(int(value) for value in self.color_lut[:, i]))
+        return color_table
+
+    def scale(self, data: np.ndarray) -> np.ndarray:
+        values = data.astype(np.float32) * self.scale_ratio + self.scale_offset
+        # round and clamp like gdal does when it converts float to byte
+        values += 0.5
+        np.nan_to_num(values, copy=False, nan=0)
+        np.clip(values, 0, 255, out=values)
+        return values.astype(np.uint8)
+
     def execute(self, src_in_task: list[str], dest_in_task: list[str], **kwargs) -> bool:
-        temp_file = os.path.join(self.dest_folder, r"temp.tif")
-        gdal.Translate(temp_file, src_in_task[0], **self.options1)
-        ds = gdal.Open(temp_file, gdal.gdalconst.GA_Update)
-        band = ds.GetRasterBand(1)
-        band.SetRasterColorTable(self.color_table)
-        band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
-        del ds
-        result = gdal.Translate(dest_in_task[0], temp_file, **self.options2)
-        os.remove(temp_file)
-        return result
+        src_ds = gdal.Open(src_in_task[0])
+        if src_ds is None:
+            return False
+        src_band = src_ds.GetRasterBand(1)
+        nodata = src_band.GetNoDataValue()
+        x_size, y_size = src_ds.RasterXSize, src_ds.RasterYSize
+        cube_years = (src_ds.GetMetadataItem(PRESENCE_YEARS_KEY) or "").split(",")
+
+        writable_path = self.get_writable_path(dest_in_task[0])
+        if writable_path == dest_in_task[0]:
+            driver, create_options = gdal.GetDriverByName(self.driver_name), self.create_options
+        else:
+            driver, create_options = gdal.GetDriverByName("GTiff"), TIF_CREATE_OPTIONS
+        if self.paletted:
+            dest_ds = driver.Create(writable_path, x_size, y_size, 1, gdal.GDT_Byte, options=create_options)
+            dest_band = dest_ds.GetRasterBand(1)
+            dest_band.SetRasterColorTable(self.get_color_table())
+            dest_band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+            # nodata pixels are hidden by mask band, so every index of color table is still usable
+            if nodata is not None:
+                dest_ds.CreateMaskBand(gdal.GMF_PER_DATASET)
+        else:
+            dest_ds = driver.Create(writable_path, x_size, y_size, 4, gdal.GDT_Byte,
+                                    options=create_options + ["PHOTOMETRIC=RGB", "ALPHA=YES"])
+        if dest_ds is None:
+            return False
+        dest_ds.SetGeoTransform(src_ds.GetGeoTransform())
+        dest_ds.SetProjection(src_ds.GetProjection())
+
+        for y_off in range(0, y_size, BLOCK_SIZE):
+            for x_off in range(0, x_size, BLOCK_SIZE):
+                x_count = min(BLOCK_SIZE, x_size - x_off)
+                y_count = min(BLOCK_SIZE, y_size - y_off)
+                data = src_band.ReadAsArray(x_off, y_off, x_count, y_count)
+                valid = data != nodata if nodata is not None else None
+                if self.presence is not None:
+                    data = self.presence.derive(data, cube_years)
+                index = self.scale(data)
+
+                if self.paletted:
+                    dest_ds.GetRasterBand(1).WriteArray(index, x_off, y_off)
+                    if valid is not None:
+                        dest_ds.GetRasterBand(1).GetMaskBand().WriteArray(valid.astype(np.uint8) * 255, x_off, y_off)
+                    continue
+
+                rgba = np.take(self.color_lut, index, axis=1)
+                if valid is not None:
+                    rgba[3][~valid] = 0
+                for i in range(4):
+                    dest_ds.GetRasterBand(i + 1).WriteArray(rgba[i], x_off, y_off)
+
+        dest_ds.FlushCache()
+        del dest_ds
+        return self.copy_to_dest_path(writable_path, dest_in_task[0])
 
 
 class Thumbnail(RasterImageProcess):
+    """
+    thumbnails are read from overviews, overviews are built when source has none of them.
+    """
+
     def __init__(self,
                  options: RasterImageProcessOptions,
                  width_percent: float,
-                 height_percent: float):
+                 height_percent: float,
+                 build_overviews: bool = True):
+        """
+        Args:
+            build_overviews: build external overviews for source files without overviews
+        """
         super().__init__(options)
         self.split_task()
         self.options = {"format": options.driver_name,
                         "widthPct": width_percent, "heightPct": height_percent}
+        self.build_overviews = build_overviews
+        self.overview_resampling = options.overview_resampling
+        # the coarsest overview needed, gdal picks the overview closest to thumbnail size
+        max_factor = 100 / max(min(width_percent, height_percent), 1e-6)
+        self.overview_levels = []
+        factor = 2
+        while factor <= max_factor:
+            self.overview_levels.append(factor)
+            factor *= 2
 
     def execute(self, src_in_task: list[str], dest_in_task: list[str], **kwargs) -> bool:
+        if self.build_overviews:
+            ensure_overviews(src_in_task[0], self.overview_levels, self.overview_resampling)
         kwargs.update(self.options)
         result = gdal.Translate(dest_in_task[0], src_in_task[0], **kwargs)
         return result
 
 
 class XYZTiles(RasterImageProcess):
+    """
+    render xyz tiles with the native tile engine.
+    tiles are saved as {z}/{x}/{y}.png like gdal2tiles --xyz, or streamed into a single mbtiles or pmtiles archive.
+    the footprint of every grid is recorded in manifest, so when some grids change,
+    only the tiles intersecting their old and new footprints are rendered again.
+    """
+
     def __init__(
             self,
             options: RasterImageProcessOptions,
             zoom: str,
-            processes: int = 4,
+            processes: int = None,
             resampling: str = "near",
+            tile_format: str = "folder",
+            changed_grids: list[str] = None,
             web_viewer: str = "all",
     ):
+        """
+        Args:
+            zoom: zoom levels like "0-10"
+            processes: worker count of tile engine, None means cpu count
+            resampling: "near" or "average"
+            tile_format: "folder", "mbtiles" or "pmtiles", an archive is saved as tiles.mbtiles or tiles.pmtiles
+            changed_grids: grids whose tiles are rendered again even if manifest finds them unchanged
+            web_viewer: viewer of gdal2tiles, leaflet.html is written into a tile folder unless it is "none",
+                other viewers are not written any more
+        """
+        if web_viewer not in WEB_VIEWERS:
+            raise ValueError(f"web viewer should be one of {WEB_VIEWERS}, but got {web_viewer}.")
+        if web_viewer not in ("all", "leaflet", "none"):
+            logger.warning(f"{web_viewer} viewer is not written any more, leaflet.html is written instead.")
         super().__init__(options)
+        self.tile_path = get_tile_store_path(self.dest_folder, tile_format)
         self.split_task()
-        self.options = ["--xyz", "--exclude", "--resume", f"--zoom={zoom}", f"--processes={processes}",
-                        f"--resampling={resampling}", f"--webviewer={web_viewer}"]
+        self.processes = processes
+        self.changed_grids = [os.path.normpath(path) for path in changed_grids or []]
+        min_zoom, max_zoom = parse_zoom(zoom)
+        self.options = {"min_zoom": min_zoom, "max_zoom": max_zoom, "resampling": resampling}
+        # the viewer does not change tiles, so it is not in options recorded by manifest
+        self.web_viewer = web_viewer != "none"
 
     def split_task(self, **kwargs):
-        self.tasks.append([self.src_path, [self.dest_folder], {}])
+        self.tasks.append([self.src_path, [self.tile_path], {}])
+
+    def get_pending_dest_paths(self, src_in_task: list[str], dest_in_task: list[str], task_args: dict) -> list[str]:
+        if len(self.changed_grids) > 0:
+            return dest_in_task
+        return super().get_pending_dest_paths(src_in_task, dest_in_task, task_args)
+
+    def get_changed_footprints(self, src_in_task: list[str], dest_in_task: list[str],
+                               task_args: dict) -> list[tuple[float, float, float, float]] | None:
+        """
+        old and new footprints of changed grids, None means all tiles should be rendered.
+        """
+        changed = set(self.changed_grids)
+        old_footprints = {}
+        if self.manifest is not None:
+            record = self.manifest.get_record(dest_in_task)
+            changed_inputs = self.manifest.get_changed_inputs(src_in_task, dest_in_task,
+                                                              self.get_task_params(task_args))
+            # tiles rendered before footprints are recorded should be rendered entirely
+            if changed_inputs is None or "footprints" not in record or not os.path.exists(dest_in_task[0]):
+                return None
+            changed.update(changed_inputs)
+            old_footprints = record["footprints"]
+        elif len(changed) == 0:
+            return None
+
+        footprints = [old_footprints[path] for path in changed if path in old_footprints]
+        footprints.extend(get_bounds(path) for path in changed if os.path.isfile(path))
+        return footprints
 
     def execute(self, src_in_task: list[str], dest_in_task: list[str], **kwargs) -> bool:
-        options = self.options + [src_in_task[0], dest_in_task[0]]
-        return gdal2tiles.main(options) == 0
+        # a recorded tile store runs again only when it is stale, so existing tiles should be rendered again
+        resume = self.manifest is None or not self.manifest.has_record(dest_in_task)
+        changed_footprints = self.get_changed_footprints(src_in_task, dest_in_task, kwargs)
+        return render_xyz_tiles(src_in_task[0], dest_in_task[0], resume=resume, max_workers=self.processes,
+                                changed_footprints=changed_footprints, web_viewer=self.web_viewer,
+                                **self.options)
+
+    def record_task(self, src_in_task: list[str], dest_in_task: list[str], task_args: dict):
+        if self.manifest is not None:
+            footprints = {path: get_bounds(path) for path in expand_vrt_sources(src_in_task) if os.path.isfile(path)}
+            self.manifest.record(src_in_task, dest_in_task, self.get_task_params(task_args), footprints=footprints)
 
 
 class Calc(RasterImageProcess):
+    """
+    raster calculator like gdal_calc, expressions are evaluated with numpy in process block by block.
+    grids in src folders are matched by the name prefix before the last "_", A is the grid of the first src folder,
+    B is the grid of the second, and so on.
+    several outputs can be evaluated block by block over one read of the inputs.
+    """
+
     def __init__(self,
                  options: RasterImageProcessOptions,
-                 calc: str,
+                 calc: str = None,
                  output_type: str = "Byte",
                  hide_nodata: bool = True,
-                 nodata: int = 0):
+                 nodata: int = 0,
+                 outputs: list[CalcOutput] = None,
+                 grid_index: GridIndex = None):
+        """
+        Args:
+            calc: expression of the single output in dest folder
+            output_type: gdal data type of the single output
+            hide_nodata: ignore nodata of inputs
+            nodata: nodata of outputs
+            outputs: expressions and the src folders they use, instead of calc and output_type,
+                the inputs of output are index of src folders
+            grid_index: index of src folders built before, to avoid scanning them again
+        """
         super().__init__(options)
+        if grid_index is None:
+            self.grid_index = GridIndex(self.src_path, self.input_suffix)
+            self.grid_index.report_mismatches(type(self).__name__)
+        else:
+            # mismatches of an index built before are reported by its builder
+            self.grid_index = grid_index.select(self.src_path)
+        if outputs is None:
+            outputs = [CalcOutput(calc, self.dest_folder, output_type)]
+        self.outputs = outputs
+        self.hide_nodata = hide_nodata
+        self.nodata = nodata
+        self.options = {"outputs": [dataclasses.asdict(output) for output in outputs],
+                        "hide_nodata": hide_nodata, "nodata": nodata}
+        for output in outputs:
+            os.makedirs(output.dest_folder, exist_ok=True)
         self.split_task()
-        self.options = [f"--calc={calc}", "--quiet", f"--type={output_type}", "--overwrite"]
-        if hide_nodata:
-            self.options.append("--hideNoData")
-        if nodata is not None:
-            self.options.append(f"--NoDataValue={nodata}")
 
     def split_task(self, **kwargs):
-        self.all_src = []
-        self.all_dest = []
-        first_input_folder = self.src_path[0]
-        path_match = os.path.join(first_input_folder, f"*.{self.input_suffix}")
-        for first_input_file in glob.iglob(path_match):
-            task = [[], [], {}]
-            basename = os.path.basename(first_input_file)
-            prefix = basename.rsplit("_", 1)[0]
-            task[0] = self.find_all_files_in_src_folders(prefix)
-
-            dest_file = os.path.join(self.dest_folder, f"{prefix}.tif")
-            task[1].append(dest_file)
-            self.all_src.extend(task[0])
-            self.all_dest.extend(task[1])
-            self.tasks.append(task)
-
-    def find_all_files_in_src_folders(self, prefix: str):
-        input_files_in_one_task = []
-        for folder in self.src_path:
-            path_match = os.path.join(folder, f"{prefix}*.{self.input_suffix}")
-            for file in glob.iglob(path_match):
-                input_files_in_one_task.append(file)
-
-        return input_files_in_one_task
+        """
+        one task for each grid, its destination is the grid of each output,
+        an output is skipped when its grid is missing in any src folder it uses.
+        """
+        for prefix in self.grid_index.prefixes:
+            src_by_folder = self.grid_index.get_paths(prefix)
+            dest_outputs = {}
+            for i, output in enumerate(self.outputs):
+                if all(src_by_folder[j] is not None for j in output.get_inputs(len(self.src_path))):
+                    dest_outputs[os.path.join(output.dest_folder, f"{prefix}.tif")] = i
+            if len(dest_outputs) == 0:
+                continue
+
+            folders = sorted({j for i in dest_outputs.values() for j in self.outputs[i].get_inputs(len(self.src_path))})
+            src_in_task = [src_by_folder[j] for j in folders]
+            self.tasks.append([src_in_task, list(dest_outputs), {"folders": folders, "outputs": dest_outputs}])
+            self.all_src.extend(src_in_task)
+        self.flatten_dest_paths()
+
+    def execute(self, src_in_task: list[str], dest_in_task: list[str], **kwargs) -> bool:
+        src_paths = [None] * len(self.src_path)
+        for folder, path in zip(kwargs["folders"], src_in_task):
+            src_paths[folder] = path
+        outputs = [self.outputs[kwargs["outputs"][dest_path]] for dest_path in dest_in_task]
+        writable_paths = [self.get_writable_path(dest_path) for dest_path in dest_in_task]
+        if writable_paths == dest_in_task:
+            driver_name, create_options = self.driver_name, self.create_options
+        else:
+            driver_name, create_options = "GTiff", TIF_CREATE_OPTIONS
+        try:
+            if not run_calc(src_paths, outputs, writable_paths, driver_name, create_options, self.hide_nodata,
+                            self.nodata, BLOCK_SIZE):
+                return False
+        except ValueError as e:
+            logger.error(f"Calc of {src_in_task} failed: {e}")
+            return False
+        return all([self.copy_to_dest_path(writable_path, dest_path)
+                    for writable_path, dest_path in zip(writable_paths, dest_in_task)])
+
+
+class PresenceCube(RasterImageProcess):
+    """
+    merge the water distribution of every year into one band, bit i is the water presence of year i.
+    change and statistics of any years are derived from it on demand, so it grows with years linearly,
+    and a new year is appended by reading the cube and the grids of the new year only.
+    """
+
+    def __init__(self,
+                 options: RasterImageProcessOptions,
+                 years: list[str],
+                 presence_value: int = 1,
+                 grid_index: GridIndex = None):
+        """
+        Args:
+            options: src_path is the folder of each year in the order of years
+            years: years of bits from bit 0, new years should be appended to the end
+            presence_value: value of water in distribution grids
+            grid_index: index of year folders built before, to avoid scanning them again
+        """
+        super().__init__(options)
+        if grid_index is None:
+            self.grid_index = GridIndex(self.src_path, self.input_suffix)
+            self.grid_index.report_mismatches(type(self).__name__)
+        else:
+            # mismatches of an index built before are reported by its builder
+            self.grid_index = grid_index.select(self.src_path)
+        if len(years) != len(self.src_path):
+            raise ValueError(f"There should be a src folder for each year of {years}.")
+        self.years = list(years)
+        self.presence_type = get_presence_type(len(years))
+        self.presence_value = presence_value
+        self.options = {"years": self.years, "presence_value": presence_value}
+        self.split_task()
+
+    def get_params(self) -> dict:
+        # years are appended without rebuilding, so they are checked by the inputs instead of parameters
+        params = super().get_params()
+        params["options"] = {"presence_type": self.presence_type, "presence_value": self.presence_value}
+        return params
+
+    def get_task_params(self, task_args: dict) -> dict:
+        # years of a grid are checked by its inputs, so a new year only merges its grid into the cube
+        return {"module": self.get_params()}
+
+    def split_task(self, **kwargs):
+        # a grid missing in some years is merged with the years it has
+        for prefix in self.grid_index.prefixes:
+            paths = self.grid_index.get_paths(prefix)
+            years = [year for year, path in zip(self.years, paths) if path is not None]
+            src_in_task = [path for path in paths if path is not None]
+            self.tasks.append([src_in_task, [os.path.join(self.dest_folder, f"{prefix}.tif")], {"years": years}])
+            self.all_src.extend(src_in_task)
+        self.flatten_dest_paths()
+
+    def get_merged_years(self, dest_path: str) -> list[str]:
+        """
+        years already in the existing cube, empty when the cube should be built again.
+        """
+        if not os.path.isfile(dest_path):
+            return []
+        dest_ds = gdal.Open(dest_path)
+        if dest_ds is None or gdal.GetDataTypeName(dest_ds.GetRasterBand(1).DataType) != self.presence_type:
+            return []
+        if dest_ds.GetRasterBand(1).GetNoDataValue() != get_presence_nodata(self.presence_type):
+            return []
+        cube_years = (dest_ds.GetMetadataItem(PRESENCE_YEARS_KEY) or "").split(",")
+        merged_years = (dest_ds.GetMetadataItem(PRESENCE_MERGED_KEY) or "").split(",")
+        # bits of old years should not move
+        if cube_years != self.years[:len(cube_years)]:
+            return []
+        return [year for year in merged_years if year in cube_years]
+
+    def get_stale_years(self, src_in_task: list[str], dest_in_task: list[str], years: list[str],
+                        merged_years: list[str]) -> list[str] | None:
+        """
+        years to merge into the existing cube, None means the cube should be built again.
+        years not merged yet are stale, a merged year whose grid changed since the cube was recorded rebuilds the cube,
+        as pixels valid only in its old grid can not be told from the cube.
+        """
+        if len(merged_years) == 0 or any(year not in years for year in merged_years):
+            return None
+        # without manifest, changes of grids of merged years are unknown
+        if self.manifest is None:
+            return None
+        changed_paths = self.manifest.get_changed_inputs(src_in_task, dest_in_task, self.get_task_params({}))
+        if changed_paths is None:
+            return None
+        path_years = {os.path.normpath(path): year for year, path in zip(years, src_in_task)}
+        # a removed grid can not be merged again
+        if any(path not in path_years for path in changed_paths):
+            return None
+        if any(path_years[path] in merged_years for path in changed_paths):
+            return None
+        stale_years = [year for year in years if year not in merged_years]
+        # inputs are unchanged, so the cube itself changed since it was recorded
+        return stale_years if len(stale_years) > 0 else None
 
     def execute(self, src_in_task: list[str], dest_in_task: list[str], **kwargs) -> bool:
-        # in argv, to represent space, should use two item in list
-        options = [" "]  # the first should be a placeholder
-        for i, input_file in enumerate(src_in_task):
-            options.append(f"-{chr(ord('A') + i)}")
-            options.append(input_file)
-        options.append(f"--outfile={dest_in_task[0]}")
-        for create_option in TIF_CREATE_OPTIONS:
-            options.append(f"--creation-option={create_option}")
-        options.extend(self.options)
-        return gdal_calc.main(options) == 0
+        dest_path = dest_in_task[0]
+        years = kwargs["years"]
+        merged_years = [] if self.overwrite else self.get_merged_years(dest_path)
+        stale_years = self.get_stale_years(src_in_task, dest_in_task, years, merged_years)
+        if stale_years is None:
+            merged_years, stale_years = [], years
+        new_src = [(self.years.index(year), path) for year, path in zip(years, src_in_task) if year in stale_years]
+        logger.info(f"Merge years {stale_years} into {dest_path}.")
+
+        src_bands = [(bit, gdal.Open(path).GetRasterBand(1)) for bit, path in new_src]
+        first_ds = gdal.Open(new_src[0][1])
+        cube_band = gdal.Open(dest_path).GetRasterBand(1) if len(merged_years) > 0 else None
+        x_size, y_size = first_ds.RasterXSize, first_ds.RasterYSize
+        dtype = PRESENCE_TYPES[self.presence_type]
+        nodata = get_presence_nodata(self.presence_type)
+
+        # the cube is never updated in place, so a failed append keeps the old cube
+        temp_path = os.path.splitext(dest_path)[0] + ".temp.tif"
+        create_options = self.create_options if self.driver_name == "GTiff" else TIF_CREATE_OPTIONS
+        temp_ds = gdal.GetDriverByName("GTiff").Create(temp_path, x_size, y_size, 1,
+                                                      gdal.GetDataTypeByName(self.presence_type),
+                                                      options=create_options)
+        if temp_ds is None:
+            return False
+        temp_ds.SetGeoTransform(first_ds.GetGeoTransform())
+        temp_ds.SetProjection(first_ds.GetProjection())
+        temp_ds.SetMetadataItem(PRESENCE_YEARS_KEY, ",".join(self.years))
+        temp_ds.SetMetadataItem(PRESENCE_MERGED_KEY,
+                                ",".join(year for year in self.years if year in merged_years or year in stale_years))
+
+        temp_band = temp_ds.GetRasterBand(1)
+        temp_band.SetNoDataValue(nodata)
+        for x_off, y_off, x_count, y_count in get_block_windows(x_size, y_size, BLOCK_SIZE):
+            if cube_band is None:
+                cube = np.zeros((y_count, x_count), dtype=dtype)
+                valid = np.zeros((y_count, x_count), dtype=bool)
+            else:
+                cube = cube_band.ReadAsArray(x_off, y_off, x_count, y_count)
+                # a pixel is valid when any merged year has data in it
+                valid = cube != nodata
+                cube[~valid] = 0
+            for bit, src_band in src_bands:
+                data = src_band.ReadAsArray(x_off, y_off, x_count, y_count)
+                cube |= (data == self.presence_value).astype(dtype) << bit
+                src_nodata = src_band.GetNoDataValue()
+                if src_nodata is None:
+                    valid[:] = True
+                else:
+                    valid |= ~np.isnan(data) if np.isnan(src_nodata) else data != src_nodata
+            cube[~valid] = nodata
+            temp_band.WriteArray(cube, x_off, y_off)
+        temp_ds.FlushCache()
+        del temp_ds, temp_band, cube_band
+
+        if self.driver_name == "GTiff":
+            os.replace(temp_path, dest_path)
+            return True
+        return self.copy_to_dest_path(temp_path, dest_path)
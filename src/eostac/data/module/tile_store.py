@@ -0,0 +1,570 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+
+TILE_FORMATS = ("folder", "mbtiles", "pmtiles")
+# every uniform tile of a folder store is stored once in this folder, tiles of the same color are hard links to it
+UNIFORM_FOLDER = ".uniform"
+# mbtiles rows are inserted in one transaction per batch
+MBTILES_BATCH_SIZE = 1000
+
+PMTILES_MAGIC = b"PMTiles"
+PMTILES_VERSION = 3
+PMTILES_HEADER_SIZE = 127
+# header and root directory should be fetched by one 16k request
+PMTILES_ROOT_SIZE = 16384 - PMTILES_HEADER_SIZE
+PMTILES_COMPRESSION_NONE = 1
+PMTILES_COMPRESSION_GZIP = 2
+PMTILES_TILE_TYPE_PNG = 2
+PMTILES_HEADER_FORMAT = "<7sB8QQQQBBBBBBiiiiBii"
+# deserialized leaf directories kept by a reader
+PMTILES_LEAF_CACHE_SIZE = 64
+
+
+def get_tile_store_path(dest_folder: str, tile_format: str) -> str:
+    """
+    a folder store is the dest folder itself, an archive is a single file in it.
+    """
+    if tile_format not in TILE_FORMATS:
+        raise ValueError(f"tile format should be one of {TILE_FORMATS}, but got {tile_format}.")
+    if tile_format == "folder":
+        return dest_folder
+    return os.path.join(dest_folder, f"tiles.{tile_format}")
+
+
+def open_tile_store(path: str, mode: str = "r") -> "TileStore":
+    """
+    open a tile store by the suffix of path, ".mbtiles", ".pmtiles" or a folder of {z}/{x}/{y}.png.
+
+    Args:
+        path: folder or archive path
+        mode: "r" to read, "w" to write from scratch, existing tiles are removed, "a" to update existing tiles,
+            a pmtiles archive is rewritten with existing tiles by "a"
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".mbtiles":
+        return MBTilesStore(path, mode)
+    if suffix == ".pmtiles":
+        if mode == "r":
+            return PMTilesReader(path)
+        return PMTilesWriter(path, append=mode == "a")
+    return FolderTileStore(path, mode)
+
+
+class TileStore:
+    """
+    Tiles of xyz scheme, z/x/y are the same with google tiles in every store.
+    """
+
+    def get(self, z: int, x: int, y: int) -> bytes | None:
+        raise NotImplementedError
+
+    def has(self, z: int, x: int, y: int) -> bool:
+        return self.get(z, x, y) is not None
+
+    def put(self, z: int, x: int, y: int, data: bytes, key: str = None):
+        """
+        Args:
+            data: encoded tile
+            key: same key means same data, so the store can keep the data once
+        """
+        raise NotImplementedError
+
+    def remove(self, z: int, x: int, y: int):
+        raise NotImplementedError
+
+    def set_metadata(self, metadata: dict):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FolderTileStore(TileStore):
+    """
+    Tiles in {z}/{x}/{y}.png, the same layout with gdal2tiles --xyz.
+    """
+
+    def __init__(self, folder: str, mode: str = "r"):
+        """
+        Args:
+            folder: tile folder, other files in it like the manifest are kept by "w" mode
+        """
+        self.folder = folder
+        if mode == "w" and os.path.isdir(folder):
+            for entry in os.scandir(folder):
+                if entry.is_dir(follow_symlinks=False) and (entry.name.isdigit() or entry.name == UNIFORM_FOLDER):
+                    shutil.rmtree(entry.path)
+
+    def get_path(self, z: int, x: int, y: int) -> str:
+        return os.path.join(self.folder, str(z), str(x), f"{y}.png")
+
+    def get(self, z: int, x: int, y: int) -> bytes | None:
+        path = self.get_path(z, x, y)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def has(self, z: int, x: int, y: int) -> bool:
+        return os.path.isfile(self.get_path(z, x, y))
+
+    def put(self, z: int, x: int, y: int, data: bytes, key: str = None):
+        path = self.get_path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            # the path may be a hard link of a uniform tile, never write through it
+            os.remove(path)
+        if key is None:
+            with open(path, "wb") as f:
+                f.write(data)
+            return
+
+        uniform_path = os.path.join(self.folder, UNIFORM_FOLDER, f"{key}.png")
+        if not os.path.isfile(uniform_path):
+            os.makedirs(os.path.dirname(uniform_path), exist_ok=True)
+            with open(uniform_path, "wb") as f:
+                f.write(data)
+        try:
+            os.link(uniform_path, path)
+        except OSError:
+            shutil.copyfile(uniform_path, path)
+
+    def remove(self, z: int, x: int, y: int):
+        path = self.get_path(z, x, y)
+        if os.path.lexists(path):
+            os.remove(path)
+
+
+class MBTilesStore(TileStore):
+    """
+    Tiles in a mbtiles sqlite file, tile data is deduplicated by the map and images tables.
+    rows are tms scheme as the mbtiles spec requires, they are flipped from xyz y.
+    """
+
+    def __init__(self, path: str, mode: str = "r"):
+        self.path = path
+        self.mode = mode
+        self.pending = []
+        if mode == "r":
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS map (
+                zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+                PRIMARY KEY (zoom_level, tile_column, tile_row));
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row,
+                       images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+        """)
+        if mode == "w":
+            with self.connection:
+                self.connection.execute("DELETE FROM map")
+                self.connection.execute("DELETE FROM images")
+                self.connection.execute("DELETE FROM metadata")
+
+    @staticmethod
+    def get_row(z: int, y: int) -> int:
+        return (1 << z) - 1 - y
+
+    def get(self, z: int, x: int, y: int) -> bytes | None:
+        self.flush()
+        row = self.connection.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, self.get_row(z, y))).fetchone()
+        return None if row is None else row[0]
+
+    def has(self, z: int, x: int, y: int) -> bool:
+        self.flush()
+        row = self.connection.execute(
+            "SELECT 1 FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, self.get_row(z, y))).fetchone()
+        return row is not None
+
+    def put(self, z: int, x: int, y: int, data: bytes, key: str = None):
+        self.pending.append((z, x, self.get_row(z, y), hashlib.sha1(data).hexdigest(), data))
+        if len(self.pending) >= MBTILES_BATCH_SIZE:
+            self.flush()
+
+    def remove(self, z: int, x: int, y: int):
+        self.flush()
+        with self.connection:
+            self.connection.execute("DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                    (z, x, self.get_row(z, y)))
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)",
+                                        [(tile_id, data) for _, _, _, tile_id, data in self.pending])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                [(z, x, row, tile_id) for z, x, row, tile_id, _ in self.pending])
+        self.pending = []
+
+    def get_metadata(self) -> dict:
+        return dict(self.connection.execute("SELECT name, value FROM metadata").fetchall())
+
+    def set_metadata(self, metadata: dict):
+        # the spec saves lists like bounds as "left,bottom,right,top"
+        rows = [(name, ",".join(str(item) for item in value) if isinstance(value, (list, tuple)) else str(value))
+                for name, value in metadata.items()]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", rows)
+
+    def close(self):
+        if self.mode != "r":
+            self.flush()
+            # images of removed or replaced tiles
+            with self.connection:
+                self.connection.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+        self.connection.close()
+
+
+def zxy_to_tile_id(z: int, x: int, y: int) -> int:
+    """
+    pmtiles tile id, tiles of lower zooms are before, and tiles of one zoom are ordered by hilbert curve.
+    """
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    s = 1 << max(z - 1, 0)
+    while s > 0 and z > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s //= 2
+    return tile_id
+
+
+def write_varint(buffer: bytearray, value: int):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def serialize_directory(entries: list[tuple[int, int, int, int]]) -> bytes:
+    """
+    gzip compressed pmtiles directory of (tile_id, offset, length, run_length) entries sorted by tile_id.
+    a run length of 0 means the entry points to a leaf directory.
+    """
+    buffer = bytearray()
+    write_varint(buffer, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        write_varint(buffer, tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        write_varint(buffer, run_length)
+    for _, _, length, _ in entries:
+        write_varint(buffer, length)
+    for i, (_, offset, _, _) in enumerate(entries):
+        # 0 means the data is right after the data of last entry
+        if i > 0 and offset == entries[i - 1][1] + entries[i - 1][2]:
+            write_varint(buffer, 0)
+        else:
+            write_varint(buffer, offset + 1)
+    return gzip.compress(bytes(buffer))
+
+
+def deserialize_directory(data: bytes) -> list[tuple[int, int, int, int]]:
+    data = gzip.decompress(data)
+    count, position = read_varint(data, 0)
+    columns = [[0] * count for _ in range(4)]
+    tile_ids, offsets, lengths, run_lengths = columns
+    last_id = 0
+    for i in range(count):
+        delta, position = read_varint(data, position)
+        last_id += delta
+        tile_ids[i] = last_id
+    for i in range(count):
+        run_lengths[i], position = read_varint(data, position)
+    for i in range(count):
+        lengths[i], position = read_varint(data, position)
+    for i in range(count):
+        value, position = read_varint(data, position)
+        offsets[i] = offsets[i - 1] + lengths[i - 1] if value == 0 and i > 0 else value - 1
+    return list(zip(tile_ids, offsets, lengths, run_lengths))
+
+
+def build_directories(entries: list[tuple[int, int, int, int]]) -> tuple[bytes, bytes]:
+    """
+    split entries into leaf directories until the root directory fits in the first 16k of archive.
+
+    Returns:
+        root directory and leaf directories
+    """
+    root = serialize_directory(entries)
+    if len(root) <= PMTILES_ROOT_SIZE:
+        return root, b""
+
+    leaf_size = 4096
+    while True:
+        root_entries = []
+        leaves = bytearray()
+        for start in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[start:start + leaf_size])
+            root_entries.append((entries[start][0], len(leaves), len(leaf), 0))
+            leaves.extend(leaf)
+        root = serialize_directory(root_entries)
+        if len(root) <= PMTILES_ROOT_SIZE:
+            return root, bytes(leaves)
+        leaf_size = int(leaf_size * 1.2)
+
+
+def find_entry(entries: list[tuple[int, int, int, int]], tile_id: int) -> tuple[int, int, int, int] | None:
+    low, high = 0, len(entries) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        if entries[middle][0] <= tile_id:
+            low = middle + 1
+        else:
+            high = middle - 1
+    if high < 0:
+        return None
+    entry = entries[high]
+    # a leaf directory entry covers every tile id until the next entry
+    if entry[3] == 0 or tile_id < entry[0] + entry[3]:
+        return entry
+    return None
+
+
+class PMTilesWriter(TileStore):
+    """
+    Write a pmtiles v3 archive.
+    tile data is appended to a temp file while rendering, and copied in tile id order when closing,
+    so the archive is clustered and same tiles are stored once.
+    """
+
+    def __init__(self, path: str, append: bool = False):
+        """
+        Args:
+            path: archive path, it is replaced when closing
+            append: start with the tiles and metadata of the existing archive
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.temp_path = f"{path}.{os.getpid()}.tmp"
+        self.data_file = open(self.temp_path, "w+b")
+        # tile id to content hash, content hash to (offset, length) in the temp file
+        self.tiles = {}
+        self.contents = {}
+        self.metadata = {}
+        if append and os.path.isfile(path):
+            self.load(path)
+
+    def load(self, path: str):
+        with PMTilesReader(path) as reader:
+            self.metadata = reader.get_metadata()
+            for tile_id, offset, length, run_length in reader.iter_entries():
+                digest = self.put_data(reader.read(reader.header["tile_data_offset"] + offset, length))
+                for i in range(run_length):
+                    self.tiles[tile_id + i] = digest
+
+    def put_data(self, data: bytes) -> bytes:
+        digest = hashlib.sha1(data).digest()
+        if digest not in self.contents:
+            self.data_file.seek(0, os.SEEK_END)
+            self.contents[digest] = (self.data_file.tell(), len(data))
+            self.data_file.write(data)
+        return digest
+
+    def get(self, z: int, x: int, y: int) -> bytes | None:
+        digest = self.tiles.get(zxy_to_tile_id(z, x, y))
+        if digest is None:
+            return None
+        offset, length = self.contents[digest]
+        self.data_file.seek(offset)
+        data = self.data_file.read(length)
+        self.data_file.seek(0, os.SEEK_END)
+        return data
+
+    def has(self, z: int, x: int, y: int) -> bool:
+        return zxy_to_tile_id(z, x, y) in self.tiles
+
+    def put(self, z: int, x: int, y: int, data: bytes, key: str = None):
+        self.tiles[zxy_to_tile_id(z, x, y)] = self.put_data(data)
+
+    def remove(self, z: int, x: int, y: int):
+        self.tiles.pop(zxy_to_tile_id(z, x, y), None)
+
+    def set_metadata(self, metadata: dict):
+        self.metadata.update(metadata)
+
+    def close(self):
+        temp_archive_path = f"{self.path}.{os.getpid()}.archive.tmp"
+        try:
+            self.write_archive(temp_archive_path)
+            os.replace(temp_archive_path, self.path)
+        finally:
+            self.abort()
+            if os.path.isfile(temp_archive_path):
+                os.remove(temp_archive_path)
+
+    def abort(self):
+        self.data_file.close()
+        if os.path.isfile(self.temp_path):
+            os.remove(self.temp_path)
+
+    def write_archive(self, path: str):
+        # entries in tile id order, a run of same content is one entry
+        entries = []
+        offsets = {}
+        tile_data_length = 0
+        for tile_id in sorted(self.tiles):
+            digest = self.tiles[tile_id]
+            if digest not in offsets:
+                offsets[digest] = tile_data_length
+                tile_data_length += self.contents[digest][1]
+            last = entries[-1] if entries else None
+            if last is not None and last[0] + last[3] == tile_id and last[1] == offsets[digest]:
+                entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+            else:
+                entries.append((tile_id, offsets[digest], self.contents[digest][1], 1))
+
+        root, leaves = build_directories(entries)
+        metadata = gzip.compress(json.dumps(self.metadata).encode("utf-8"))
+        root_offset = PMTILES_HEADER_SIZE
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        tile_data_offset = leaves_offset + len(leaves)
+
+        bounds = self.metadata.get("bounds", (-180, -85, 180, 85))
+        min_zoom = int(self.metadata.get("minzoom", 0))
+        max_zoom = int(self.metadata.get("maxzoom", 0))
+        header = struct.pack(
+            PMTILES_HEADER_FORMAT, PMTILES_MAGIC, PMTILES_VERSION,
+            root_offset, len(root), metadata_offset, len(metadata), leaves_offset, len(leaves),
+            tile_data_offset, tile_data_length, len(self.tiles), len(entries), len(offsets),
+            1, PMTILES_COMPRESSION_GZIP, PMTILES_COMPRESSION_NONE, PMTILES_TILE_TYPE_PNG, min_zoom, max_zoom,
+            *[round(value * 1e7) for value in bounds],
+            min_zoom, round((bounds[0] + bounds[2]) / 2 * 1e7), round((bounds[1] + bounds[3]) / 2 * 1e7))
+
+        with open(path, "wb") as f:
+            f.write(header)
+            f.write(root)
+            f.write(metadata)
+            f.write(leaves)
+            # copy every content once in the order of its first tile
+            for digest in sorted(offsets, key=offsets.get):
+                offset, length = self.contents[digest]
+                self.data_file.seek(offset)
+                f.write(self.data_file.read(length))
+
+
+class PMTilesReader(TileStore):
+    """
+    Read tiles of a pmtiles v3 archive from a local file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "rb")
+        self.header = self.read_header()
+        self.root = deserialize_directory(self.read(self.header["root_offset"], self.header["root_length"]))
+        self.leaves = {}
+
+    def read(self, offset: int, length: int) -> bytes:
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def read_header(self) -> dict:
+        values = struct.unpack(PMTILES_HEADER_FORMAT, self.read(0, PMTILES_HEADER_SIZE))
+        if values[0] != PMTILES_MAGIC or values[1] != PMTILES_VERSION:
+            raise ValueError(f"{self.path} is not a pmtiles v3 archive.")
+        names = ["root_offset", "root_length", "metadata_offset", "metadata_length", "leaves_offset",
+                 "leaves_length", "tile_data_offset", "tile_data_length", "addressed_tiles", "tile_entries",
+                 "tile_contents", "clustered", "internal_compression", "tile_compression", "tile_type",
+                 "min_zoom", "max_zoom", "min_lon_e7", "min_lat_e7", "max_lon_e7", "max_lat_e7",
+                 "center_zoom", "center_lon_e7", "center_lat_e7"]
+        return dict(zip(names, values[2:]))
+
+    def get_metadata(self) -> dict:
+        data = self.read(self.header["metadata_offset"], self.header["metadata_length"])
+        return json.loads(gzip.decompress(data))
+
+    def get(self, z: int, x: int, y: int) -> bytes | None:
+        tile_id = zxy_to_tile_id(z, x, y)
+        entries = self.root
+        # the depth of leaf directories is at most 3 in the spec
+        for _ in range(4):
+            entry = find_entry(entries, tile_id)
+            if entry is None:
+                return None
+            _, offset, length, run_length = entry
+            if run_length > 0:
+                return self.read(self.header["tile_data_offset"] + offset, length)
+            entries = self.get_leaf(offset, length)
+        return None
+
+    def get_leaf(self, offset: int, length: int) -> list[tuple[int, int, int, int]]:
+        if offset not in self.leaves:
+            if len(self.leaves) >= PMTILES_LEAF_CACHE_SIZE:
+                self.leaves.pop(next(iter(self.leaves)))
+            self.leaves[offset] = deserialize_directory(self.read(self.header["leaves_offset"] + offset, length))
+        return self.leaves[offset]
+
+    def iter_entries(self, entries: list[tuple[int, int, int, int]] = None):
+        """
+        iterate (tile_id, offset, length, run_length) of every tile entry, leaf directories are expanded.
+        """
+        for tile_id, offset, length, run_length in self.root if entries is None else entries:
+            if run_length > 0:
+                yield tile_id, offset, length, run_length
+            else:
+                yield from self.iter_entries(self.get_leaf(offset, length))
+
+    def put(self, z: int, x: int, y: int, data: bytes, key: str = None):
+        raise ValueError(f"{self.path} is opened for reading.")
+
+    def remove(self, z: int, x: int, y: int):
+        raise ValueError(f"{self.path} is opened for reading.")
+
+    def close(self):
+        self.file.close()
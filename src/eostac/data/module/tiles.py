@@ -0,0 +1,431 @@
+# Copyright (c) GeoSprite. All rights reserved.
+#
+# Author: Jia Song
+#
+
+import concurrent.futures
+import logging
+import functools
+import math
+import os
+import uuid
+
+import numpy as np
+from osgeo import gdal
+
+from .executor import get_executor, get_max_workers
+from .tile_store import open_tile_store, TileStore
+from .utils import get_bounds, get_color_lut
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+# tiles in a group are rendered by one warp, the group is at most METATILE_SIZE x METATILE_SIZE tiles
+METATILE_SIZE = 8
+WEB_MERCATOR_ORIGIN = 20037508.342789244
+MAX_LATITUDE = 85.0511287798066
+DOWNSAMPLE_RESAMPLINGS = ("near", "average")
+# state of a tile with different pixels, state of a uniform tile is its rgba hex and an empty tile has no state
+DATA_STATE = "data"
+# web viewers written by gdal2tiles, only leaflet.html is written into a tile folder now
+WEB_VIEWERS = ("all", "leaflet", "google", "openlayers", "mapml", "none")
+LEAFLET_HTML = """<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <title>{title}</title>
+  <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+  <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+  <style>html, body, #map {{ width: 100%; height: 100%; margin: 0; }}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+  var map = L.map("map").fitBounds([[{min_y}, {min_x}], [{max_y}, {max_x}]]);
+  L.tileLayer("https://tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png",
+    {{attribution: "&copy; OpenStreetMap contributors"}}).addTo(map);
+  L.tileLayer("./{{z}}/{{x}}/{{y}}.png", {{minZoom: {min_zoom}, maxZoom: {max_zoom}}}).addTo(map);
+</script>
+</body>
+</html>
+"""
+
+MEM_DRIVER = gdal.GetDriverByName("MEM")
+PNG_DRIVER = gdal.GetDriverByName("PNG")
+
+
+def parse_zoom(zoom: str) -> tuple[int, int]:
+    """
+    parse zoom levels like gdal2tiles, "0-10" or "5".
+    """
+    levels = [int(level) for level in str(zoom).split("-")]
+    return min(levels), max(levels)
+
+
+def get_tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """
+    (min_x, min_y, max_x, max_y) of a xyz tile in EPSG:3857.
+    """
+    size = 2 * WEB_MERCATOR_ORIGIN / (1 << z)
+    min_x = -WEB_MERCATOR_ORIGIN + x * size
+    max_y = WEB_MERCATOR_ORIGIN - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+def lng_lat_to_mercator(lng: float, lat: float) -> tuple[float, float]:
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    x = math.radians(lng) * 6378137
+    y = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * 6378137
+    return x, y
+
+
+def get_tile_range(bounds: tuple[float, float, float, float], z: int) -> tuple[int, int, int, int]:
+    """
+    (min_x, min_y, max_x, max_y) of xyz tiles intersecting wgs84 bounds, max is inclusive.
+    """
+    min_x, min_y = lng_lat_to_mercator(bounds[0], bounds[1])
+    max_x, max_y = lng_lat_to_mercator(bounds[2], bounds[3])
+    count = 1 << z
+    size = 2 * WEB_MERCATOR_ORIGIN / count
+
+    def clamp(value):
+        return max(min(value, count - 1), 0)
+
+    tile_min_x = clamp(math.floor((min_x + WEB_MERCATOR_ORIGIN) / size))
+    tile_max_x = clamp(math.ceil((max_x + WEB_MERCATOR_ORIGIN) / size) - 1)
+    tile_min_y = clamp(math.floor((WEB_MERCATOR_ORIGIN - max_y) / size))
+    tile_max_y = clamp(math.ceil((WEB_MERCATOR_ORIGIN - min_y) / size) - 1)
+    return tile_min_x, tile_min_y, tile_max_x, tile_max_y
+
+
+def get_footprints(src_path: str) -> list[tuple[float, float, float, float]]:
+    """
+    wgs84 bounds of every grid in src, a vrt is split into its sources, so the gaps between grids have no tile.
+    """
+    ds = gdal.Open(src_path)
+    file_list = [path for path in ds.GetFileList() or [] if os.path.abspath(path) != os.path.abspath(src_path)]
+    if ds.GetDriver().ShortName != "VRT" or len(file_list) == 0:
+        return [get_bounds(src_path)]
+    return [get_bounds(path) for path in file_list if os.path.isfile(path)]
+
+
+def get_tiles(footprints: list[tuple[float, float, float, float]], z: int) -> set[tuple[int, int]]:
+    tiles = set()
+    for bounds in footprints:
+        min_x, min_y, max_x, max_y = get_tile_range(bounds, z)
+        tiles.update((x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1))
+    return tiles
+
+
+def group_tiles(tiles: set[tuple[int, int]]) -> list[list[tuple[int, int]]]:
+    groups = {}
+    for x, y in sorted(tiles):
+        groups.setdefault((x // METATILE_SIZE, y // METATILE_SIZE), []).append((x, y))
+    return list(groups.values())
+
+
+def encode_tile(tile: np.ndarray) -> bytes:
+    path = f"/vsimem/{uuid.uuid4()}.png"
+    mem_ds = MEM_DRIVER.Create("", TILE_SIZE, TILE_SIZE, 4, gdal.GDT_Byte)
+    for i in range(4):
+        mem_ds.GetRasterBand(i + 1).WriteArray(tile[i])
+    PNG_DRIVER.CreateCopy(path, mem_ds)
+    try:
+        f = gdal.VSIFOpenL(path, "rb")
+        gdal.VSIFSeekL(f, 0, 2)
+        size = gdal.VSIFTellL(f)
+        gdal.VSIFSeekL(f, 0, 0)
+        data = gdal.VSIFReadL(1, size, f)
+        gdal.VSIFCloseL(f)
+        return data
+    finally:
+        gdal.Unlink(path)
+
+
+def decode_tile(data: bytes) -> np.ndarray:
+    path = f"/vsimem/{uuid.uuid4()}.png"
+    gdal.FileFromMemBuffer(path, data)
+    try:
+        return gdal.Open(path).ReadAsArray()
+    finally:
+        gdal.Unlink(path)
+
+
+def get_uniform_tile(key: str) -> np.ndarray:
+    tile = np.empty((4, TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+    tile[:] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)[:, None, None]
+    return tile
+
+
+@functools.lru_cache(maxsize=1024)
+def get_uniform_data(key: str) -> bytes:
+    # a uniform tile is encoded once for each color
+    return encode_tile(get_uniform_tile(key))
+
+
+def get_tile_state(tile: np.ndarray, minimum: np.ndarray, maximum: np.ndarray) -> tuple[str, bytes]:
+    """
+    state and encoded data of a tile by its statistics.
+    fully transparent tiles have no state, uniform tiles are never encoded again.
+    """
+    if maximum[3] == 0:
+        return None, None
+    if (minimum == maximum).all():
+        return minimum.astype(np.uint8).tobytes().hex(), None
+    return DATA_STATE, encode_tile(tile)
+
+
+def save_tile(store: TileStore, z: int, x: int, y: int, state: str, data: bytes):
+    if state is None:
+        store.remove(z, x, y)
+    elif state == DATA_STATE:
+        store.put(z, x, y, data)
+    else:
+        store.put(z, x, y, get_uniform_data(state), key=state)
+
+
+def get_tile_statistics(data: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    min and max of each band of each tile in a (4, rows * TILE_SIZE, cols * TILE_SIZE) array,
+    both have the shape (4, rows, cols).
+    """
+    bands, height, width = data.shape
+    blocks = data.reshape(bands, height // TILE_SIZE, TILE_SIZE, width // TILE_SIZE, TILE_SIZE)
+    return blocks.min(axis=(2, 4)), blocks.max(axis=(2, 4))
+
+
+def warp_rgba(src_path: str, bounds: tuple[float, float, float, float], width: int, height: int,
+              resampling: str) -> np.ndarray:
+    """
+    warp src into EPSG:3857 bounds, returns (4, height, width) rgba array.
+    a paletted src is warped as index with nearest resampling and expanded by its color table.
+    """
+    ds = gdal.Open(src_path)
+    color_table = ds.GetRasterBand(1).GetColorTable() if ds.RasterCount == 1 else None
+    has_alpha = ds.GetRasterBand(ds.RasterCount).GetColorInterpretation() == gdal.GCI_AlphaBand
+    warped = gdal.Warp("", ds, format="MEM", outputBounds=bounds, width=width, height=height,
+                       dstSRS="EPSG:3857", resampleAlg="near" if color_table is not None else resampling,
+                       srcAlpha=has_alpha, dstAlpha=True)
+    data = warped.ReadAsArray()
+    if color_table is None:
+        return data
+
+    index, alpha = data
+    rgba = np.take(get_color_lut(color_table), index, axis=1)
+    np.minimum(rgba[3], alpha, out=rgba[3])
+    return rgba
+
+
+def downsample(children: np.ndarray, resampling: str) -> np.ndarray:
+    """
+    reduce (4, 2 * TILE_SIZE, 2 * TILE_SIZE) children to one (4, TILE_SIZE, TILE_SIZE) tile.
+    """
+    if resampling == "near":
+        return np.ascontiguousarray(children[:, ::2, ::2])
+
+    # average colors weighted by alpha, so transparent pixels do not darken edges
+    blocks = children.reshape(4, TILE_SIZE, 2, TILE_SIZE, 2).astype(np.uint32)
+    alpha = blocks[3]
+    alpha_sum = alpha.sum(axis=(1, 3))
+    tile = np.zeros((4, TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+    valid = alpha_sum > 0
+    for i in range(3):
+        weighted = (blocks[i] * alpha).sum(axis=(1, 3))
+        tile[i][valid] = (weighted[valid] + alpha_sum[valid] // 2) // alpha_sum[valid]
+    tile[3] = (alpha_sum + 2) // 4
+    return tile
+
+
+def render_tile_group(src_path: str, z: int, tiles: list[tuple[int, int]],
+                      resampling: str) -> dict[tuple[int, int], tuple[str, bytes]]:
+    """
+    render tiles of the max zoom from src with one warp, returns the state and encoded data of each tile.
+    """
+    min_tile_x = min(x for x, _ in tiles)
+    max_tile_x = max(x for x, _ in tiles)
+    min_tile_y = min(y for _, y in tiles)
+    max_tile_y = max(y for _, y in tiles)
+    min_x, _, _, max_y = get_tile_bounds(z, min_tile_x, min_tile_y)
+    _, min_y, max_x, _ = get_tile_bounds(z, max_tile_x, max_tile_y)
+    data = warp_rgba(src_path, (min_x, min_y, max_x, max_y),
+                     (max_tile_x - min_tile_x + 1) * TILE_SIZE, (max_tile_y - min_tile_y + 1) * TILE_SIZE, resampling)
+    minimum, maximum = get_tile_statistics(data)
+
+    results = {}
+    for x, y in tiles:
+        row = y - min_tile_y
+        col = x - min_tile_x
+        tile = data[:, row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE]
+        results[(x, y)] = get_tile_state(tile, minimum[:, row, col], maximum[:, row, col])
+    return results
+
+
+def downsample_tile_group(tiles: list[tuple[int, int]], resampling: str, child_states: dict[tuple[int, int], str],
+                          child_data: dict[tuple[int, int], bytes]) -> dict[tuple[int, int], tuple[str, bytes]]:
+    """
+    render parent tiles from their four children instead of reading src again,
+    returns the state and encoded data of each tile.
+
+    Args:
+        child_states: states of non-empty children
+        child_data: encoded data of children whose state is DATA_STATE
+    """
+    results = {}
+    for x, y in tiles:
+        children_data = np.zeros((4, 2 * TILE_SIZE, 2 * TILE_SIZE), dtype=np.uint8)
+        for dy in range(2):
+            for dx in range(2):
+                child = (2 * x + dx, 2 * y + dy)
+                state = child_states.get(child)
+                window = children_data[:, dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE]
+                if state == DATA_STATE:
+                    window[:] = decode_tile(child_data[child])
+                elif state is not None:
+                    window[:] = get_uniform_tile(state)
+
+        tile = downsample(children_data, resampling)
+        minimum, maximum = get_tile_statistics(tile)
+        results[(x, y)] = get_tile_state(tile, minimum[:, 0, 0], maximum[:, 0, 0])
+    return results
+
+
+def get_parent_state(x: int, y: int, child_states: dict[tuple[int, int], str]) -> str:
+    """
+    a parent of empty children is empty and a parent of four same uniform children is the same uniform tile,
+    both of them are decided without reading any child. other parents should be downsampled.
+    """
+    states = {child_states.get((2 * x + dx, 2 * y + dy)) for dy in range(2) for dx in range(2)}
+    if states == {None}:
+        return None
+    if len(states) == 1 and DATA_STATE not in states:
+        return states.pop()
+    return DATA_STATE
+
+
+def write_leaflet_viewer(dest_folder: str, min_zoom: int, max_zoom: int,
+                         bounds: tuple[float, float, float, float]) -> str:
+    """
+    write leaflet.html showing the tiles of folder over openstreetmap, like gdal2tiles --webviewer=leaflet.
+    """
+    path = os.path.join(dest_folder, "leaflet.html")
+    min_x, min_y, max_x, max_y = bounds
+    with open(path, "w") as f:
+        f.write(LEAFLET_HTML.format(title=os.path.basename(os.path.normpath(dest_folder)), min_x=min_x, min_y=min_y,
+                                    max_x=max_x, max_y=max_y, min_zoom=min_zoom, max_zoom=max_zoom))
+    return path
+
+
+def render_xyz_tiles(src_path: str, dest_path: str, min_zoom: int, max_zoom: int, resampling: str = "near",
+                     resume: bool = True, max_workers: int = None,
+                     changed_footprints: list[tuple[float, float, float, float]] = None,
+                     web_viewer: bool = False) -> bool:
+    """
+    render xyz tiles of src in a process pool, or in this process with one worker.
+    tiles of the max zoom are listed from grid footprints and warped from src,
+    tiles of other zooms are downsampled from their children.
+    workers return encoded tiles and only this process writes the tile store.
+
+    when changed footprints are given, only the tiles intersecting them are rendered again at every zoom,
+    and the unchanged children of their parents are read from the existing store.
+
+    Args:
+        src_path: rgba or paletted raster, or a vrt of them
+        dest_path: tile folder of {z}/{x}/{y}.png, or a ".mbtiles" or ".pmtiles" archive
+        resampling: "near" or "average"
+        resume: skip existing tiles
+        max_workers: worker count, None means cpu count
+        changed_footprints: wgs84 bounds of changed grids, include the old bounds of removed grids,
+            so their tiles are cleared. None means all tiles
+        web_viewer: write leaflet.html into a tile folder
+    """
+    if resampling not in DOWNSAMPLE_RESAMPLINGS:
+        raise ValueError(f"resampling should be one of {DOWNSAMPLE_RESAMPLINGS}, but got {resampling}.")
+
+    footprints = get_footprints(src_path)
+    if len(footprints) == 0:
+        logger.info(f"No grid in {src_path}, no tile is rendered.")
+        return False
+    incremental = changed_footprints is not None
+    if incremental:
+        # changed tiles are always rendered again, tiles out of current grids become empty and are removed
+        tiles = get_tiles(changed_footprints, max_zoom)
+        resume = False
+        logger.info(f"{len(changed_footprints)} grids changed, render {len(tiles)} tiles of zoom {max_zoom} again.")
+    else:
+        tiles = get_tiles(footprints, max_zoom)
+    # tile groups in flight are bounded, so encoded tiles of a whole zoom are never held at once
+    max_pending = get_max_workers(max_workers) * 4
+    states = {}
+    try:
+        mode = "a" if resume or incremental else "w"
+        # a single worker renders in this process, like a task running in a pool of task graph
+        executor_name = "serial" if get_max_workers(max_workers) == 1 else "process"
+        all_bounds = [min(bounds[0] for bounds in footprints), min(bounds[1] for bounds in footprints),
+                      max(bounds[2] for bounds in footprints), max(bounds[3] for bounds in footprints)]
+        with open_tile_store(dest_path, mode) as store, get_executor(executor_name, max_workers) as executor:
+            store.set_metadata({
+                "name": os.path.basename(os.path.normpath(dest_path)), "format": "png", "type": "overlay",
+                "minzoom": min_zoom, "maxzoom": max_zoom, "bounds": all_bounds,
+                "center": [(all_bounds[0] + all_bounds[2]) / 2, (all_bounds[1] + all_bounds[3]) / 2, min_zoom],
+            })
+
+            for z in range(max_zoom, min_zoom - 1, -1):
+                child_states = states
+                states = {}
+                if z != max_zoom:
+                    child_tiles = tiles
+                    tiles = {(x // 2, y // 2) for x, y in tiles}
+                    if incremental:
+                        # siblings of changed tiles keep their existing data
+                        for x, y in tiles:
+                            for child in [(2 * x + dx, 2 * y + dy) for dy in range(2) for dx in range(2)]:
+                                if child not in child_tiles and store.has(z + 1, *child):
+                                    child_states[child] = DATA_STATE
+
+                pending_tiles = []
+                for x, y in sorted(tiles):
+                    if resume and store.has(z, x, y):
+                        states[(x, y)] = DATA_STATE
+                        continue
+                    state = DATA_STATE if z == max_zoom else get_parent_state(x, y, child_states)
+                    if state != DATA_STATE:
+                        save_tile(store, z, x, y, state, None)
+                        if state is not None:
+                            states[(x, y)] = state
+                        continue
+                    pending_tiles.append((x, y))
+
+                futures = {}
+                done = len(tiles) - len(pending_tiles)
+
+                def save_done(return_when):
+                    nonlocal done
+                    finished, _ = concurrent.futures.wait(futures, return_when=return_when)
+                    for future in finished:
+                        done += futures.pop(future)
+                        for (x, y), (state, data) in future.result().items():
+                            save_tile(store, z, x, y, state, data)
+                            if state is not None:
+                                states[(x, y)] = state
+                    logger.info(f"Zoom {z}: {done}/{len(tiles)} tiles processed, {len(states)} tiles are not empty.")
+
+                for group in group_tiles(set(pending_tiles)):
+                    if len(futures) >= max_pending:
+                        save_done(concurrent.futures.FIRST_COMPLETED)
+                    if z == max_zoom:
+                        future = executor.submit(render_tile_group, src_path, z, group, resampling)
+                    else:
+                        children = [(2 * x + dx, 2 * y + dy) for x, y in group for dy in range(2) for dx in range(2)]
+                        group_states = {child: child_states[child] for child in children if child in child_states}
+                        group_data = {child: store.get(z + 1, *child) for child, state in group_states.items()
+                                      if state == DATA_STATE}
+                        future = executor.submit(downsample_tile_group, group, resampling, group_states, group_data)
+                    futures[future] = len(group)
+                save_done(concurrent.futures.ALL_COMPLETED)
+    except Exception:
+        # a failed archive is aborted, it never replaces the last archive
+        logger.exception(f"Render tiles in {dest_path} failed.")
+        return False
+    if web_viewer and os.path.isdir(dest_path):
+        write_leaflet_viewer(dest_path, min_zoom, max_zoom, all_bounds)
+    return True
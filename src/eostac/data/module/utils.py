@@ -1,3 +1,4 @@
+import numpy as np
 from osgeo import ogr, osr, gdal
 
 
@@ -6,6 +7,17 @@ def get_suffix_by_driver(driver_name: str):
     return drive.GetMetadataItem(gdal.DMD_EXTENSIONS).split(' ')[0]
 
 
+def get_color_lut(color_table: gdal.ColorTable) -> np.ndarray:
+    """
+    convert color table to a (4, 256) rgba lookup table, index out of color table is transparent.
+    it is the same with gdal rgba expansion.
+    """
+    color_lut = np.zeros((4, 256), dtype=np.uint8)
+    for i in range(min(color_table.GetCount(), 256)):
+        color_lut[:, i] = color_table.GetColorEntry(i)
+    return color_lut
+
+
 def get_block_geom(min_x, max_x, min_y, max_y):
     point1 = min_x, max_y
     point2 = max_x, max_y
@@ -40,3 +52,43 @@ def get_srs_from_epsg(epsg: int) -> osr.SpatialReference:
     srs.SetAxisMappingStrategy(0)
     srs.ImportFromEPSG(epsg)
     return srs
+
+
+def get_bounds(path: str, epsg: int = 4326) -> tuple[float, float, float, float]:
+    """
+    get (min_x, min_y, max_x, max_y) of a raster in the given epsg without reading pixels.
+    """
+    ds = gdal.Open(path)
+    geo_transform = ds.GetGeoTransform()
+    x1 = geo_transform[0]
+    y1 = geo_transform[3]
+    x2 = x1 + geo_transform[1] * ds.RasterXSize
+    y2 = y1 + geo_transform[5] * ds.RasterYSize
+    bounds = min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+    src_srs = ds.GetSpatialRef()
+    dest_srs = get_srs_from_epsg(epsg)
+    if src_srs is None or src_srs.IsSame(dest_srs):
+        return bounds
+    src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src_srs, dest_srs)
+    # densify edges, because straight edges are curves in another projection
+    return transform.TransformBounds(*bounds, 21)
+
+
+def is_intersect(bounds1: tuple[float, float, float, float], bounds2: tuple[float, float, float, float]) -> bool:
+    return bounds1[0] < bounds2[2] and bounds2[0] < bounds1[2] and bounds1[1] < bounds2[3] and bounds2[1] < bounds1[3]
+
+
+def ensure_overviews(path: str, levels: list[int], resampling: str = "NEAREST") -> bool:
+    """
+    build overviews for a raster without any, returns whether overviews are built.
+    dataset is opened in read only mode, so overviews are written into an external .ovr file.
+    """
+    ds = gdal.Open(path)
+    if ds is None or ds.GetDriver().ShortName == "VRT" or len(levels) == 0:
+        return False
+    if ds.GetRasterBand(1).GetOverviewCount() > 0:
+        return False
+    ds.BuildOverviews(resampling, levels)
+    return True
@@ -3,10 +3,14 @@
 # Author: Jia Song
 #
 import argparse
+import glob
 import os
 
-from eostac.data.module import RasterImageProcessOptions, ReProjection, WGS84Grid, Thumbnail, \
+from eostac.data.module.pipeline import TaskGraph, add_stage_task
+from eostac.data.module.presence import PresenceProduct
+from eostac.data.module.task import RasterImageProcessOptions, ReProjection, WGS84Grid, Thumbnail, \
     ColorRamp, XYZTiles
+from eostac.data.module.utils import get_bounds, is_intersect
 
 
 def parse_args():
@@ -22,85 +26,171 @@ def parse_args():
     parser.add_argument('-f', "--name_format", help="grid name format with two place holder", type=str, required=True)
     parser.add_argument('-c', "--color_file_path", help="color ramp file in qgis", type=str, required=True)
     parser.add_argument('-z', '--zoom', help='zoom levels', type=str, default="0-2")
+    parser.add_argument('-e', '--executor', help='serial, thread or process', type=str, default="serial")
+    parser.add_argument('-w', '--max_workers', help='worker count, default is cpu count', type=int, default=None)
+    parser.add_argument('--cog', help='write grids and color grids as cloud optimized geotiff', action="store_true")
+    parser.add_argument('-t', '--tile_format', help='folder, mbtiles or pmtiles', type=str, default="folder")
 
     return parser.parse_args()
 
 
-def raw_to_grid(raw_folder: str, wgs84_folder: str, grid_folder: str, grid_shp_path: str, name_format: str):
+def add_raw_to_grid(graph: TaskGraph, raw_folder: str | list[str], wgs84_folder: str, grid_folder: str,
+                    grid_shp_path: str, name_format: str, driver_name: str = "GTiff") -> dict[str, str]:
     """
+    add reprojection and grid nodes into graph.
+    a grid is cut as soon as the raw files intersecting it are reprojected.
+
     Args:
-        raw_folder: raw data foldr
-        wgs84_folder: wgs84 data folder
-        grid_folder: grid data folder
-        grid_shp_path: grid shapefile path
-        name_format: grid name format
+        driver_name: driver of grids, "COG" makes cloud optimized geotiff
+
+    Returns:
+        a dict from grid path to the node name which produces it
     """
     # re projection
     wgs84_epsg = 4326
-    projection = ReProjection(RasterImageProcessOptions(src_path=[raw_folder], dest_folder=wgs84_folder),
+    src_path = raw_folder if isinstance(raw_folder, list) else [raw_folder]
+    projection = ReProjection(RasterImageProcessOptions(src_path=src_path, dest_folder=wgs84_folder),
                               output_epsg=wgs84_epsg)
-    if projection() is False or len(projection.all_dest) == 0:
-        return
+    projection_nodes = []
+    for src_in_task, dest_in_task, task_args in projection.tasks:
+        node = add_stage_task(graph, projection, src_in_task, dest_in_task, task_args)
+        projection_nodes.append((get_bounds(src_in_task[0], wgs84_epsg), dest_in_task[0], node))
 
-    # WGS84 grids
-    projection_vrt_path = projection.build_vrt()
-    wgs84_grid = WGS84Grid(RasterImageProcessOptions(src_path=[projection_vrt_path], dest_folder=grid_folder),
+    # WGS84 grids, each grid only depends on the reprojected files it intersects
+    wgs84_grid = WGS84Grid(RasterImageProcessOptions(src_path=[], dest_folder=grid_folder, driver_name=driver_name),
                            grid_shp_path=grid_shp_path, name_format=name_format)
-    if wgs84_grid() is False or len(wgs84_grid.all_dest) == 0:
-        os.remove(projection_vrt_path)
-        return
-    os.remove(projection_vrt_path)
-
+    grid_nodes = {}
+    for _, dest_in_task, task_args in wgs84_grid.tasks:
+        lng_min, lat_max, lng_max, lat_min = task_args["projWin"]
+        deps = [(path, node) for bounds, path, node in projection_nodes
+                if is_intersect(bounds, (lng_min, lat_min, lng_max, lat_max))]
+        if len(deps) == 0:
+            continue
+        vrt_path = os.path.splitext(dest_in_task[0])[0] + ".vrt"
+        grid_nodes[dest_in_task[0]] = add_stage_task(graph, wgs84_grid, [path for path, _ in deps], dest_in_task,
+                                                     task_args, deps=[node for _, node in deps], vrt_path=vrt_path)
+    return grid_nodes
+
+
+def add_grid_to_tile(graph: TaskGraph, grid_nodes: dict[str, str], color_folder: str, color_file_path: str,
+                     thumbnail_folder: str, tile_folder: str, zoom: str, driver_name: str = "GTiff",
+                     grid_thumbnail_percent: float = 5, mosaic_thumbnail_percent: float = 1,
+                     tile_format: str = "folder", changed_grids: list[str] = None,
+                     presence: PresenceProduct = None):
+    """
+    add color, thumbnail and tile nodes into graph.
 
-def grid_to_tile(grid_folder: str, color_folder: str, color_file_path: str, thumbnail_folder: str, tile_folder: str,
-                 zoom: str):
+    Args:
+        grid_nodes: a dict from grid path to the node name which produces it, None means the grid already exists
+        driver_name: driver of color grids, "COG" makes cloud optimized geotiff
+        grid_thumbnail_percent: size of each grid thumbnail in percent of grid
+        mosaic_thumbnail_percent: size of all grid thumbnail in percent of grids
+        tile_format: "folder" of {z}/{x}/{y}.png, or a single "mbtiles" or "pmtiles" archive in tile folder
+        changed_grids: grids whose tiles are rendered again, other tiles are kept if their grids are unchanged
+        presence: grids are presence cubes, and the tiles are rendered from this product derived from them
+    """
     # color map
-    color_ramp = ColorRamp(RasterImageProcessOptions(src_path=[grid_folder], dest_folder=color_folder),
-                           color_file_path=color_file_path)
-    if color_ramp() is False or len(color_ramp.all_dest) == 0:
-        return
-
+    color_ramp = ColorRamp(RasterImageProcessOptions(src_path=[], dest_folder=color_folder, driver_name=driver_name),
+                           color_file_path=color_file_path, presence=presence)
     # thumbnail of each grid
     each_thumbnail = Thumbnail(
-        RasterImageProcessOptions(src_path=[color_folder], dest_folder=thumbnail_folder, driver_name="PNG"),
-        width_percent=5, height_percent=5)
-    if each_thumbnail() is False or len(each_thumbnail.all_dest) == 0:
+        RasterImageProcessOptions(src_path=[], dest_folder=thumbnail_folder, driver_name="PNG"),
+        width_percent=grid_thumbnail_percent, height_percent=grid_thumbnail_percent)
+
+    color_nodes = {}
+    thumbnail_nodes = {}
+    for grid_path, grid_node in grid_nodes.items():
+        color_dest = color_ramp.get_dest_paths(grid_path)
+        color_node = add_stage_task(graph, color_ramp, [grid_path], color_dest, {}, deps=[grid_node])
+        color_nodes[color_dest[0]] = color_node
+        thumbnail_dest = each_thumbnail.get_dest_paths(color_dest[0])
+        thumbnail_nodes[thumbnail_dest[0]] = add_stage_task(graph, each_thumbnail, color_dest, thumbnail_dest, {},
+                                                            deps=[color_node])
+    if len(color_nodes) == 0:
         return
 
-    # thumbnail of all grid
-    color_vrt_filename = "all_thumbnail.vrt"
-    color_vrt_path = color_ramp.build_vrt(filename=color_vrt_filename)
+    # thumbnail of all grid is read from the overviews of color grids, which the thumbnail of each grid builds.
+    # png thumbnails are not used, they are georeferenced only by .aux.xml files removed after every run
     all_thumbnail = Thumbnail(
-        RasterImageProcessOptions(src_path=[color_vrt_path], dest_folder=thumbnail_folder, driver_name="PNG"),
-        width_percent=1, height_percent=1)
-    if all_thumbnail() is False or len(all_thumbnail.all_dest) == 0:
-        return
+        RasterImageProcessOptions(src_path=[], dest_folder=thumbnail_folder, driver_name="PNG"),
+        width_percent=mosaic_thumbnail_percent, height_percent=mosaic_thumbnail_percent, build_overviews=False)
+    color_vrt_path = os.path.join(color_folder, "all_thumbnail.vrt")
+    all_thumbnail_dest = all_thumbnail.get_dest_paths(color_vrt_path)
+    add_stage_task(graph, all_thumbnail, list(color_nodes), all_thumbnail_dest, {},
+                   deps=list(color_nodes.values()) + list(thumbnail_nodes.values()), vrt_path=color_vrt_path)
 
     # XYZ google Tiles
-    color_vrt_path = color_ramp.build_vrt()
-    xyz_tiles = XYZTiles(RasterImageProcessOptions(src_path=[color_vrt_path], dest_folder=tile_folder), zoom=zoom)
-    if xyz_tiles() is False or len(xyz_tiles.all_dest) == 0:
-        os.remove(color_vrt_path)
-        return
-    os.remove(color_vrt_path)
+    # tiles are made of color grids, so changed grids are mapped to their color grids
+    changed_colors = [color_ramp.get_dest_paths(path)[0] for path in changed_grids or []]
+    # tile tasks in a pool of graph render with one worker, otherwise each of them would start a pool of cpu count
+    processes = graph.max_workers if graph.executor == "serial" else 1
+    xyz_tiles = XYZTiles(RasterImageProcessOptions(src_path=[], dest_folder=tile_folder), zoom=zoom,
+                         processes=processes, tile_format=tile_format, changed_grids=changed_colors)
+    # thumbnails build overviews of color grids, so tiles wait for them instead of reading grids being changed
+    for _, dest_in_task, task_args in xyz_tiles.tasks:
+        add_stage_task(graph, xyz_tiles, list(color_nodes), dest_in_task, task_args,
+                       deps=list(color_nodes.values()) + list(thumbnail_nodes.values()),
+                       vrt_path=os.path.join(color_folder, "tiles.vrt"))
+
+
+def find_grid_nodes(grid_folder: str, input_suffix: str = "tif") -> dict[str, None]:
+    """
+    existing grids have no node to wait for.
+    """
+    return {path: None for path in glob.iglob(os.path.join(grid_folder, f"*.{input_suffix}"))}
 
 
+def raw_to_grid(raw_folder: str, wgs84_folder: str, grid_folder: str, grid_shp_path: str, name_format: str,
+                executor: str = "serial", max_workers: int = None, driver_name: str = "GTiff"):
+    """
+    Args:
+        raw_folder: raw data foldr
+        wgs84_folder: wgs84 data folder
+        grid_folder: grid data folder
+        grid_shp_path: grid shapefile path
+        name_format: grid name format
+        executor: executor of graph, "serial", "thread" or "process"
+        max_workers: worker count of executor
+        driver_name: driver of grids, "COG" makes cloud optimized geotiff
+    """
+    graph = TaskGraph(executor=executor, max_workers=max_workers)
+    add_raw_to_grid(graph, raw_folder=raw_folder, wgs84_folder=wgs84_folder, grid_folder=grid_folder,
+                    grid_shp_path=grid_shp_path, name_format=name_format, driver_name=driver_name)
+    return graph.run()
+
+
+def grid_to_tile(grid_folder: str, color_folder: str, color_file_path: str, thumbnail_folder: str, tile_folder: str,
+                 zoom: str, executor: str = "serial", max_workers: int = None, driver_name: str = "GTiff",
+                 tile_format: str = "folder"):
+    graph = TaskGraph(executor=executor, max_workers=max_workers)
+    add_grid_to_tile(graph, grid_nodes=find_grid_nodes(grid_folder), color_folder=color_folder,
+                     color_file_path=color_file_path, thumbnail_folder=thumbnail_folder, tile_folder=tile_folder,
+                     zoom=zoom, driver_name=driver_name, tile_format=tile_format)
+    return graph.run()
 
 
 def main():
     args = parse_args()
 
-    raw_to_grid(raw_folder=args.raw_folder,
-                wgs84_folder=args.wgs84_folder,
-                grid_folder=args.grid_folder,
-                grid_shp_path=args.grid_shp_path,
-                name_format=args.name_format)
-    grid_to_tile(grid_folder=args.grid_folder,
-                 color_folder=args.color_folder,
-                 color_file_path=args.color_file_path,
-                 thumbnail_folder=args.thumbnail_folder,
-                 tile_folder=args.tile_folder,
-                 zoom=args.zoom)
+    # one graph, so the colors and tiles of a grid start right after it is cut
+    graph = TaskGraph(executor=args.executor, max_workers=args.max_workers)
+    grid_nodes = add_raw_to_grid(graph,
+                                 raw_folder=args.raw_folder,
+                                 wgs84_folder=args.wgs84_folder,
+                                 grid_folder=args.grid_folder,
+                                 grid_shp_path=args.grid_shp_path,
+                                 name_format=args.name_format,
+                                 driver_name="COG" if args.cog else "GTiff")
+    add_grid_to_tile(graph,
+                     grid_nodes=grid_nodes,
+                     color_folder=args.color_folder,
+                     color_file_path=args.color_file_path,
+                     thumbnail_folder=args.thumbnail_folder,
+                     tile_folder=args.tile_folder,
+                     zoom=args.zoom,
+                     driver_name="COG" if args.cog else "GTiff",
+                     tile_format=args.tile_format)
+    graph.run()
 
 
 if __name__ == '__main__':
@@ -9,4 +9,6 @@ python water_distribution_analysis.py \
 -i /mnt/disk/xials/hkh/grid_data/water_distribution \
 -o1 /mnt/disk/xials/hkh/grid_data/water_distribution_change \
 -o2 /mnt/disk/xials/hkh/grid_data/water_distribution_statistics \
--o3 /mnt/disk/xials/hkh/api_data/water_distribution
+-o3 /mnt/disk/xials/hkh/api_data/water_distribution \
+-o4 /mnt/disk/xials/hkh/grid_data/water_distribution_presence \
+--combinations
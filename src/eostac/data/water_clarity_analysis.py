@@ -1,7 +1,8 @@
 import argparse
 import os
 import itertools
-from geosprite.stac.data.module import RasterImageProcessOptions, Calc
+from eostac.data.module import RasterImageProcessOptions, Calc, CalcOutput, GridIndex, build_histogram, \
+    build_spatial_index, build_vrt_overviews
 
 
 def parse_arg():
@@ -11,72 +12,79 @@ def parse_arg():
     parser.add_argument("-o2", "--change_api_folder", type=str, required=True)
     parser.add_argument('-o3', '--statistics_folder', help='destination Folder', type=str, required=True)
     parser.add_argument("-o4", "--statistics_api_folder", type=str, required=True)
+    parser.add_argument('--cog', help='write output as cloud optimized geotiff', action="store_true")
     return parser.parse_args()
 
 
-def clarity_change():
-    args = parse_arg()
-    years = [year for year in os.listdir(args.water_clarity_folder) if
-             os.path.isdir(os.path.join(args.water_clarity_folder, year))]
+def get_years(water_clarity_folder: str) -> list[str]:
+    return sorted(year for year in os.listdir(water_clarity_folder) if
+                  os.path.isdir(os.path.join(water_clarity_folder, year)))
 
-    for pair in itertools.combinations(years, 2):
-        src_path = [os.path.join(args.water_clarity_folder, year) for year in pair]
-        dest_folder = os.path.join(args.change_folder, f"{pair[0]}-{pair[1]}")
-        calc = Calc(
-            RasterImageProcessOptions(src_path=src_path, dest_folder=dest_folder),
-            calc="B-A", output_type="Float32", hide_nodata=False)
-        calc()
+
+def get_grid_index(water_clarity_folder: str) -> GridIndex:
+    """
+    one scan of every year folder, shared by all pairs and years.
+    """
+    years = get_years(water_clarity_folder)
+    return GridIndex([os.path.join(water_clarity_folder, year) for year in years])
 
 
-def clarity_change_api():
+def clarity_change(grid_index: GridIndex = None):
+    """
+    change and its api of every pair of years from one read of the two years.
+    """
     args = parse_arg()
-    years = [year for year in os.listdir(args.water_clarity_folder) if
-             os.path.isdir(os.path.join(args.water_clarity_folder, year))]
+    years = get_years(args.water_clarity_folder)
+    grid_index = grid_index or get_grid_index(args.water_clarity_folder)
 
     for pair in itertools.combinations(years, 2):
         src_path = [os.path.join(args.water_clarity_folder, year) for year in pair]
-        dest_folder = os.path.join(args.change_api_folder, f"{pair[0]}-{pair[1]}")
+        change_folder = os.path.join(args.change_folder, f"{pair[0]}-{pair[1]}")
+        change_api_folder = os.path.join(args.change_api_folder, f"{pair[0]}-{pair[1]}")
         calc = Calc(
-            RasterImageProcessOptions(src_path=src_path, dest_folder=dest_folder),
-            calc="2*(B>=A)+(B<A)", output_type="Byte", hide_nodata=False)
+            RasterImageProcessOptions(src_path=src_path, dest_folder=change_folder,
+                                      driver_name="COG" if args.cog else "GTiff"),
+            outputs=[CalcOutput(calc="B-A", dest_folder=change_folder, output_type="Float32"),
+                     CalcOutput(calc="2*(B>=A)+(B<A)", dest_folder=change_api_folder, output_type="Byte")],
+            hide_nodata=False, grid_index=grid_index)
         calc()
-        calc.build_vrt("api.vrt")
+        vrt_path = calc.build_vrt("api.vrt", change_api_folder)
+        build_vrt_overviews(vrt_path)
+        build_histogram(vrt_path)
+        build_spatial_index(vrt_path)
 
 
-def clarity_statistics():
+def clarity_statistics(grid_index: GridIndex = None):
+    """
+    statistics and its api of every year from one read of the year.
+    """
     args = parse_arg()
-    years = [year for year in os.listdir(args.water_clarity_folder) if
-             os.path.isdir(os.path.join(args.water_clarity_folder, year))]
+    years = get_years(args.water_clarity_folder)
+    grid_index = grid_index or get_grid_index(args.water_clarity_folder)
 
     for year in years:
         src_path = [os.path.join(args.water_clarity_folder, year)]
-        dest_folder = os.path.join(args.statistics_folder, year)
+        statistics_folder = os.path.join(args.statistics_folder, year)
+        statistics_api_folder = os.path.join(args.statistics_api_folder, year)
         calc = Calc(
-            RasterImageProcessOptions(src_path=src_path, dest_folder=dest_folder),
-            calc="A*(A>0.5)", output_type="Float32", hide_nodata=False)
+            RasterImageProcessOptions(src_path=src_path, dest_folder=statistics_folder,
+                                      driver_name="COG" if args.cog else "GTiff"),
+            outputs=[CalcOutput(calc="A*(A>0.5)", dest_folder=statistics_folder, output_type="Float32"),
+                     CalcOutput(calc="(A>=0.5)+(A>0)", dest_folder=statistics_api_folder, output_type="Byte")],
+            hide_nodata=False, grid_index=grid_index)
         calc()
-
-
-def clarity_statistics_api():
-    args = parse_arg()
-    years = [year for year in os.listdir(args.water_clarity_folder) if
-             os.path.isdir(os.path.join(args.water_clarity_folder, year))]
-
-    for year in years:
-        src_path = [os.path.join(args.water_clarity_folder, year)]
-        dest_folder = os.path.join(args.statistics_api_folder, year)
-        calc = Calc(
-            RasterImageProcessOptions(src_path=src_path, dest_folder=dest_folder),
-            calc="(A>=0.5)+(A>0)", output_type="Byte", hide_nodata=False)
-        calc()
-        calc.build_vrt("api.vrt")
+        vrt_path = calc.build_vrt("api.vrt", statistics_api_folder)
+        build_vrt_overviews(vrt_path)
+        build_histogram(vrt_path)
+        build_spatial_index(vrt_path)
 
 
 def main():
-    clarity_change()
-    clarity_change_api()
-    clarity_statistics()
-    clarity_statistics_api()
+    args = parse_arg()
+    grid_index = get_grid_index(args.water_clarity_folder)
+    grid_index.report_mismatches(args.water_clarity_folder)
+    clarity_change(grid_index)
+    clarity_statistics(grid_index)
 
 
 if __name__ == "__main__":
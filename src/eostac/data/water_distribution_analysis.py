@@ -1,9 +1,9 @@
 import argparse
 import os
 import itertools
-from geosprite.stac.data.module import RasterImageProcessOptions, Calc
-import shutil
-from osgeo import gdal
+from eostac.data.module import RasterImageProcessOptions, Calc, CalcOutput, PresenceCube, GridIndex, \
+    PRESENCE_YEARS_KEY, PUBLISH_MODES, API_OVERVIEW_LEVELS, build_histogram, build_spatial_index, publish_files, \
+    publish_vrt
 
 
 def parse_arg():
@@ -12,76 +12,119 @@ def parse_arg():
     parser.add_argument('-o1', '--change_folder', help='destination Folder', type=str, required=True)
     parser.add_argument('-o2', '--statistics_folder', help='destination Folder', type=str, required=True)
     parser.add_argument('-o3', '--api_folder', help='destination Folder', type=str, required=True)
+    parser.add_argument('-o4', '--presence_folder', help='destination Folder of presence cubes, '
+                                                         'no cube is built when it is missing',
+                        type=str, default=None)
+    parser.add_argument('--cog', help='write output as cloud optimized geotiff', action="store_true")
+    parser.add_argument('--combinations', help='also write change and statistics of every year combination',
+                        action="store_true")
+    parser.add_argument('--publish', help='publish grids into statistics and api folders by hardlink or reflink, '
+                                          'by vrt of the original grids, or by copy',
+                        type=str, choices=PUBLISH_MODES, default="link")
     return parser.parse_args()
 
 
-def distribution_change():
-    args = parse_arg()
-    years = [year for year in os.listdir(args.water_distribution_folder) if
-             os.path.isdir(os.path.join(args.water_distribution_folder, year))]
+def get_years(water_distribution_folder: str) -> list[str]:
+    return sorted(year for year in os.listdir(water_distribution_folder) if
+                  os.path.isdir(os.path.join(water_distribution_folder, year)))
+
 
-    for pair in itertools.combinations(years, 2):
-        src_path = [os.path.join(args.water_distribution_folder, year) for year in pair]
-        dest_folder = os.path.join(args.change_folder, f"{pair[0]}-{pair[1]}")
-        calc = Calc(
-            RasterImageProcessOptions(src_path=src_path, dest_folder=dest_folder, overwrite=False),
-            calc="A+2*B", output_type="Byte", hide_nodata=True)
-        calc()
+def get_grid_index(water_distribution_folder: str) -> GridIndex:
+    """
+    one scan of every year folder, shared by all steps.
+    """
+    years = get_years(water_distribution_folder)
+    return GridIndex([os.path.join(water_distribution_folder, year) for year in years])
 
 
-def distribution_statistics():
+def distribution_combination(grid_index: GridIndex = None):
+    """
+    change of every pair and statistics of every pair and triple of years in one pass,
+    each grid of each year is read once instead of once for each combination.
+    """
+    args = parse_arg()
+    years = get_years(args.water_distribution_folder)
+    grid_index = grid_index or get_grid_index(args.water_distribution_folder)
+
+    outputs = []
+    for pair in itertools.combinations(range(len(years)), 2):
+        name = "-".join(years[i] for i in pair)
+        outputs.append(CalcOutput(calc="A+2*B", dest_folder=os.path.join(args.change_folder, name),
+                                  output_type="Byte", inputs=pair))
+        outputs.append(CalcOutput(calc="A+B", dest_folder=os.path.join(args.statistics_folder, name),
+                                  output_type="Byte", inputs=pair))
+    for triple in itertools.combinations(range(len(years)), 3):
+        name = "-".join(years[i] for i in triple)
+        outputs.append(CalcOutput(calc="A+B+C", dest_folder=os.path.join(args.statistics_folder, name),
+                                  output_type="Byte", inputs=triple))
+
+    src_path = [os.path.join(args.water_distribution_folder, year) for year in years]
+    calc = Calc(
+        RasterImageProcessOptions(src_path=src_path, dest_folder=args.statistics_folder, overwrite=False,
+                                  driver_name="COG" if args.cog else "GTiff"),
+        outputs=outputs, hide_nodata=True, grid_index=grid_index)
+    calc()
+
+
+def distribution_statistics(grid_index: GridIndex = None):
     args = parse_arg()
-    years = [year for year in os.listdir(args.water_distribution_folder) if
-             os.path.isdir(os.path.join(args.water_distribution_folder, year))]
+    years = get_years(args.water_distribution_folder)
+    grid_index = grid_index or get_grid_index(args.water_distribution_folder)
 
     for year in years:
         src_path = os.path.join(args.water_distribution_folder, year)
         dest_folder = os.path.join(args.statistics_folder, year)
-        os.makedirs(dest_folder, exist_ok=True)
-        for file in os.listdir(src_path):
-            src_file_path = os.path.join(src_path, file)
-            dest_file_path = os.path.join(dest_folder, file)
-            shutil.copy(src_file_path, dest_file_path)
-
-    for pair in itertools.combinations(years, 2):
-        src_path = [os.path.join(args.water_distribution_folder, year) for year in pair]
-        dest_folder = os.path.join(args.statistics_folder, f"{pair[0]}-{pair[1]}")
-        calc = Calc(
-            RasterImageProcessOptions(src_path=src_path, dest_folder=dest_folder),
-            calc="A+B", output_type="Byte", hide_nodata=True)
-        calc()
-
-    for pair in itertools.combinations(years, 3):
-        src_path = [os.path.join(args.water_distribution_folder, year) for year in pair]
-        dest_folder = os.path.join(args.statistics_folder, f"{pair[0]}-{pair[1]}-{pair[2]}")
-        calc = Calc(
-            RasterImageProcessOptions(src_path=src_path, dest_folder=dest_folder),
-            calc="A+B+C", output_type="Byte", hide_nodata=True)
-        calc()
-
-
-def distribution_api():
+        # statistics are read as grid files, so they are linked even in vrt mode
+        publish_files(grid_index.get_folder_paths(src_path), dest_folder, args.publish)
+
+
+def distribution_presence(grid_index: GridIndex = None):
+    """
+    one presence cube per grid with a bit for every year, a new year is appended to the existing cubes.
+    change and statistics of any years are derived from the cubes on demand.
+    """
     args = parse_arg()
-    years = [year for year in os.listdir(args.water_distribution_folder) if
-             os.path.isdir(os.path.join(args.water_distribution_folder, year))]
+    years = get_years(args.water_distribution_folder)
+    grid_index = grid_index or get_grid_index(args.water_distribution_folder)
+
+    src_path = [os.path.join(args.water_distribution_folder, year) for year in years]
+    presence = PresenceCube(
+        RasterImageProcessOptions(src_path=src_path, dest_folder=args.presence_folder,
+                                  driver_name="COG" if args.cog else "GTiff"),
+        years=years, grid_index=grid_index)
+    presence()
+
+    cube_paths = [path for path in presence.all_dest if os.path.isfile(path)]
+    vrt_path = publish_vrt(cube_paths, os.path.join(args.api_folder, "presence", "api.vrt"), args.publish,
+                           {PRESENCE_YEARS_KEY: ",".join(years)}, API_OVERVIEW_LEVELS)
+    # histograms of cube values, products of any years are counted by deriving the classes
+    build_histogram(vrt_path)
+    build_spatial_index(vrt_path)
+
+
+def distribution_api(grid_index: GridIndex = None):
+    args = parse_arg()
+    years = get_years(args.water_distribution_folder)
+    grid_index = grid_index or get_grid_index(args.water_distribution_folder)
 
     for year in years:
         src_path = os.path.join(args.water_distribution_folder, year)
-        dest_folder = os.path.join(args.api_folder, year)
-        os.makedirs(dest_folder, exist_ok=True)
-        dest_files = []
-        for file in os.listdir(src_path):
-            src_file_path = os.path.join(src_path, file)
-            dest_file_path = os.path.join(dest_folder, file)
-            shutil.copy(src_file_path, dest_file_path)
-            dest_files.append(dest_file_path)
-        gdal.BuildVRT(os.path.join(dest_folder, "api.vrt"), dest_files)
+        vrt_path = publish_vrt(grid_index.get_folder_paths(src_path), os.path.join(args.api_folder, year, "api.vrt"),
+                               args.publish, overview_levels=API_OVERVIEW_LEVELS)
+        build_histogram(vrt_path)
+        build_spatial_index(vrt_path)
 
 
 def main():
-    distribution_change()
-    distribution_statistics()
-    distribution_api()
+    args = parse_arg()
+    grid_index = get_grid_index(args.water_distribution_folder)
+    grid_index.report_mismatches(args.water_distribution_folder)
+    if args.presence_folder is not None:
+        distribution_presence(grid_index)
+    if args.combinations:
+        distribution_combination(grid_index)
+    distribution_statistics(grid_index)
+    distribution_api(grid_index)
 
 
 if __name__ == "__main__":
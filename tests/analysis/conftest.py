@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+# modules of lambda are imported flat like in its image, presence module is copied into it
+SRC_FOLDER = os.path.join(os.path.dirname(__file__), "..", "..", "src", "eostac")
+sys.path.insert(0, os.path.join(SRC_FOLDER, "analysis"))
+sys.path.insert(1, os.path.join(SRC_FOLDER, "data", "module"))
+
+ORIGIN = (96.0, 33.0)
+RESOLUTION = 0.001
+NODATA = 3
+
+
+@pytest.fixture
+def class_tif(tmp_path) -> str:
+    """
+    a tiled byte grid of classes 0 to 2 with nodata 3, in EPSG:4326.
+    """
+    data = np.random.default_rng(0).integers(0, 4, size=(600, 500), dtype=np.uint8)
+    path = str(tmp_path / "grid.tif")
+    with rasterio.open(path, "w", driver="GTiff", width=500, height=600, count=1, dtype="uint8", crs="EPSG:4326",
+                       transform=from_origin(*ORIGIN, RESOLUTION, RESOLUTION), nodata=NODATA, tiled=True,
+                       blockxsize=128, blockysize=128) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def write_vrt(vrt_path: str, src: rasterio.DatasetReader, source_path: str):
+    """
+    a vrt of one grid, like api.vrt published by the pipeline.
+    """
+    with open(vrt_path, "w") as f:
+        f.write(f"""<VRTDataset rasterXSize="{src.width}" rasterYSize="{src.height}">
+  <SRS>{src.crs.to_wkt()}</SRS>
+  <GeoTransform>{", ".join(str(value) for value in src.transform.to_gdal())}</GeoTransform>
+  <VRTRasterBand dataType="Byte" band="1">
+    <NoDataValue>{src.nodata}</NoDataValue>
+    <SimpleSource>
+      <SourceFilename relativeToVRT="0">{os.path.abspath(source_path)}</SourceFilename>
+      <SourceBand>1</SourceBand>
+    </SimpleSource>
+  </VRTRasterBand>
+</VRTDataset>""")
+
+
+@pytest.fixture
+def data_root(class_tif, tmp_path, monkeypatch) -> str:
+    """
+    a local folder standing in for the s3 api data, with api.vrt of product "water" in 2020.
+    """
+    from cache import DATA_ROOT_ENV, DATASETS, GRIDS, INDEXES, RESULTS
+
+    root = tmp_path / "api_data"
+    (root / "water" / "2020").mkdir(parents=True)
+    with rasterio.open(class_tif) as src:
+        write_vrt(str(root / "water" / "2020" / "api.vrt"), src, class_tif)
+    monkeypatch.setenv(DATA_ROOT_ENV, str(root))
+    for cache in (DATASETS, GRIDS, INDEXES, RESULTS):
+        cache.clear()
+    return str(root)
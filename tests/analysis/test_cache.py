@@ -0,0 +1,30 @@
+import rasterio
+
+from cache import GDAL_OPTIONS, get_request_key
+from conftest import write_vrt
+
+
+def test_external_overviews_are_found(class_tif, tmp_path, monkeypatch):
+    # overviews of api grids are external .ovr files, as grids are opened read only to build them
+    with rasterio.Env(TIFF_USE_OVR=True), rasterio.open(class_tif, "r+") as src:
+        src.build_overviews([2, 4, 8])
+        write_vrt(str(tmp_path / "api.vrt"), src, class_tif)
+    assert (tmp_path / "grid.tif.ovr").exists()
+
+    # options are set as environment variables like configure_gdal
+    for key, value in GDAL_OPTIONS.items():
+        monkeypatch.setenv(key, value)
+    with rasterio.open(class_tif) as src:
+        assert src.overviews(1) == [2, 4, 8]
+    with rasterio.open(str(tmp_path / "api.vrt")) as src:
+        assert len(src.overviews(1)) > 0
+
+
+def test_request_key():
+    geometry = {"type": "Polygon", "coordinates": [[[96, 32], [97, 32], [97, 33], [96, 32]]]}
+    key = get_request_key({"features": [{"id": "a", "geometry": geometry, "properties": {"name": "lake"}}]},
+                          year="2020")
+    assert key == get_request_key({"features": [{"geometry": dict(reversed(geometry.items())), "id": "a"}]},
+                                  year="2020")
+    assert key != get_request_key({"features": [{"id": "b", "geometry": geometry}]}, year="2020")
+    assert key != get_request_key({"features": [{"id": "a", "geometry": geometry}]}, year="2021")
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+import rasterio
+
+import lambda_function
+from cache import RESULTS
+from test_zonal import GEOMETRY, OTHER_GEOMETRY, get_ground_truth
+
+
+def get_event(**params) -> dict:
+    features = [{"type": "Feature", "id": "lake", "geometry": GEOMETRY.__geo_interface__},
+                {"type": "Feature", "id": "river", "geometry": OTHER_GEOMETRY.__geo_interface__}]
+    return {"geojson": {"type": "FeatureCollection", "features": features}, "product_name": "water", **params}
+
+
+def test_region_statistics(class_tif, data_root):
+    response = lambda_function.lambda_handler(get_event(year="2020"), None)
+    assert response["statusCode"] == 200
+    with rasterio.open(class_tif) as src:
+        truth = get_ground_truth(src, [GEOMETRY, OTHER_GEOMETRY])
+    body = json.loads(response["body"])
+    assert body == {**{str(value): count for value, count in truth.items()}, "total": sum(truth.values())}
+    # a second request is answered from the results of the warm container
+    assert len(RESULTS.entries) == 1
+    assert lambda_function.lambda_handler(get_event(year="2020"), None) == response
+
+
+def test_batch_statistics(class_tif, data_root):
+    body = json.loads(lambda_function.lambda_handler(get_event(years=["2020"], statistic_values=[1]), None)["body"])
+    with rasterio.open(class_tif) as src:
+        truths = [get_ground_truth(src, [geom]) for geom in (GEOMETRY, OTHER_GEOMETRY)]
+    assert [feature["id"] for feature in body["features"]] == ["lake", "river"]
+    for feature, truth in zip(body["features"], truths):
+        assert feature["years"]["2020"] == {"1": truth[1], "total": sum(truth.values())}
+
+
+@pytest.mark.parametrize("params", [{"area": True, "accuracy": 0.01}, {"accuracy": 0}, {"max_pixels": -1},
+                                    {"max_pixels": "many"}])
+def test_invalid_parameters(data_root, params):
+    response = lambda_function.lambda_handler(get_event(year="2020", **params), None)
+    assert response["statusCode"] == 400
+    assert "message" in json.loads(response["body"])
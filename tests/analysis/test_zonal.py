@@ -0,0 +1,161 @@
+import math
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio import features
+from shapely.geometry import Polygon, box
+
+from zonal import AreaCounter, BlockHistograms, ClassCounter, ValueStatistics, approximate_zonal_classes, \
+    get_dataset_row_areas, get_max_pixels, get_row_areas, histogram_zonal_classes, label_zonal_classes, \
+    stream_zonal_classes
+
+# vertices are off the pixel grid, so no pixel center lies on an edge
+GEOMETRY = Polygon([(96.0513, 32.9871), (96.4317, 32.6123), (96.2219, 32.5077), (96.1091, 32.7033)])
+OTHER_GEOMETRY = box(96.2031, 32.6017, 96.3529, 32.8543)
+
+
+def get_ground_truth(src: rasterio.DatasetReader, geoms: list, weights: np.ndarray = None) -> dict:
+    """
+    counts of classes from the mask of the whole grid.
+    """
+    data = src.read(1)
+    inside = features.geometry_mask(geoms, data.shape, src.transform, invert=True) & (data != src.nodata)
+    if weights is None:
+        classes, counts = np.unique(data[inside], return_counts=True)
+        return dict(zip(classes.tolist(), counts.tolist()))
+    weights = np.broadcast_to(weights, data.shape)
+    return {value: weights[inside & (data == value)].sum() for value in np.unique(data[inside]).tolist()}
+
+
+def test_class_counter():
+    counter = ClassCounter()
+    counter.update(np.array([[0, 1], [1, 5]], dtype=np.uint8), np.array([[True, True], [True, False]]))
+    other = ClassCounter()
+    other.update(np.array([-1.5, 2.0, 2.0]))
+    counter.merge(other)
+    assert counter.get_counts() == {-1.5: 1, 0: 1, 1: 2, 2.0: 2}
+    assert counter.get_statistics([1, 7]) == {1: 2, 7: 0, "total": 6}
+
+
+@pytest.mark.parametrize("memory_budget", [64 * 1024, 64 * 1024 * 1024])
+def test_stream_matches_full_mask(class_tif, memory_budget):
+    with rasterio.open(class_tif) as src:
+        counter = stream_zonal_classes(src, [GEOMETRY], memory_budget=memory_budget)
+        assert counter.get_counts() == get_ground_truth(src, [GEOMETRY])
+
+
+def test_derived_product(class_tif):
+    with rasterio.open(class_tif) as src:
+        counter = stream_zonal_classes(src, [GEOMETRY], derive=lambda data: data // 2, memory_budget=64 * 1024)
+        truth = get_ground_truth(src, [GEOMETRY])
+    assert counter.get_counts() == {0: truth[0] + truth[1], 1: truth[2]}
+
+
+def test_labels_match_full_mask(class_tif):
+    geoms = [GEOMETRY, OTHER_GEOMETRY, box(100, 20, 101, 21)]
+    with rasterio.open(class_tif) as src:
+        counters = label_zonal_classes(src, geoms, memory_budget=64 * 1024)[0]
+        for geom, counter in zip(geoms[:2], counters):
+            assert counter.get_counts() == get_ground_truth(src, [geom])
+    assert counters[2].total == 0
+
+
+def get_histograms(src: rasterio.DatasetReader, block_size: int) -> BlockHistograms:
+    """
+    histograms of blocks like build_histogram of data module, which needs gdal.
+    """
+    data = src.read(1)
+    rows, cols, block_counts = [], [], []
+    for row in range(0, src.height, block_size):
+        for col in range(0, src.width, block_size):
+            block = data[row:row + block_size, col:col + block_size]
+            block = block[block != src.nodata]
+            if block.size > 0:
+                rows.append(row // block_size)
+                cols.append(col // block_size)
+                block_counts.append(np.bincount(block, minlength=3))
+    return BlockHistograms({"row": np.array(rows), "col": np.array(cols), "classes": np.arange(3),
+                            "counts": np.array(block_counts, dtype=np.uint32), "block_size": np.array(block_size),
+                            "shape": np.array(src.shape), "geo_transform": np.array(src.transform.to_gdal())})
+
+
+def test_histograms_match_full_mask(class_tif):
+    with rasterio.open(class_tif) as src:
+        histograms = get_histograms(src, 64)
+        assert histograms.matches(src)
+        counter = histogram_zonal_classes(src, [GEOMETRY, OTHER_GEOMETRY], histograms)
+        assert counter.get_counts() == get_ground_truth(src, [GEOMETRY, OTHER_GEOMETRY])
+        # a region covering whole blocks reads no pixels
+        assert histogram_zonal_classes(src, [box(96.0, 32.4, 96.5, 33.0)], histograms).total == \
+            int(histograms.counts.sum())
+        assert histogram_zonal_classes(src, [box(100, 20, 101, 21)], histograms).total == 0
+
+
+def test_approximate_within_error(class_tif):
+    with rasterio.open(class_tif) as src:
+        statistics = approximate_zonal_classes(src, [GEOMETRY], max_pixels=4096).get_statistics([0, 1, 2])
+        truth = get_ground_truth(src, [GEOMETRY])
+    assert statistics["overview_factor"] > 1
+    for value in (0, 1, 2):
+        assert abs(statistics[value] - truth[value]) <= statistics["error"][value]
+
+
+@pytest.mark.parametrize("accuracy", [0, 1, -0.1, float("nan"), "0.01", True])
+def test_invalid_accuracy(accuracy):
+    with pytest.raises(ValueError):
+        get_max_pixels(accuracy)
+
+
+@pytest.mark.parametrize("max_pixels", [0, -1, 100.5, "100", None])
+def test_invalid_max_pixels(class_tif, max_pixels):
+    with rasterio.open(class_tif) as src, pytest.raises(ValueError):
+        approximate_zonal_classes(src, [GEOMETRY], max_pixels=max_pixels)
+
+
+def test_approximate_outside_raster(class_tif):
+    with rasterio.open(class_tif) as src:
+        statistics = approximate_zonal_classes(src, [box(100, 20, 101, 21)]).get_statistics([0, 1])
+    assert statistics["total"] == 0
+    assert statistics[0] == 0 and statistics[1] == 0
+
+
+def test_row_areas_of_ellipsoid():
+    areas = get_row_areas((-180.0, 1.0, 0.0, 90.0, 0.0, -1.0), 180)
+    # surface area of WGS84 ellipsoid
+    assert areas.sum() * 360 == pytest.approx(510065621.7241, rel=1e-9)
+    assert np.allclose(areas, areas[::-1])
+    assert (np.diff(areas[:90]) > 0).all()
+
+
+def test_row_areas_of_projected_grid():
+    assert np.allclose(get_row_areas((0.0, 30.0, 0.0, 0.0, 0.0, -30.0), 3, False), 0.0009)
+    assert np.allclose(get_row_areas((0.0, 100.0, 0.0, 0.0, 0.0, -100.0), 2, False, 0.3048), 0.01 * 0.3048 ** 2)
+
+
+def test_area_counter_matches_pixel_areas(class_tif):
+    with rasterio.open(class_tif) as src:
+        counter = stream_zonal_classes(src, [GEOMETRY], memory_budget=64 * 1024, area=True)
+        row_areas = get_dataset_row_areas(src)
+        truth = get_ground_truth(src, [GEOMETRY], row_areas[:, np.newaxis])
+        labels = label_zonal_classes(src, [GEOMETRY], memory_budget=64 * 1024, area=True)[0][0]
+    assert isinstance(counter, AreaCounter)
+    for value, area in truth.items():
+        assert counter.get_counts()[value] == pytest.approx(area, rel=1e-9)
+        assert labels.get_counts()[value] == pytest.approx(area, rel=1e-9)
+
+
+def test_value_statistics_merge():
+    values = np.random.default_rng(0).normal(2, 3, 10000)
+    statistics = ValueStatistics((0, 4), 4)
+    statistics.update(values[:3000])
+    other = ValueStatistics((0, 4), 4)
+    other.update(np.append(values[3000:], np.nan))
+    result = statistics.merge(other).get_statistics([50])
+    assert result["count"] == values.size
+    assert result["mean"] == pytest.approx(values.mean())
+    assert result["std"] == pytest.approx(values.std())
+    assert (result["min"], result["max"]) == (values.min(), values.max())
+    assert math.isclose(result["percentiles"]["50"], np.median(values), rel_tol=0.01)
+    assert sum(result["histogram"]["counts"]) + result["histogram"]["below"] + result["histogram"]["above"] \
+        == values.size
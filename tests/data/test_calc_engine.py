@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip("osgeo")
+
+from eostac.data.module import Calc, RasterImageProcessOptions
+from eostac.data.module.calc_engine import CalcInput, CalcOutput, run_calc
+
+RESOLUTION = 0.01
+SIZE = 300
+NODATA = 255
+
+
+def write_raster(path: str, data: np.ndarray, west: float = 0.0, north: float = 3.0, nodata: float = None) -> str:
+    with rasterio.open(path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                       dtype=data.dtype, crs="EPSG:4326", transform=from_origin(west, north, RESOLUTION, RESOLUTION),
+                       nodata=nodata, tiled=True, blockxsize=128, blockysize=128) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def read_raster(path: str) -> tuple[np.ndarray, float]:
+    with rasterio.open(path) as src:
+        return src.read(1), src.nodata
+
+
+@pytest.fixture
+def years(tmp_path) -> list[np.ndarray]:
+    """
+    water of three years, 0 is land, 1 is water and 255 is nodata.
+    """
+    rng = np.random.default_rng(0)
+    arrays = []
+    for year in range(3):
+        data = rng.integers(0, 2, size=(SIZE, SIZE), dtype=np.uint8)
+        data[rng.random((SIZE, SIZE)) < 0.1] = NODATA
+        arrays.append(data)
+    return arrays
+
+
+@pytest.fixture
+def year_paths(tmp_path, years) -> list[str]:
+    return [write_raster(str(tmp_path / f"{i}.tif"), data, nodata=NODATA) for i, data in enumerate(years)]
+
+
+def test_combinations(tmp_path, years, year_paths):
+    outputs = [CalcOutput("A * 10 + B", str(tmp_path), inputs=(0, 1)),
+               CalcOutput("A * 10 + B", str(tmp_path), inputs=(1, 2)),
+               CalcOutput("A + B + C", str(tmp_path), "UInt16")]
+    dest_paths = [str(tmp_path / f"out{i}.tif") for i in range(len(outputs))]
+    assert run_calc(year_paths, outputs, dest_paths, block_size=128)
+
+    # expressions are evaluated in the types of inputs, and cast to output type like gdal_calc
+    expected = [years[0] * 10 + years[1], years[1] * 10 + years[2], (years[0] + years[1] + years[2]).astype(np.uint16)]
+    for dest_path, data in zip(dest_paths, expected):
+        result, nodata = read_raster(dest_path)
+        assert result.dtype == data.dtype and nodata == 0
+        assert (result == data).all()
+
+
+def test_outputs_share_reads(tmp_path, years, monkeypatch):
+    folders = []
+    for i, data in enumerate(years[:2]):
+        folder = tmp_path / f"year{i}"
+        folder.mkdir()
+        write_raster(str(folder / f"grid_{i}.tif"), data, nodata=NODATA)
+        folders.append(str(folder))
+    reads = []
+    read = CalcInput.read
+
+    def count_read(calc_input, *args):
+        reads.append((calc_input.path, args))
+        return read(calc_input, *args)
+
+    monkeypatch.setattr(CalcInput, "read", count_read)
+    options = RasterImageProcessOptions(src_path=folders, dest_folder=str(tmp_path / "change"))
+    outputs = [CalcOutput("A * 10 + B", str(tmp_path / "change")),
+               CalcOutput("A + B", str(tmp_path / "statistics")),
+               # the grid of the second src folder is A of this output
+               CalcOutput("A", str(tmp_path / "last"), inputs=(1,))]
+    calc = Calc(options, outputs=outputs)
+    assert len(calc.tasks) == 1 and calc()
+
+    # each input is read once per window for all outputs
+    assert len(reads) == len(set(reads)) and len(reads) % 2 == 0
+    expected = [years[0] * 10 + years[1], years[0] + years[1], years[1]]
+    for output, data in zip(outputs, expected):
+        result, _ = read_raster(os.path.join(output.dest_folder, "grid.tif"))
+        assert (result == data).all()
+
+    # a single expression is the same with one output
+    calc = Calc(RasterImageProcessOptions(src_path=folders, dest_folder=str(tmp_path / "single")), calc="A * 10 + B")
+    assert calc()
+    assert (read_raster(str(tmp_path / "single" / "grid.tif"))[0] == expected[0]).all()
+
+
+@pytest.mark.parametrize("hide_nodata", [True, False])
+def test_nodata(tmp_path, years, year_paths, hide_nodata):
+    dest_path = str(tmp_path / "out.tif")
+    assert run_calc(year_paths[:2], [CalcOutput("A + B", str(tmp_path))], [dest_path], hide_nodata=hide_nodata,
+                    nodata=NODATA, block_size=128)
+    result, nodata = read_raster(dest_path)
+    expected = years[0] + years[1]
+    if not hide_nodata:
+        # pixels with nodata in any input are nodata
+        expected[(years[0] == NODATA) | (years[1] == NODATA)] = NODATA
+    assert nodata == NODATA and (result == expected).all()
+
+
+def test_partial_inputs(tmp_path, years):
+    # the second input is shifted by 100 pixels to east and to south, and it is smaller
+    first_path = write_raster(str(tmp_path / "0.tif"), years[0], nodata=NODATA)
+    second_path = write_raster(str(tmp_path / "1.tif"), years[1][:150, :150], west=100 * RESOLUTION,
+                               north=3.0 - 100 * RESOLUTION, nodata=NODATA)
+    dest_path = str(tmp_path / "out.tif")
+    # pixels out of input are masked even when nodata of inputs is hidden
+    assert run_calc([first_path, second_path], [CalcOutput("A * 10 + B", str(tmp_path))], [dest_path],
+                    nodata=NODATA, block_size=128)
+    result, _ = read_raster(dest_path)
+    expected = np.full((SIZE, SIZE), NODATA, dtype=np.uint8)
+    expected[100:250, 100:250] = years[0][100:250, 100:250] * 10 + years[1][:150, :150]
+    assert result.shape == (SIZE, SIZE) and (result == expected).all()
+
+    # inputs with other resolution or not aligned are rejected
+    shifted_path = write_raster(str(tmp_path / "2.tif"), years[1], west=RESOLUTION / 2)
+    with pytest.raises(ValueError):
+        run_calc([first_path, shifted_path], [CalcOutput("A + B", str(tmp_path))], [dest_path])
+
+
+@pytest.mark.parametrize("hide_nodata", [True, False])
+def test_same_as_gdal_calc(tmp_path, year_paths, hide_nodata):
+    gdal_calc = pytest.importorskip("osgeo_utils.gdal_calc")
+    calc = "(A == 1) * 2 + (B == 1)"
+    dest_path = str(tmp_path / "out.tif")
+    assert run_calc(year_paths[:2], [CalcOutput(calc, str(tmp_path))], [dest_path], hide_nodata=hide_nodata,
+                    nodata=0, block_size=128)
+    gdal_calc_path = str(tmp_path / "gdal_calc.tif")
+    gdal_calc.Calc(calc, gdal_calc_path, NoDataValue=0, hideNoData=hide_nodata, type="Byte", quiet=True,
+                   A=year_paths[0], B=year_paths[1]).FlushCache()
+    result, nodata = read_raster(dest_path)
+    expected, expected_nodata = read_raster(gdal_calc_path)
+    assert nodata == expected_nodata and (result == expected).all()
@@ -0,0 +1,79 @@
+import logging
+
+import pytest
+
+pytest.importorskip("osgeo")
+
+from eostac.data.module import Calc, CalcOutput, RasterImageProcessOptions, grid_index
+from eostac.data.module.grid_index import GridIndex
+
+
+@pytest.fixture
+def folders(tmp_path) -> list[str]:
+    """
+    grids of two years, grid c is missing in 2021, and other files are ignored.
+    """
+    names = {"2020": ["a_2020.tif", "b_2020.tif", "c_2020.tif", ".d_2020.tif", "a_2020.tif.aux.xml"],
+             "2021": ["a_2021.tif", "b_2021.tif", "e_2021.vrt"]}
+    paths = []
+    for year, files in names.items():
+        folder = tmp_path / year
+        folder.mkdir()
+        for name in files:
+            (folder / name).write_bytes(b"")
+        paths.append(str(folder))
+    return paths
+
+
+def test_match_grids(folders):
+    index = GridIndex(folders)
+    assert index.prefixes == ["a", "b", "c"]
+    assert index.get_paths("a") == [f"{folders[0]}/a_2020.tif", f"{folders[1]}/a_2021.tif"]
+    assert index.get_paths("c") == [f"{folders[0]}/c_2020.tif", None]
+    assert index.get_mismatches() == {"c": [folders[1]]}
+    assert index.get_folder_paths(folders[1]) == [f"{folders[1]}/a_2021.tif", f"{folders[1]}/b_2021.tif"]
+
+
+def test_select_without_scanning(folders, tmp_path, monkeypatch):
+    index = GridIndex(folders)
+    scanned = []
+    scan_grids = grid_index.scan_grids
+    monkeypatch.setattr(grid_index, "scan_grids", lambda folder, suffix: scanned.append(folder) or
+                        scan_grids(folder, suffix))
+
+    # folders in index are not scanned again, even written in other forms
+    selected = index.select([f"{folders[1]}/", folders[0]])
+    assert scanned == [] and selected.prefixes == ["a", "b", "c"]
+    assert selected.get_paths("c") == [None, f"{folders[0]}/c_2020.tif"]
+
+    # a folder out of index is scanned
+    other = tmp_path / "2022"
+    other.mkdir()
+    (other / "a_2022.tif").write_bytes(b"")
+    assert index.select([str(other)]).prefixes == ["a"] and scanned == [str(other)]
+
+
+def test_report_mismatches(folders, caplog):
+    with caplog.at_level(logging.WARNING):
+        assert GridIndex(folders).report_mismatches("Calc") == {"c": [folders[1]]}
+    assert "1 of 3 grids of Calc are missing in some src folders." in caplog.text
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        assert GridIndex(folders[:1]).report_mismatches() == {}
+    assert caplog.text == ""
+
+
+def test_calc_tasks(folders, tmp_path):
+    options = RasterImageProcessOptions(src_path=folders, dest_folder=str(tmp_path / "change"))
+    outputs = [CalcOutput("A * 10 + B", str(tmp_path / "change")),
+               CalcOutput("A", str(tmp_path / "first"), inputs=(0,))]
+    calc = Calc(options, outputs=outputs, grid_index=GridIndex(folders))
+    # grid c is missing in 2021, so only the output of 2020 is built
+    tasks = {tuple(dest_in_task): src_in_task for src_in_task, dest_in_task, _ in calc.tasks}
+    assert tasks == {
+        (str(tmp_path / "change" / "a.tif"), str(tmp_path / "first" / "a.tif")): [f"{folders[0]}/a_2020.tif",
+                                                                                    f"{folders[1]}/a_2021.tif"],
+        (str(tmp_path / "change" / "b.tif"), str(tmp_path / "first" / "b.tif")): [f"{folders[0]}/b_2020.tif",
+                                                                                    f"{folders[1]}/b_2021.tif"],
+        (str(tmp_path / "first" / "c.tif"),): [f"{folders[0]}/c_2020.tif"],
+    }
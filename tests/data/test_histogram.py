@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip("osgeo")
+
+from osgeo import gdal
+
+from eostac.data.module import build_histogram, get_histogram_path
+
+NODATA = 255
+RESOLUTION = 0.01
+
+
+@pytest.fixture
+def vrt_path(tmp_path) -> str:
+    """
+    a vrt of two grids side by side, they are not multiples of block size, and the second one is all nodata.
+    """
+    rng = np.random.default_rng(0)
+    grids = [rng.integers(0, 4, size=(700, 600), dtype=np.uint8), np.full((700, 300), NODATA, dtype=np.uint8)]
+    grids[0][rng.random((700, 600)) < 0.3] = NODATA
+    grids[0][:256, :256] = NODATA
+    paths = []
+    for i, (west, data) in enumerate(zip([0.0, 6.0], grids)):
+        path = str(tmp_path / f"grid_{i}.tif")
+        with rasterio.open(path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                           dtype="uint8", crs="EPSG:4326", transform=from_origin(west, 7.0, RESOLUTION, RESOLUTION),
+                           nodata=NODATA) as dst:
+            dst.write(data, 1)
+        paths.append(path)
+    path = str(tmp_path / "api.vrt")
+    gdal.BuildVRT(path, paths)
+    return path
+
+
+@pytest.mark.parametrize("block_size", [256, 100])
+def test_build_histogram(vrt_path, block_size):
+    with rasterio.open(vrt_path) as src:
+        data, transform = src.read(1), src.transform
+    path = build_histogram(vrt_path, block_size=block_size)
+    assert path == get_histogram_path(vrt_path)
+
+    with np.load(path) as arrays:
+        assert tuple(arrays["shape"]) == data.shape and int(arrays["block_size"]) == block_size
+        assert np.allclose(arrays["geo_transform"], transform.to_gdal())
+        classes, counts = arrays["classes"], arrays["counts"]
+        blocks = {(row, col): dict(zip(classes.tolist(), block_counts.tolist()))
+                  for row, col, block_counts in zip(arrays["row"].tolist(), arrays["col"].tolist(), counts)}
+    assert classes.tolist() == [0, 1, 2, 3]
+
+    # blocks with only nodata are left out, others have the counts of their pixels
+    expected = {}
+    for row in range(0, data.shape[0], block_size):
+        for col in range(0, data.shape[1], block_size):
+            block = data[row:row + block_size, col:col + block_size]
+            values, value_counts = np.unique(block[block != NODATA], return_counts=True)
+            if len(values) > 0:
+                expected[(row // block_size, col // block_size)] = {value: 0 for value in range(4)} | dict(
+                    zip(values.tolist(), value_counts.tolist()))
+    assert (0, 0) not in blocks
+    assert blocks == expected
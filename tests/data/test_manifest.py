@@ -0,0 +1,136 @@
+import concurrent.futures
+import os
+
+import pytest
+
+pytest.importorskip("osgeo")
+
+from eostac.data.module.manifest import Manifest, expand_vrt_sources
+
+PARAMS = {"module": {"name": "reclass"}}
+
+
+@pytest.fixture
+def task(tmp_path) -> tuple[list[str], list[str]]:
+    inputs = []
+    for name in ("a.tif", "b.tif"):
+        path = tmp_path / name
+        path.write_bytes(b"grid " + name.encode())
+        inputs.append(os.path.normpath(str(path)))
+    output = tmp_path / "out" / "c.tif"
+    output.parent.mkdir()
+    output.write_bytes(b"output")
+    return inputs, [str(output)]
+
+
+def touch(path: str, data: bytes = None):
+    if data is not None:
+        with open(path, "wb") as f:
+            f.write(data)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_up_to_date_after_record(task, tmp_path):
+    src, dest = task
+    manifest = Manifest(str(tmp_path / "out"))
+    assert not manifest.is_up_to_date(src, dest, PARAMS)
+    assert manifest.get_changed_inputs(src, dest, PARAMS) is None
+    manifest.record(src, dest, PARAMS)
+    # the record is saved and read by later runs
+    manifest = Manifest(str(tmp_path / "out"))
+    assert manifest.is_up_to_date(src, dest, PARAMS)
+    assert manifest.get_changed_inputs(src, dest, PARAMS) == []
+
+
+def test_changed_input(task, tmp_path):
+    src, dest = task
+    manifest = Manifest(str(tmp_path / "out"))
+    manifest.record(src, dest, PARAMS)
+    touch(src[1], b"another grid")
+    assert not manifest.is_up_to_date(src, dest, PARAMS)
+    assert manifest.get_changed_inputs(src, dest, PARAMS) == [src[1]]
+
+
+def test_added_and_removed_inputs(task, tmp_path):
+    src, dest = task
+    manifest = Manifest(str(tmp_path / "out"))
+    manifest.record(src[:1], dest, PARAMS)
+    assert not manifest.is_up_to_date(src, dest, PARAMS)
+    assert manifest.get_changed_inputs(src, dest, PARAMS) == [src[1]]
+    manifest.record(src, dest, PARAMS)
+    assert manifest.get_changed_inputs(src[1:], dest, PARAMS) == [src[0]]
+
+
+def test_changed_params(task, tmp_path):
+    src, dest = task
+    manifest = Manifest(str(tmp_path / "out"))
+    manifest.record(src, dest, PARAMS)
+    params = {"module": {"name": "reclass", "nodata": 0}}
+    assert not manifest.is_up_to_date(src, dest, params)
+    assert manifest.get_changed_inputs(src, dest, params) is None
+
+
+def test_changed_output(task, tmp_path):
+    src, dest = task
+    manifest = Manifest(str(tmp_path / "out"))
+    manifest.record(src, dest, PARAMS)
+    touch(dest[0], b"truncated")
+    assert not manifest.is_up_to_date(src, dest, PARAMS)
+    os.remove(dest[0])
+    assert not manifest.is_up_to_date(src, dest, PARAMS)
+
+
+def test_touched_input(task, tmp_path):
+    src, dest = task
+    Manifest(str(tmp_path / "out")).record(src, dest, PARAMS)
+    Manifest(str(tmp_path / "out"), hash_inputs=True).record(src, dest, PARAMS)
+    touch(src[0])
+    assert not Manifest(str(tmp_path / "out")).is_up_to_date(src, dest, PARAMS)
+    assert Manifest(str(tmp_path / "out"), hash_inputs=True).is_up_to_date(src, dest, PARAMS)
+
+
+def test_stages_share_folder(task, tmp_path):
+    src, dest = task
+    other = str(tmp_path / "out" / "d.tif")
+    with open(other, "wb") as f:
+        f.write(b"other output")
+    first = Manifest(str(tmp_path / "out"))
+    second = Manifest(str(tmp_path / "out"))
+    first.record(src, dest, PARAMS)
+    second.record(src, [other], PARAMS)
+    manifest = Manifest(str(tmp_path / "out"))
+    assert manifest.is_up_to_date(src, dest, PARAMS)
+    assert manifest.is_up_to_date(src, [other], PARAMS)
+
+
+def test_threads_share_folder(task, tmp_path):
+    src, _ = task
+    outputs = []
+    for i in range(32):
+        path = str(tmp_path / "out" / f"{i}.tif")
+        with open(path, "wb") as f:
+            f.write(b"output")
+        outputs.append(path)
+    # stages of thread executor record into one folder at the same time
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda path: Manifest(str(tmp_path / "out")).record(src, [path], PARAMS), outputs))
+    manifest = Manifest(str(tmp_path / "out"))
+    assert all(manifest.is_up_to_date(src, [path], PARAMS) for path in outputs)
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path / "out"))
+
+
+def test_vrt_is_fingerprinted_by_sources(task, tmp_path):
+    src, dest = task
+    vrt_path = str(tmp_path / "temp_123.vrt")
+    with open(vrt_path, "w") as f:
+        f.write(f"""<VRTDataset>
+  <VRTRasterBand band="1">
+    <SimpleSource><SourceFilename relativeToVRT="1">a.tif</SourceFilename></SimpleSource>
+    <SimpleSource><SourceFilename relativeToVRT="0">{src[1]}</SourceFilename></SimpleSource>
+  </VRTRasterBand>
+</VRTDataset>""")
+    assert expand_vrt_sources([vrt_path]) == src
+    manifest = Manifest(str(tmp_path / "out"))
+    manifest.record([vrt_path], dest, PARAMS)
+    assert manifest.is_up_to_date(src, dest, PARAMS)
@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+pytest.importorskip("osgeo")
+
+from eostac.data.module import TaskGraph
+
+
+class Recorder:
+    """
+    functions of nodes, it records the order they run in.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ran = []
+
+    def run(self, name: str, result=True) -> bool:
+        with self.lock:
+            self.ran.append(name)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread"])
+def test_dependencies_run_first(executor):
+    recorder = Recorder()
+    graph = TaskGraph(executor=executor, max_workers=4)
+    graph.add("grid", recorder.run, "grid")
+    for name in ("color", "thumbnail"):
+        graph.add(name, recorder.run, name, deps=["grid"])
+    graph.add("tiles", recorder.run, "tiles", deps=["color", "thumbnail", None])
+    assert graph.run()
+    assert recorder.ran[0] == "grid" and recorder.ran[-1] == "tiles" and len(recorder.ran) == 4
+
+
+@pytest.mark.parametrize("result", [False, RuntimeError("broken grid")])
+def test_failure_skips_descendants(result):
+    recorder = Recorder()
+    succeeded = []
+    graph = TaskGraph()
+    graph.add("a", recorder.run, "a", result)
+    graph.add("a_color", recorder.run, "a_color", deps=["a"])
+    graph.add("a_tiles", recorder.run, "a_tiles", deps=["a_color"])
+    graph.add("b", recorder.run, "b", on_success=lambda: succeeded.append("b"))
+    graph.add("b_color", recorder.run, "b_color", deps=["b"], on_success=lambda: succeeded.append("b_color"))
+    graph.add("mosaic", recorder.run, "mosaic", deps=["a_color", "b_color"])
+    assert not graph.run()
+    # nodes of other grids still run
+    assert sorted(recorder.ran) == ["a", "b", "b_color"]
+    assert succeeded == ["b", "b_color"]
+
+
+def test_skipped_node_is_done():
+    recorder = Recorder()
+    recorded = []
+    graph = TaskGraph()
+    graph.add("grid", recorder.run, "grid", skip=lambda: True, on_success=lambda: recorded.append("grid"))
+    graph.add("color", recorder.run, "color", deps=["grid"])
+    assert graph.run()
+    # an up-to-date node neither runs nor is recorded again, and its children run
+    assert recorder.ran == ["color"]
+    assert recorded == []
+
+
+def test_invalid_nodes():
+    graph = TaskGraph()
+    graph.add("grid", bool)
+    with pytest.raises(ValueError):
+        graph.add("grid", bool)
+    with pytest.raises(ValueError):
+        graph.add("color", bool, deps=["missing"])
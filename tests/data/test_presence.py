@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip("osgeo")
+
+from osgeo import gdal
+
+from eostac.data.module import PresenceCube, PresenceProduct, RasterImageProcessOptions
+from eostac.data.module.presence import (PRESENCE_MERGED_KEY, PRESENCE_TYPES, PRESENCE_YEARS_KEY, derive_presence,
+                                         get_presence_nodata, get_presence_type)
+
+NODATA = 255
+SIZE = 100
+
+
+def write_year(folder: str, year: str, data: np.ndarray) -> str:
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"grid_{year}.tif")
+    with rasterio.open(path, "w", driver="GTiff", width=SIZE, height=SIZE, count=1, dtype="uint8", crs="EPSG:4326",
+                       transform=from_origin(0.0, 1.0, 0.01, 0.01), nodata=NODATA) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def get_year(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 2, size=(SIZE, SIZE), dtype=np.uint8)
+    data[rng.random((SIZE, SIZE)) < 0.2] = NODATA
+    # the first rows are nodata in every year
+    data[:2] = NODATA
+    return data
+
+
+def read_cube(path: str) -> tuple[np.ndarray, dict]:
+    with rasterio.open(path) as src:
+        return src.read(1), src.tags()
+
+
+@pytest.mark.parametrize("year_count", [3, 12])
+def test_derive_presence(year_count):
+    rng = np.random.default_rng(year_count)
+    years = rng.integers(0, 2, size=(year_count, 50, 50))
+    dtype = PRESENCE_TYPES[get_presence_type(year_count)]
+    cube = sum(years[i].astype(dtype) << i for i in range(year_count)).astype(dtype)
+
+    assert (derive_presence(cube, [2], "distribution") == years[2]).all()
+    assert (derive_presence(cube, [0, 2], "change") == years[0] + 2 * years[2]).all()
+    bits = list(range(0, year_count, 2))
+    assert (derive_presence(cube, bits, "statistics") == years[bits].sum(axis=0)).all()
+    with pytest.raises(ValueError):
+        derive_presence(cube, bits, "mean")
+
+
+def test_presence_type():
+    assert get_presence_type(7) == "Byte" and get_presence_type(8) == "UInt16"
+    assert get_presence_type(31) == "UInt32" and get_presence_nodata("Byte") == 255
+    with pytest.raises(ValueError):
+        get_presence_type(32)
+
+
+def test_presence_cube(tmp_path, monkeypatch):
+    years = ["2020", "2021", "2022"]
+    data = {year: get_year(i) for i, year in enumerate(years)}
+    folders = [str(tmp_path / year) for year in years]
+    for folder, year in zip(folders, years):
+        write_year(folder, year, data[year])
+    cube_path = str(tmp_path / "presence" / "grid.tif")
+
+    def build(count: int):
+        options = RasterImageProcessOptions(src_path=folders[:count], dest_folder=str(tmp_path / "presence"))
+        assert PresenceCube(options, years[:count])()
+        cube, tags = read_cube(cube_path)
+        nodata = np.logical_and.reduce([data[year] == NODATA for year in years[:count]])
+        assert (cube[nodata] == 255).all() and (cube[:2] == 255).all()
+        assert tags[PRESENCE_YEARS_KEY] == tags[PRESENCE_MERGED_KEY] == ",".join(years[:count])
+        for product in [PresenceProduct("distribution", (years[count - 1],)),
+                        PresenceProduct("change", tuple(years[:2])),
+                        PresenceProduct("statistics", tuple(years[:count]))]:
+            values = [(data[year] == 1).astype(np.uint8) for year in product.years]
+            expected = {"distribution": values[0], "change": values[0] + 2 * values[-1],
+                        "statistics": sum(values)}[product.operation]
+            assert (product.derive(cube, years[:count])[~nodata] == expected[~nodata]).all()
+        return cube
+
+    build(2)
+    opened = []
+    gdal_open = gdal.Open
+    monkeypatch.setattr(gdal, "Open", lambda path, *args: opened.append(path) or gdal_open(path, *args))
+    # a new year is appended to the cube, and the grids of old years are not read again
+    cube = build(3)
+    assert cube.dtype == np.uint8 and os.path.join(folders[2], "grid_2022.tif") in opened
+    assert not any(path.startswith((folders[0], folders[1])) for path in opened)
+
+    # the cube is built again when the grid of a merged year changes
+    opened.clear()
+    data["2021"] = get_year(10)
+    write_year(folders[1], "2021", data["2021"])
+    build(3)
+    assert all(os.path.join(folder, f"grid_{year}.tif") in opened for folder, year in zip(folders, years))
+
+    with pytest.raises(ValueError):
+        PresenceProduct("distribution", ("2019",)).derive(cube, years)
@@ -0,0 +1,93 @@
+import os
+import shutil
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip("osgeo")
+
+from eostac.data.module import publish
+from eostac.data.module.publish import publish_file, publish_files, publish_vrt
+
+
+def fail(*args):
+    raise OSError("Not supported.")
+
+
+@pytest.fixture
+def src_path(tmp_path) -> str:
+    path = tmp_path / "src" / "grid.tif"
+    path.parent.mkdir()
+    path.write_bytes(b"grid")
+    return str(path)
+
+
+def test_hardlink(src_path, tmp_path):
+    dest_path = str(tmp_path / "dest" / "grid.tif")
+    assert publish_file(src_path, dest_path) == "hardlink"
+    assert os.path.samefile(src_path, dest_path)
+    # publishing again keeps the link
+    assert publish_file(src_path, dest_path) == "hardlink"
+
+
+def test_fallback(src_path, tmp_path, monkeypatch):
+    dest_path = str(tmp_path / "dest" / "grid.tif")
+    monkeypatch.setattr(os, "link", fail)
+    cloned = []
+    monkeypatch.setattr(publish, "reflink", lambda src, dest: cloned.append(dest) or shutil.copyfile(src, dest))
+    assert publish_file(src_path, dest_path) == "reflink" and cloned == [dest_path]
+
+    monkeypatch.setattr(publish, "reflink", fail)
+    assert publish_file(src_path, dest_path) == "copy"
+    assert not os.path.samefile(src_path, dest_path)
+    with open(dest_path, "rb") as f:
+        assert f.read() == b"grid"
+
+
+def test_replace_old_link(src_path, tmp_path):
+    dest_path = str(tmp_path / "dest" / "grid.tif")
+    publish_file(src_path, dest_path)
+    # a copy never writes through the old link into src
+    other_path = tmp_path / "other.tif"
+    other_path.write_bytes(b"other")
+    assert publish_file(str(other_path), dest_path, "copy") == "copy"
+    with open(src_path, "rb") as f:
+        assert f.read() == b"grid"
+
+    os.remove(dest_path)
+    os.symlink(str(other_path), dest_path)
+    assert publish_file(src_path, dest_path) == "hardlink" and os.path.samefile(src_path, dest_path)
+    assert other_path.read_bytes() == b"other"
+
+
+def test_invalid_mode(src_path, tmp_path):
+    with pytest.raises(ValueError):
+        publish_files([src_path], str(tmp_path / "dest"), "move")
+
+
+@pytest.mark.parametrize("mode", ["link", "vrt", "copy"])
+def test_publish_vrt(tmp_path, mode):
+    src_paths = []
+    for i in range(2):
+        path = str(tmp_path / "grid" / f"grid_{i}.tif")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with rasterio.open(path, "w", driver="GTiff", width=10, height=10, count=1, dtype="uint8", crs="EPSG:4326",
+                           transform=from_origin(i, 1.0, 0.1, 0.1)) as dst:
+            dst.write(np.full((10, 10), i + 1, dtype=np.uint8), 1)
+        src_paths.append(path)
+    vrt_path = publish_vrt(src_paths, str(tmp_path / "api" / "api.vrt"), mode)
+
+    # sources are relative to the vrt, published grids are next to it except the vrt mode
+    sources = list(ElementTree.parse(vrt_path).iter("SourceFilename"))
+    assert all(element.get("relativeToVRT") == "1" for element in sources)
+    folder = "" if mode != "vrt" else os.path.join("..", "grid")
+    assert sorted(element.text for element in sources) == [os.path.join(folder, f"grid_{i}.tif") for i in range(2)]
+    if mode != "vrt":
+        assert all(os.path.samefile(path, tmp_path / "api" / os.path.basename(path)) == (mode == "link")
+                   for path in src_paths)
+    with rasterio.open(vrt_path) as src:
+        data = src.read(1)
+    assert data.shape == (10, 20) and (data[:, :10] == 1).all() and (data[:, 10:] == 2).all()
@@ -0,0 +1,57 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip("osgeo")
+
+from osgeo import gdal
+
+from eostac.data.module import build_spatial_index, get_spatial_index_path
+
+
+def write_grid(path: str, west: float, north: float, nodata: float = None):
+    with rasterio.open(path, "w", driver="GTiff", width=200, height=100, count=1, dtype="uint8", crs="EPSG:4326",
+                       transform=from_origin(west, north, 0.01, 0.01), nodata=nodata, tiled=True, blockxsize=64,
+                       blockysize=32) as dst:
+        dst.write(np.ones((100, 200), dtype=np.uint8), 1)
+
+
+def test_build_spatial_index(tmp_path):
+    os.makedirs(tmp_path / "grid")
+    paths = [str(tmp_path / "grid" / "a_2020.tif"), str(tmp_path / "grid" / "b_2020.tif")]
+    write_grid(paths[0], 90.0, 30.0, nodata=255)
+    write_grid(paths[1], 92.0, 31.0)
+    vrt_path = str(tmp_path / "api" / "api.vrt")
+    os.makedirs(os.path.dirname(vrt_path))
+    vrt_ds = gdal.BuildVRT(vrt_path, paths)
+    vrt_ds.SetMetadataItem("PRESENCE_YEARS", "2020,2021")
+    del vrt_ds
+
+    index_path = build_spatial_index(vrt_path)
+    assert index_path == get_spatial_index_path(vrt_path)
+    with np.load(index_path) as arrays:
+        # paths are relative to the index, so the index and grids can be moved together
+        assert arrays["path"].tolist() == [os.path.join("..", "grid", "a_2020.tif"),
+                                           os.path.join("..", "grid", "b_2020.tif")]
+        assert np.allclose(arrays["bbox"], [[90.0, 29.0, 92.0, 30.0], [92.0, 30.0, 94.0, 31.0]])
+        assert np.allclose(arrays["geo_transform"][1], [92.0, 0.01, 0.0, 31.0, 0.0, -0.01])
+        assert arrays["shape"].tolist() == [[100, 200], [100, 200]]
+        assert arrays["block_shape"].tolist() == [[32, 64], [32, 64]]
+        assert arrays["nodata"][0] == 255 and np.isnan(arrays["nodata"][1])
+        assert json.loads(str(arrays["metadata"]))["PRESENCE_YEARS"] == "2020,2021"
+
+
+def test_missing_grid(tmp_path):
+    paths = [str(tmp_path / "a_2020.tif"), str(tmp_path / "b_2020.tif")]
+    write_grid(paths[0], 90.0, 30.0)
+    write_grid(paths[1], 92.0, 30.0)
+    vrt_path = str(tmp_path / "api.vrt")
+    gdal.BuildVRT(vrt_path, paths)
+    os.remove(paths[1])
+    # a grid which can not be opened is not indexed
+    with np.load(build_spatial_index(vrt_path)) as arrays:
+        assert arrays["path"].tolist() == ["a_2020.tif"] and arrays["bbox"].shape == (1, 4)
@@ -0,0 +1,120 @@
+import random
+
+import pytest
+
+pytest.importorskip("osgeo")
+
+from eostac.data.module.tile_store import PMTilesReader, build_directories, deserialize_directory, find_entry, \
+    open_tile_store, serialize_directory, zxy_to_tile_id
+
+
+def get_tile(z: int, x: int, y: int) -> bytes:
+    return f"{z}/{x}/{y}".encode()
+
+
+def test_tile_ids():
+    # values from the pmtiles v3 spec
+    assert zxy_to_tile_id(0, 0, 0) == 0
+    assert [zxy_to_tile_id(1, x, y) for x, y in ((0, 0), (0, 1), (1, 1), (1, 0))] == [1, 2, 3, 4]
+    assert zxy_to_tile_id(2, 0, 0) == 5
+    assert zxy_to_tile_id(12, 3423, 1763) == 19078479
+    ids = sorted(zxy_to_tile_id(3, x, y) for x in range(8) for y in range(8))
+    assert ids == list(range(21, 85))
+
+
+def test_directory_round_trip():
+    entries = [(0, 0, 100, 1), (1, 100, 50, 3), (7, 20, 50, 1), (300, 10 ** 9, 2 ** 31, 2), (1000, 5, 7, 0)]
+    assert deserialize_directory(serialize_directory(entries)) == entries
+    assert deserialize_directory(serialize_directory([])) == []
+
+
+def test_find_entry():
+    entries = [(5, 0, 10, 2), (10, 10, 10, 1), (20, 20, 10, 0)]
+    assert find_entry(entries, 4) is None
+    assert find_entry(entries, 6) == entries[0]
+    assert find_entry(entries, 7) is None
+    assert find_entry(entries, 10) == entries[1]
+    # a leaf directory covers tile ids until the next entry
+    assert find_entry(entries, 10 ** 6) == entries[2]
+
+
+def test_leaf_directories():
+    entries = [(tile_id * 3, tile_id * 1000, 1000 + tile_id % 97, 1) for tile_id in range(30000)]
+    root, leaves = build_directories(entries)
+    root_entries = deserialize_directory(root)
+    assert len(root) <= 16384 - 127 and leaves
+    assert all(run_length == 0 for _, _, _, run_length in root_entries)
+    expanded = []
+    for _, offset, length, _ in root_entries:
+        expanded.extend(deserialize_directory(leaves[offset:offset + length]))
+    assert expanded == entries
+
+
+def test_archive_round_trip(tmp_path):
+    path = str(tmp_path / "tiles.pmtiles")
+    tiles = {(z, x, y): get_tile(z, x, y) for z in range(6) for x in range(2 ** z) for y in range(2 ** z)}
+    # sparse tiles of a high zoom, so the directory does not fit in the root
+    rng = random.Random(0)
+    for _ in range(20000):
+        x, y = rng.randrange(2 ** 12), rng.randrange(2 ** 12, 2 ** 13)
+        tiles[13, x, y] = get_tile(13, x, y)
+    uniform = b"uniform"
+    with open_tile_store(path, "w") as store:
+        for (z, x, y), data in tiles.items():
+            store.put(z, x, y, data)
+        # same tiles share their data
+        for y in range(64, 128):
+            store.put(7, 0, y, uniform)
+        store.set_metadata({"minzoom": 0, "maxzoom": 13, "bounds": [90, 30, 100, 40], "name": "water"})
+
+    with PMTilesReader(path) as reader:
+        assert reader.header["addressed_tiles"] == len(tiles) + 64
+        assert reader.header["tile_contents"] == len(tiles) + 1
+        assert reader.header["leaves_length"] > 0
+        assert reader.get_metadata()["name"] == "water"
+        for (z, x, y), data in tiles.items():
+            assert reader.get(z, x, y) == data
+        assert all(reader.get(7, 0, y) == uniform for y in range(64, 128))
+        assert reader.get(7, 1, 100) is None
+        assert reader.get(8, 0, 0) is None
+
+
+def test_archive_append(tmp_path):
+    path = str(tmp_path / "tiles.pmtiles")
+    with open_tile_store(path, "w") as store:
+        for x in range(4):
+            store.put(2, x, 0, get_tile(2, x, 0))
+        store.set_metadata({"name": "water"})
+
+    with open_tile_store(path, "a") as store:
+        assert store.get(2, 1, 0) == get_tile(2, 1, 0)
+        store.put(2, 1, 0, b"updated")
+        store.remove(2, 3, 0)
+        store.put(3, 0, 0, get_tile(3, 0, 0))
+
+    with open_tile_store(path) as reader:
+        assert reader.get_metadata() == {"name": "water"}
+        assert [reader.get(2, x, 0) for x in range(4)] == [get_tile(2, 0, 0), b"updated", get_tile(2, 2, 0), None]
+        assert reader.get(3, 0, 0) == get_tile(3, 0, 0)
+
+    # writing from scratch drops the existing tiles
+    with open_tile_store(path, "w") as store:
+        store.put(0, 0, 0, get_tile(0, 0, 0))
+    with open_tile_store(path) as reader:
+        assert reader.get(2, 0, 0) is None
+        assert reader.get(0, 0, 0) == get_tile(0, 0, 0)
+
+
+def test_mbtiles_metadata(tmp_path):
+    path = str(tmp_path / "tiles.mbtiles")
+    with open_tile_store(path, "w") as store:
+        store.put(1, 0, 0, get_tile(1, 0, 0))
+        store.set_metadata({"name": "water", "minzoom": 0, "bounds": [-180.0, -85.0, 180.0, 85.0],
+                            "center": (0.0, 0.0, 0)})
+    with open_tile_store(path) as store:
+        # lists are saved as the spec requires
+        assert store.get_metadata() == {"name": "water", "minzoom": "0", "bounds": "-180.0,-85.0,180.0,85.0",
+                                        "center": "0.0,0.0,0"}
+        # rows are tms scheme
+        assert store.connection.execute("SELECT tile_row FROM tiles").fetchall() == [(1,)]
+        assert store.get(1, 0, 0) == get_tile(1, 0, 0)
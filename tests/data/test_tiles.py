@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import ColorInterp
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+
+pytest.importorskip("osgeo")
+
+from osgeo import gdal
+
+from eostac.data.module import RasterImageProcessOptions, XYZTiles
+from eostac.data.module.tile_store import PMTilesReader, open_tile_store
+from eostac.data.module.tiles import decode_tile, get_tile_bounds, get_tiles, render_xyz_tiles, write_leaflet_viewer
+
+RESOLUTION = 0.024
+RED = (255, 0, 0, 255)
+# a tile of max zoom inside the red grid, and a tile inside the transparent hole of it
+UNIFORM_TILE = (8, 129, 126)
+EMPTY_TILE = (8, 131, 124)
+FOOTPRINT = (0.0, 0.0, 12.0, 6.0)
+
+
+def get_lng_lat_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    return transform_bounds("EPSG:3857", "EPSG:4326", *get_tile_bounds(z, x, y))
+
+
+def write_grid(path: str, data: np.ndarray, west: float):
+    with rasterio.open(path, "w", driver="GTiff", width=250, height=250, count=4, dtype="uint8", crs="EPSG:4326",
+                       transform=from_origin(west, 6.0, RESOLUTION, RESOLUTION)) as dst:
+        dst.write(data)
+        dst.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue, ColorInterp.alpha]
+
+
+def get_noise(seed: int) -> np.ndarray:
+    data = np.random.default_rng(seed).integers(0, 256, size=(4, 250, 250), dtype=np.uint8)
+    data[3] = 255
+    return data
+
+
+@pytest.fixture
+def color_grids(tmp_path) -> list[str]:
+    """
+    two rgba grids side by side, a red one with a transparent hole and a noisy one.
+    """
+    red = np.empty((4, 250, 250), dtype=np.uint8)
+    red[:] = np.array(RED, dtype=np.uint8)[:, None, None]
+    min_x, min_y, max_x, max_y = get_lng_lat_bounds(*EMPTY_TILE)
+    rows = slice(int((6.0 - max_y) / RESOLUTION) - 2, int((6.0 - min_y) / RESOLUTION) + 2)
+    cols = slice(int(min_x / RESOLUTION) - 2, int(max_x / RESOLUTION) + 2)
+    red[3, rows, cols] = 0
+    paths = [str(tmp_path / "red.tif"), str(tmp_path / "noise.tif")]
+    write_grid(paths[0], red, 0.0)
+    write_grid(paths[1], get_noise(0), 6.0)
+    return paths
+
+
+def build_vrt(vrt_path: str, paths: list[str]) -> str:
+    gdal.BuildVRT(vrt_path, paths)
+    return vrt_path
+
+
+def read_tiles(path: str, z: int) -> dict[tuple[int, int], np.ndarray]:
+    with open_tile_store(path) as store:
+        tiles = {tile: store.get(z, *tile) for tile in get_tiles([FOOTPRINT], z)}
+    return {tile: decode_tile(data) for tile, data in tiles.items() if data is not None}
+
+
+def test_render_tiles(color_grids, tmp_path):
+    vrt_path = build_vrt(str(tmp_path / "tiles.vrt"), color_grids)
+    dest_folder = str(tmp_path / "tile")
+    assert render_xyz_tiles(vrt_path, dest_folder, 6, 8, max_workers=1, web_viewer=True)
+    assert os.path.isfile(os.path.join(dest_folder, "leaflet.html"))
+
+    tiles = read_tiles(dest_folder, 8)
+    assert set(tiles) | {EMPTY_TILE[1:]} == get_tiles([FOOTPRINT], 8)
+    assert all(tile.shape == (4, 256, 256) for tile in tiles.values())
+    assert (tiles[UNIFORM_TILE[1:]] == np.array(RED, dtype=np.uint8)[:, None, None]).all()
+
+    # parents are downsampled from their children
+    parents = read_tiles(dest_folder, 7)
+    assert parents
+    for (x, y), parent in parents.items():
+        children = np.zeros((4, 512, 512), dtype=np.uint8)
+        for dy in range(2):
+            for dx in range(2):
+                child = tiles.get((2 * x + dx, 2 * y + dy))
+                if child is not None:
+                    children[:, dy * 256:(dy + 1) * 256, dx * 256:(dx + 1) * 256] = child
+        assert (parent == children[:, ::2, ::2]).all()
+
+
+@pytest.mark.parametrize("suffix", [".mbtiles", ".pmtiles"])
+def test_archives_match_folder(color_grids, tmp_path, suffix):
+    vrt_path = build_vrt(str(tmp_path / "tiles.vrt"), color_grids)
+    assert render_xyz_tiles(vrt_path, str(tmp_path / "tile"), 6, 8, max_workers=1)
+    # a pool of two workers renders the same tiles
+    assert render_xyz_tiles(vrt_path, str(tmp_path / f"tiles{suffix}"), 6, 8, max_workers=2)
+    for z in range(6, 9):
+        folder_tiles = read_tiles(str(tmp_path / "tile"), z)
+        archive_tiles = read_tiles(str(tmp_path / f"tiles{suffix}"), z)
+        assert folder_tiles.keys() == archive_tiles.keys()
+        assert all((folder_tiles[tile] == archive_tiles[tile]).all() for tile in folder_tiles)
+
+
+def test_uniform_and_empty_tiles(color_grids, tmp_path):
+    vrt_path = build_vrt(str(tmp_path / "tiles.vrt"), color_grids)
+    dest_folder = str(tmp_path / "tile")
+    assert render_xyz_tiles(vrt_path, dest_folder, 6, 8, max_workers=1)
+    # transparent tiles are not saved, and no saved tile is transparent
+    assert not os.path.exists(os.path.join(dest_folder, *map(str, EMPTY_TILE)) + ".png")
+    assert all(tile[3].max() > 0 for tile in read_tiles(dest_folder, 8).values())
+
+    # uniform tiles of one color are links of one file
+    uniform_path = os.path.join(dest_folder, ".uniform", f"{bytes(RED).hex()}.png")
+    tile_path = os.path.join(dest_folder, *map(str, UNIFORM_TILE)) + ".png"
+    assert os.path.samefile(uniform_path, tile_path)
+
+    # and their data is stored once in an archive
+    archive_path = str(tmp_path / "tiles.pmtiles")
+    assert render_xyz_tiles(vrt_path, archive_path, 6, 8, max_workers=1)
+    with PMTilesReader(archive_path) as reader:
+        assert reader.header["tile_contents"] < reader.header["addressed_tiles"]
+
+
+@pytest.mark.parametrize("suffix", ["", ".mbtiles", ".pmtiles"])
+def test_incremental_tiles(color_grids, tmp_path, suffix):
+    vrt_path = build_vrt(str(tmp_path / "tiles.vrt"), color_grids)
+    dest_path = str(tmp_path / f"tiles{suffix}")
+    assert render_xyz_tiles(vrt_path, dest_path, 6, 8, max_workers=1)
+    uniform_path = os.path.join(dest_path, *map(str, UNIFORM_TILE)) + ".png"
+    mtime = os.stat(uniform_path).st_mtime_ns if suffix == "" else None
+
+    # the noisy grid changes, only its tiles are rendered again
+    write_grid(color_grids[1], get_noise(1), 6.0)
+    changed_footprints = [(6.0, 0.0, 12.0, 6.0)]
+    assert render_xyz_tiles(vrt_path, dest_path, 6, 8, resume=False, max_workers=1,
+                            changed_footprints=changed_footprints)
+    if suffix == "":
+        assert os.stat(uniform_path).st_mtime_ns == mtime
+    assert render_xyz_tiles(vrt_path, str(tmp_path / f"full{suffix}"), 6, 8, max_workers=1)
+    for z in range(6, 9):
+        tiles, full_tiles = read_tiles(dest_path, z), read_tiles(str(tmp_path / f"full{suffix}"), z)
+        assert tiles.keys() == full_tiles.keys()
+        assert all((tiles[tile] == full_tiles[tile]).all() for tile in tiles)
+
+    # the noisy grid is removed, and its tiles are cleared
+    vrt_path = build_vrt(str(tmp_path / "red.vrt"), color_grids[:1])
+    assert render_xyz_tiles(vrt_path, dest_path, 6, 8, resume=False, max_workers=1,
+                            changed_footprints=changed_footprints)
+    assert render_xyz_tiles(vrt_path, str(tmp_path / f"red{suffix}"), 6, 8, max_workers=1)
+    for z in range(6, 9):
+        tiles, red_tiles = read_tiles(dest_path, z), read_tiles(str(tmp_path / f"red{suffix}"), z)
+        assert tiles.keys() == red_tiles.keys()
+        assert all((tiles[tile] == red_tiles[tile]).all() for tile in tiles)
+
+
+def test_web_viewer(tmp_path):
+    options = RasterImageProcessOptions(src_path=[str(tmp_path / "color.vrt")], dest_folder=str(tmp_path / "tile"))
+    # gdal2tiles viewers are still accepted
+    assert XYZTiles(options, zoom="0-2", web_viewer="all").web_viewer
+    assert XYZTiles(options, zoom="0-2", web_viewer="openlayers").web_viewer
+    assert not XYZTiles(options, zoom="0-2", web_viewer="none").web_viewer
+    with pytest.raises(ValueError):
+        XYZTiles(options, zoom="0-2", web_viewer="cesium")
+
+    path = write_leaflet_viewer(str(tmp_path), 0, 2, (96.0, 32.4, 96.5, 33.0))
+    assert os.path.basename(path) == "leaflet.html"
+    with open(path) as f:
+        html = f.read()
+    assert "fitBounds([[32.4, 96.0], [33.0, 96.5]])" in html and "maxZoom: 2" in html
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+pytest.importorskip("osgeo")
+
+from eostac.data.module import TaskGraph, add_grid_to_tile
+
+
+@pytest.fixture
+def color_file_path(tmp_path) -> str:
+    path = tmp_path / "colorramp.txt"
+    path.write_text("0,255,255,255,0\n1,0,0,255,255\n")
+    return str(path)
+
+
+def test_mosaic_thumbnail_reads_color_grids(tmp_path, color_file_path):
+    graph = TaskGraph()
+    grid_nodes = {str(tmp_path / "grid" / f"{name}.tif"): None for name in ("a", "b")}
+    color_folder = str(tmp_path / "color")
+    add_grid_to_tile(graph, grid_nodes=grid_nodes, color_folder=color_folder, color_file_path=color_file_path,
+                     thumbnail_folder=str(tmp_path / "thumbnail"), tile_folder=str(tmp_path / "tile"), zoom="0-2")
+
+    thumbnail_nodes = [name for name in graph.nodes if name.startswith("Thumbnail:")]
+    mosaic_node = graph.nodes[next(name for name in thumbnail_nodes if "all_thumbnail" in name)]
+    # png thumbnails lose their georeference when .aux.xml files are cleaned up, so color grids are mosaicked
+    src_paths = mosaic_node.args[1]
+    assert len(src_paths) == 2 and all(os.path.dirname(path) == color_folder for path in src_paths)
+    assert set(thumbnail_nodes) - {mosaic_node.name} <= set(mosaic_node.deps)
+    # tiles are rendered after overviews of color grids are built
+    tile_node = graph.nodes[next(name for name in graph.nodes if name.startswith("XYZTiles:"))]
+    assert set(thumbnail_nodes) - {mosaic_node.name} <= set(tile_node.deps)